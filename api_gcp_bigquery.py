@@ -30,6 +30,70 @@ https://cloud.google.com/python/docs/reference/bigquery/latest
 # pip install --upgrade google-cloud-bigquery-storage
 from google.cloud import bigquery
 
+import threading
+
+from api_sinks import Sink, ParquetSink
+
+
+# ---------------------------------------------------------------------------
+# Client registry
+#
+# One bigquery.Client is kept per project and shared by every helper in this module (and the scripts),
+# instead of a new client per call.  The credentials are discovered once and shared by every client,
+# and each client has an HTTP session with a pool of BQ_CLIENT_POOL_MAXSIZE connections, so the
+# TLS connections are reused by the threads using the client.
+# Call gcp_bq_close_clients() at shutdown.
+
+BQ_CLIENT_POOL_MAXSIZE = 32         # The requests library default is 10
+
+_bq_clients = {}
+_bq_clients_lock = threading.Lock()
+_bq_credentials = None
+
+
+def gcp_bq_client(project_id=None):
+    """
+    Returns the shared bigquery.Client for project_id from the process-wide client registry
+    (the project of the default credentials if project_id is None).
+    """
+    from google.cloud import bigquery
+
+    global _bq_credentials
+
+    with _bq_clients_lock:
+        client = _bq_clients.get(project_id)
+        if client is None:
+            import google.auth
+            from google.auth.transport.requests import AuthorizedSession
+            from requests.adapters import HTTPAdapter
+
+            # Credential discovery (env var, gcloud, metadata server) only happens once
+            if _bq_credentials is None: _bq_credentials, default_project_id = google.auth.default(scopes=bigquery.Client.SCOPE)
+
+            session = AuthorizedSession(_bq_credentials)
+            session.mount("https://", HTTPAdapter(pool_connections=BQ_CLIENT_POOL_MAXSIZE, pool_maxsize=BQ_CLIENT_POOL_MAXSIZE))
+            client = bigquery.Client(project=project_id, credentials=_bq_credentials, _http=session)
+            _bq_clients[project_id] = client
+    return client
+
+
+def gcp_bq_close_clients(verbose=False):
+    """
+    Closes every client in the registry (and its HTTP connections).  A later gcp_bq_client() creates a new one.
+    """
+    with _bq_clients_lock:
+        clients = list(_bq_clients.items())
+        _bq_clients.clear()
+    for project_id, client in clients:
+        try:
+            client.close()
+        except Exception as e:
+            print("ERROR: closing the BigQuery client for " + str(project_id) + " " + str(e))
+    if verbose: print(str(len(clients)) + " BigQuery clients closed")
+
+
+# ---------------------------------------------------------------------------
+
 
 
 def gcp_bq_dataset_exists(project_id=None, dataset_id=None, verbose=False):
@@ -51,7 +115,7 @@ def gcp_bq_dataset_exists(project_id=None, dataset_id=None, verbose=False):
     proj_ds_path = project_id + "." + dataset_id
     if verbose: print("proj_ds_path:" + proj_ds_path)
 
-    client = bigquery.Client(project=project_id)
+    client = gcp_bq_client(project_id)
 
     try:
         client.get_dataset(proj_ds_path)  # Make an API request.
@@ -89,7 +153,7 @@ def gcp_bq_table_exists(project_id=None, dataset_id=None, table_id=None, verbose
     if verbose: print("table_path:" + table_path)
 
     # Added project=project_id 20240923
-    client = bigquery.Client(project=project_id)
+    client = gcp_bq_client(project_id)
 
     try:
         client.get_dataset(proj_ds_path)  # Make an API request.
@@ -110,6 +174,117 @@ def gcp_bq_table_exists(project_id=None, dataset_id=None, table_id=None, verbose
 
 
 
+# ---------------------------------------------------------------------------
+# Metadata cache
+
+# Datasets and tables (including their schema) are cached for BQ_METADATA_CACHE_TTL_S seconds so that
+# per-message checks like "does the table exist" make no API request in the steady state.
+# A dataset or table that was not found is cached for BQ_METADATA_CACHE_NOT_FOUND_TTL_S seconds.
+# Call gcp_bq_invalidate_metadata() when an API request reports NotFound for a cached table.
+
+BQ_METADATA_CACHE_TTL_S = 300.0
+BQ_METADATA_CACHE_NOT_FOUND_TTL_S = 30.0
+
+_bq_metadata_cache = {}
+_bq_metadata_cache_lock = threading.Lock()
+
+
+def _bq_metadata_cached(path, get, ttl_s):
+    # Returns the cached object for path (None if not found), calling get(path) when the entry has expired.
+    from time import monotonic
+    from google.cloud.exceptions import NotFound
+
+    with _bq_metadata_cache_lock:
+        entry = _bq_metadata_cache.get(path)
+    if not entry is None and entry[0] > monotonic(): return entry[1]
+
+    try:
+        obj = get(path)     # Make an API request.
+        t_expires = monotonic() + ttl_s
+    except NotFound:
+        # Error 403 when permissions are insufficient (but could be other error)
+        obj = None
+        t_expires = monotonic() + min(ttl_s, BQ_METADATA_CACHE_NOT_FOUND_TTL_S)
+
+    with _bq_metadata_cache_lock:
+        _bq_metadata_cache[path] = (t_expires, obj)
+    return obj
+
+
+def gcp_bq_get_dataset_cached(project_id=None, dataset_id=None, ttl_s=BQ_METADATA_CACHE_TTL_S, client=None):
+    """
+    Returns the bigquery.Dataset 'dataset_id' from the metadata cache, or None if it does not exist.
+    client is an optional bigquery.Client used when the cache entry has expired.
+    """
+    from google.cloud import bigquery
+
+    if project_id is None: raise Exception("Argument project_id not passed as argument")
+    if dataset_id is None: raise Exception("Argument dataset_id not passed as argument")
+
+    def get(path):
+        return (client if not client is None else gcp_bq_client(project_id)).get_dataset(path)
+
+    return _bq_metadata_cached(project_id + "." + dataset_id, get, ttl_s)
+
+
+def gcp_bq_get_table_cached(project_id=None, dataset_id=None, table_id=None, ttl_s=BQ_METADATA_CACHE_TTL_S, client=None):
+    """
+    Returns the bigquery.Table 'table_id' (with its .schema) from the metadata cache, or None if
+    the dataset or the table does not exist.
+    client is an optional bigquery.Client used when the cache entry has expired.
+    """
+    from google.cloud import bigquery
+
+    if table_id is None: raise Exception("Argument table_id not passed as argument")
+
+    if gcp_bq_get_dataset_cached(project_id=project_id, dataset_id=dataset_id, ttl_s=ttl_s, client=client) is None: return None
+
+    def get(path):
+        return (client if not client is None else gcp_bq_client(project_id)).get_table(path)
+
+    return _bq_metadata_cached(project_id + "." + dataset_id + "." + table_id, get, ttl_s)
+
+
+def gcp_bq_table_exists_cached(project_id=None, dataset_id=None, table_id=None, ttl_s=BQ_METADATA_CACHE_TTL_S, verbose=False):
+    """
+    Returns True if the dataset 'dataset_id' and table name 'table_id' exists.
+    Same as gcp_bq_table_exists(), but answered from the metadata cache.
+    """
+    table = gcp_bq_get_table_cached(project_id=project_id, dataset_id=dataset_id, table_id=table_id, ttl_s=ttl_s)
+    if verbose: print("Table {}.{}.{} {}".format(project_id, dataset_id, table_id, "exists" if not table is None else "is not found or IAM permissions are insufficient."))
+    return not table is None
+
+
+def gcp_bq_table_schema_cached(project_id=None, dataset_id=None, table_id=None, ttl_s=BQ_METADATA_CACHE_TTL_S):
+    """
+    Returns the schema (list of bigquery.SchemaField) of table 'table_id' from the metadata cache,
+    or None if the table does not exist.
+    """
+    table = gcp_bq_get_table_cached(project_id=project_id, dataset_id=dataset_id, table_id=table_id, ttl_s=ttl_s)
+    return None if table is None else table.schema
+
+
+def gcp_bq_invalidate_metadata(project_id=None, dataset_id=None, table_id=None):
+    """
+    Removes the cached metadata for table 'table_id' and its dataset, or for the dataset 'dataset_id'
+    and all of its tables if table_id is None, or for the whole project if dataset_id is None.
+    """
+    if project_id is None: raise Exception("Argument project_id not passed as argument")
+
+    with _bq_metadata_cache_lock:
+        if dataset_id is None:
+            paths = [path for path in _bq_metadata_cache if path == project_id or path.startswith(project_id + ".")]
+        elif table_id is None:
+            paths = [path for path in _bq_metadata_cache if path == project_id + "." + dataset_id or path.startswith(project_id + "." + dataset_id + ".")]
+        else:
+            paths = [project_id + "." + dataset_id, project_id + "." + dataset_id + "." + table_id]
+        for path in paths:
+            _bq_metadata_cache.pop(path, None)
+
+
+# ---------------------------------------------------------------------------
+
+
 def gcp_bq_insert(project_id=None, dataset_id=None, table_id=None, verbose=False):
     """
     Returns True if the synthetic data generated was succcessfully inserted
@@ -130,7 +305,7 @@ def gcp_bq_insert(project_id=None, dataset_id=None, table_id=None, verbose=False
     if table_id is None: raise Exception("Argument table_id not passed as argument")
     if ":" in table_id or "." in table_id: raise Exception("Argument table_id passed an invalid character such as ':' or '.'.  Format is 'table_id'")
 
-    client = bigquery.Client(project=project_id)
+    client = gcp_bq_client(project_id)
 
     # ds_data_platform
     table_ref = client.dataset(dataset_id).table(table_id)
@@ -198,10 +373,11 @@ def gcp_bq_insert(project_id=None, dataset_id=None, table_id=None, verbose=False
         return True
 
 
-def gcp_bq_row_exists(project_id=None, dataset_id=None, table_id=None, unix_ms=None, pub_region=None, verbose=False):
+def gcp_bq_row_exists(project_id=None, dataset_id=None, table_id=None, unix_ms=None, pub_region=None, batch_query=True, verbose=False):
     """
     Returns True if a record matching unix_ms and pub_region exists.
 
+    batch_query=True runs the query at batch priority (may be queued), otherwise at interactive priority.
     """
 
     if project_id is None: raise Exception("Argument project_id has not been passed")
@@ -214,7 +390,7 @@ def gcp_bq_row_exists(project_id=None, dataset_id=None, table_id=None, unix_ms=N
     from time import sleep
 
     # Construct a BigQuery client object.
-    client = bigquery.Client(project=project_id)
+    client = gcp_bq_client(project_id)
 
     sql = "SELECT unix_ms,pub_region"
     sql += " FROM `" + project_id + "." + dataset_id + "." + table_id + "`"
@@ -222,6 +398,12 @@ def gcp_bq_row_exists(project_id=None, dataset_id=None, table_id=None, unix_ms=N
     sql += " ORDER BY unix_ms;"
     if verbose: print(sql)
 
+    if not batch_query:
+        # Execute an interactive query and wait for the result
+        rows = client.query(sql).result()  # Make an API request.
+        if rows.total_rows > 1: print("WARNING: " + str(rows.total_rows-1) + " duplicate records found!")
+        return rows.total_rows > 0
+
     # Execute a batch query.
     job_config = bigquery.QueryJobConfig(
         # Run at batch priority, which won't count toward concurrent rate limit.
@@ -255,7 +437,230 @@ def gcp_bq_row_exists(project_id=None, dataset_id=None, table_id=None, unix_ms=N
         return False
 
 
+def gcp_bq_rows_exist(project_id=None, dataset_id=None, table_id=None, keys=None, batch_query=False, verbose=False):
+    """
+    Returns the set of (unix_ms, pub_region) in keys (a list of (unix_ms, pub_region)) that exist in the table,
+    with one query for all of the keys instead of a gcp_bq_row_exists() query per row.
+    unix_ms is returned as a float.
 
+    The query runs at interactive priority, because the subscriber waits for it before acking the message.
+    batch_query=True runs it at batch priority instead, which may be queued for minutes (offline use only).
+    """
+
+    if project_id is None: raise Exception("Argument project_id has not been passed")
+    if dataset_id is None: raise Exception("Argument data_set has not been passed")
+    if table_id is None: raise Exception("Argument table_id has not been passed")
+    if keys is None: raise Exception("Argument keys has not been passed")
+    if len(keys) == 0: return set()
+
+    from google.cloud import bigquery
+
+    # Construct a BigQuery client object.
+    client = gcp_bq_client(project_id)
+
+    # One condition per pub_region (a message has a single pub_region)
+    regions = {}
+    for unix_ms, pub_region in keys:
+        regions.setdefault(pub_region, []).append(float(unix_ms))
+    conditions = []
+    params = []
+    for i, (pub_region, unix_ms) in enumerate(regions.items()):
+        conditions.append("(pub_region=@pub_region_" + str(i) + " AND unix_ms IN UNNEST(@unix_ms_" + str(i) + "))")
+        params.append(bigquery.ScalarQueryParameter("pub_region_" + str(i), "STRING", pub_region))
+        params.append(bigquery.ArrayQueryParameter("unix_ms_" + str(i), "FLOAT64", unix_ms))
+
+    sql = "SELECT unix_ms,pub_region"
+    sql += " FROM `" + project_id + "." + dataset_id + "." + table_id + "`"
+    sql += " WHERE " + " OR ".join(conditions) + ";"
+    if verbose: print(sql)
+
+    job_config = bigquery.QueryJobConfig(query_parameters=params)
+    # Run at batch priority, which won't count toward concurrent rate limit.
+    if batch_query: job_config.priority = bigquery.QueryPriority.BATCH
+    rows = client.query(sql, job_config=job_config).result()      # Make an API request.
+    return set((float(row["unix_ms"]), row["pub_region"]) for row in rows)
+
+
+
+
+
+# ---------------------------------------------------------------------------
+# Dedup index
+
+# In-process index of the (unix_ms, pub_region) rows already written to a table, so the subscriber
+# does not need a BigQuery query per row to avoid duplicates.  Recent keys are kept in an LRU set and
+# every key seen is added to a Bloom filter.  A key in neither is new (no request).  A key in the Bloom
+# filter but not in the LRU set may be a false positive, so only then is BigQuery queried.
+DEDUP_LRU_SIZE = 100000
+DEDUP_BLOOM_CAPACITY = 2000000
+DEDUP_BLOOM_ERROR_RATE = 0.001
+# BqDedupIndex.warm() loads the rows of the last DEDUP_WARM_WINDOW_S seconds.  A message that was written but
+# not acked is delivered again once its ack deadline (10 min at most) or lease expires, so older rows are not
+# expected again.  The query scans the key columns of the table (it is not partitioned), so keep it short.
+DEDUP_WARM_WINDOW_S = 1800.0
+# The Bloom filter is replaced by a new one every DEDUP_BLOOM_ROTATE_S seconds (the warm window), or once it
+# holds DEDUP_BLOOM_CAPACITY keys, and the previous filter is kept.  The keys of the last one to two windows are
+# then in the filters, and the false positive rate stays near DEDUP_BLOOM_ERROR_RATE in a long running service.
+DEDUP_BLOOM_ROTATE_S = DEDUP_WARM_WINDOW_S
+
+
+class BloomFilter:
+    """
+    Bloom filter sized for capacity keys at the false positive rate error_rate.
+    Keys are strings.  The k bit positions come from one BLAKE2b hash (double hashing).
+    """
+
+    def __init__(self, capacity=DEDUP_BLOOM_CAPACITY, error_rate=DEDUP_BLOOM_ERROR_RATE):
+        from math import ceil, log
+        if capacity < 1: raise Exception("Argument capacity must be at least 1")
+        if error_rate <= 0.0 or error_rate >= 1.0: raise Exception("Argument error_rate must be between 0 and 1")
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.n_bits = int(ceil(-capacity * log(error_rate) / (log(2) ** 2)))
+        self.n_hashes = max(1, int(round(self.n_bits / capacity * log(2))))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        from hashlib import blake2b
+        digest = blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.n_bits for i in range(0, self.n_hashes)]
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for pos in self._positions(key):
+            if not self.bits[pos >> 3] & (1 << (pos & 7)): return False
+        return True
+
+
+class BqDedupIndex:
+    """
+    Dedup index of the (unix_ms, pub_region) rows in the BigQuery table project_id.dataset_id.table_id.
+
+    exists() answers from memory except on a Bloom filter hit that is not in the LRU set, when
+    gcp_bq_row_exists() is called (interactive priority).  Call add() for every row written and
+    warm() at startup to load the keys of the rows written recently.  The index is thread safe.
+
+    The Bloom filter is rotated every bloom_rotate_s seconds (only by capacity if 0), or once it holds
+    bloom_capacity keys:  the current and the previous filter are checked, so a key is forgotten after
+    one to two rotations.
+    """
+
+    def __init__(self, project_id=None, dataset_id=None, table_id=None, lru_size=DEDUP_LRU_SIZE, bloom_capacity=DEDUP_BLOOM_CAPACITY, bloom_error_rate=DEDUP_BLOOM_ERROR_RATE, bloom_rotate_s=DEDUP_BLOOM_ROTATE_S):
+        from collections import OrderedDict
+        from time import monotonic
+
+        if project_id is None: raise Exception("Argument project_id has not been passed")
+        if dataset_id is None: raise Exception("Argument data_set has not been passed")
+        if table_id is None: raise Exception("Argument table_id has not been passed")
+
+        self.project_id = project_id
+        self.dataset_id = dataset_id
+        self.table_id = table_id
+        self.lru_size = lru_size
+        self._lru = OrderedDict()
+        self.bloom_capacity = bloom_capacity
+        self.bloom_error_rate = bloom_error_rate
+        self.bloom_rotate_s = bloom_rotate_s
+        self._bloom = BloomFilter(capacity=bloom_capacity, error_rate=bloom_error_rate)
+        self._bloom_previous = None
+        self._bloom_t_start = monotonic()
+        self._lock = threading.Lock()
+        self.stats = {"lru_hits": 0, "bloom_misses": 0, "bq_queries": 0, "bq_hits": 0, "bloom_rotations": 0}
+
+    @staticmethod
+    def key(unix_ms, pub_region):
+        return repr(float(unix_ms)) + "|" + str(pub_region)
+
+    def _rotate(self):
+        # Starts a new Bloom filter (the current one becomes the previous one) when it is due.  Called with self._lock held
+        from time import monotonic
+        if self._bloom.count < self.bloom_capacity and (self.bloom_rotate_s <= 0 or monotonic() - self._bloom_t_start < self.bloom_rotate_s): return
+        self._bloom_previous = self._bloom
+        self._bloom = BloomFilter(capacity=self.bloom_capacity, error_rate=self.bloom_error_rate)
+        self._bloom_t_start = monotonic()
+        self.stats["bloom_rotations"] += 1
+
+    def _in_bloom(self, key):
+        # Called with self._lock held
+        return key in self._bloom or (not self._bloom_previous is None and key in self._bloom_previous)
+
+    def _add(self, key):
+        # Called with self._lock held
+        self._lru[key] = None
+        self._lru.move_to_end(key)
+        if len(self._lru) > self.lru_size: self._lru.popitem(last=False)
+        self._rotate()
+        self._bloom.add(key)
+
+    def add(self, unix_ms=None, pub_region=None):
+        """ Adds the row key (unix_ms, pub_region) to the index. """
+        key = self.key(unix_ms, pub_region)
+        with self._lock:
+            self._add(key)
+
+    def exists(self, unix_ms=None, pub_region=None, verbose=False):
+        """
+        Returns True if a row with unix_ms and pub_region exists in the table.
+        """
+        key = self.key(unix_ms, pub_region)
+        with self._lock:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                self.stats["lru_hits"] += 1
+                return True
+            self._rotate()
+            if not self._in_bloom(key):
+                self.stats["bloom_misses"] += 1
+                return False
+            self.stats["bq_queries"] += 1
+
+        # Bloom filter hit that is not in the LRU set:  an older row, or a false positive
+        exists = gcp_bq_row_exists(project_id=self.project_id, dataset_id=self.dataset_id, table_id=self.table_id, unix_ms=unix_ms, pub_region=pub_region, batch_query=False, verbose=verbose)
+        if exists:
+            with self._lock:
+                self.stats["bq_hits"] += 1
+                self._add(key)
+        return exists
+
+    def warm(self, window_s=DEDUP_WARM_WINDOW_S, client=None, verbose=False):
+        """
+        Loads the keys of the rows written in the last window_s seconds into the index.
+        Returns the number of rows loaded.
+        """
+        from google.cloud import bigquery
+        from datetime import datetime, timezone
+        from time import perf_counter
+
+        t_start = perf_counter()
+        if client is None: client = gcp_bq_client(self.project_id)
+
+        unix_ms_min = datetime.now(tz=timezone.utc).timestamp() * 1000.0 - window_s * 1000.0
+        sql = "SELECT unix_ms,pub_region"
+        sql += " FROM `" + self.project_id + "." + self.dataset_id + "." + self.table_id + "`"
+        sql += " WHERE unix_ms>=" + str(unix_ms_min)
+        sql += " ORDER BY unix_ms;"
+        if verbose: print(sql)
+
+        n = 0
+        # Oldest first so the newest rows end up in the LRU set
+        for row in client.query(sql).result():      # Make an API request.
+            key = self.key(row["unix_ms"], row["pub_region"])
+            with self._lock:
+                self._add(key)
+            n += 1
+
+        if verbose: print("Dedup index warmed with " + str(n) + " rows from the last " + str(window_s) + " sec of " + self.table_id + " in " + str(round(perf_counter() - t_start, 3)) + " sec")
+        return n
+
+
+# ---------------------------------------------------------------------------
 
 
 def gcp_bq_query_db(project_id=None, dataset_id=None, table_id=None, batch_query=True, verbose=False):
@@ -288,7 +693,7 @@ def gcp_bq_query_db(project_id=None, dataset_id=None, table_id=None, batch_query
     if table_id is None: raise Exception("Argument table_id has not been passed")
 
     # Construct a BigQuery client object.
-    client = bigquery.Client(project=project_id)
+    client = gcp_bq_client(project_id)
 
     sql = "SELECT unix_ms, pub_region, datetime_created, msg_trip_s, msg_proc_s"
     sql += " FROM `" + project_id + "." + dataset_id + "." + table_id + "`"
@@ -370,6 +775,626 @@ def gcp_bq_query_db(project_id=None, dataset_id=None, table_id=None, batch_query
     """
 
 
+# ---------------------------------------------------------------------------
+# Deterministic insertId
+
+def gcp_bq_insert_id(pub_region=None, unix_ms=None, message_id=None):
+    """
+    Returns a deterministic insertId (row_ids argument of insert_rows_json()) for the row of the sample
+    unix_ms from pub_region in the Pub/Sub message message_id.
+
+    BigQuery drops a streamed row with the same insertId as a row streamed in the last few minutes
+    (best effort), so a redelivered message is absorbed without a query before the insert.
+    """
+    from hashlib import blake2b
+
+    if pub_region is None: raise Exception("Argument pub_region has not been passed")
+    if unix_ms is None: raise Exception("Argument unix_ms has not been passed")
+    key = str(pub_region) + "|" + repr(float(unix_ms)) + "|" + str(message_id)
+    return blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+
+# ---------------------------------------------------------------------------
+# Micro-batching writer
+
+# Rows from many messages (and threads) are buffered and inserted with one insert_rows_json() request
+# when BQ_BATCH_MAX_ROWS rows or BQ_BATCH_MAX_BYTES bytes are buffered, or the oldest row has waited
+# BQ_BATCH_MAX_LATENCY_S seconds.  A streaming insert request is limited to 10 MB and 50,000 rows.
+BQ_BATCH_MAX_ROWS = 500
+BQ_BATCH_MAX_BYTES = 5000000        # 5 MB
+BQ_BATCH_MAX_LATENCY_S = 1.0
+
+
+class BqBatchWriter(Sink):
+    """
+    Buffered writer of rows (dictionaries) to the BigQuery table project_id.dataset_id.table_id
+    (see Sink in api_sinks.py).  The rows are inserted with insert_rows_json().
+
+    add() buffers the rows of one message, optionally with their insertIds (row_ids, see gcp_bq_insert_id()),
+    together with the callbacks on_success() and on_failure(),
+    which are called from the flush thread once the insert request for those rows has completed.
+    on_success() is only called if every row of the message was inserted (e.g. to ack the message),
+    otherwise on_failure(errors) is called (e.g. to nack the message so it is delivered again).
+    """
+
+    bigquery = True
+
+    def __init__(self, project_id=None, dataset_id=None, table_id=None, max_rows=BQ_BATCH_MAX_ROWS, max_bytes=BQ_BATCH_MAX_BYTES, max_latency_s=BQ_BATCH_MAX_LATENCY_S, client=None, verbose=False):
+        if project_id is None: raise Exception("Argument project_id has not been passed")
+        if dataset_id is None: raise Exception("Argument data_set has not been passed")
+        if table_id is None: raise Exception("Argument table_id has not been passed")
+
+        self.project_id = project_id
+        self.dataset_id = dataset_id
+        self.table_id = table_id
+        self.client = client
+        super().__init__(max_rows=max_rows, max_bytes=max_bytes, max_latency_s=max_latency_s, verbose=verbose)
+
+    def _insert(self, rows, row_ids=None):
+        # Inserts rows with one request and returns the insert_rows_json() errors:
+        # a list of {"index": <row index>, "errors": [...]} for each row that was not inserted.
+        # row_ids is None or a list with an insertId (or None) per row.
+        from google.cloud import bigquery
+        from google.cloud.exceptions import NotFound
+
+        try:
+            if self.client is None: self.client = gcp_bq_client(self.project_id)
+            table_ref = gcp_bq_get_table_cached(project_id=self.project_id, dataset_id=self.dataset_id, table_id=self.table_id, client=self.client)
+            if table_ref is None: table_ref = self.project_id + "." + self.dataset_id + "." + self.table_id
+            if row_ids is None:
+                return self.client.insert_rows_json(table_ref, rows)     # Make an API request.
+            else:
+                return self.client.insert_rows_json(table_ref, rows, row_ids=row_ids)     # Make an API request.
+        except Exception as e:
+            if isinstance(e, NotFound): gcp_bq_invalidate_metadata(project_id=self.project_id, dataset_id=self.dataset_id, table_id=self.table_id)
+            print("ERROR: insert_rows_json() " + str(e))
+            return [{"index": i, "errors": [str(e)]} for i in range(0, len(rows))]
+
+# ---------------------------------------------------------------------------
+# Storage Write API sink
+
+# Alternative to the legacy streaming insert_rows_json().  Rows are serialized as protobuf messages
+# built from the table schema and appended to a COMMITTED write stream (rows are visible as soon as
+# an append succeeds).  Every append carries the stream offset of its first row, so an append that is
+# retried after a lost response is rejected by BigQuery with ALREADY_EXISTS instead of writing the
+# rows twice (exactly-once within a write stream).
+#
+# https://cloud.google.com/bigquery/docs/write-api
+# https://cloud.google.com/bigquery/docs/write-api-streaming
+
+# pip install --upgrade google-cloud-bigquery-storage
+STORAGE_WRITE_APPEND_RETRIES = 3
+STORAGE_WRITE_RETRY_BACKOFF_S = 0.5
+
+
+def gcp_bq_schema_to_proto(schema=None, message_name="BqRow"):
+    """
+    Returns (descriptor_proto, message_class) for a protobuf message with one field per column
+    of the BigQuery schema (list of bigquery.SchemaField).
+
+    TIMESTAMP columns are int64 microseconds since the epoch, DATE columns int32 days since the epoch,
+    and NUMERIC, BIGNUMERIC, DATETIME, TIME and JSON columns strings (as accepted by the Storage Write API).
+    REPEATED and RECORD columns are not supported.
+    """
+    from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+    if schema is None: raise Exception("Argument schema has not been passed")
+
+    F = descriptor_pb2.FieldDescriptorProto
+    proto_types = {
+        "STRING": F.TYPE_STRING, "BYTES": F.TYPE_BYTES,
+        "INTEGER": F.TYPE_INT64, "INT64": F.TYPE_INT64,
+        "FLOAT": F.TYPE_DOUBLE, "FLOAT64": F.TYPE_DOUBLE,
+        "BOOLEAN": F.TYPE_BOOL, "BOOL": F.TYPE_BOOL,
+        "TIMESTAMP": F.TYPE_INT64, "DATE": F.TYPE_INT32,
+        "NUMERIC": F.TYPE_STRING, "BIGNUMERIC": F.TYPE_STRING,
+        "DATETIME": F.TYPE_STRING, "TIME": F.TYPE_STRING, "JSON": F.TYPE_STRING,
+    }
+
+    file_proto = descriptor_pb2.FileDescriptorProto(name=message_name.lower() + ".proto", package="api_gcp_bigquery")
+    descriptor_proto = file_proto.message_type.add(name=message_name)
+    for i in range(0, len(schema)):
+        field = schema[i]
+        if field.mode == "REPEATED" or not field.field_type in proto_types: raise Exception("Column '" + field.name + "' of type " + field.mode + " " + field.field_type + " not supported by gcp_bq_schema_to_proto()")
+        descriptor_proto.field.add(name=field.name, number=i+1, type=proto_types[field.field_type], label=F.LABEL_OPTIONAL)
+
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(file_proto)
+    message_class = message_factory.GetMessageClass(pool.FindMessageTypeByName("api_gcp_bigquery." + message_name))
+    return descriptor_proto, message_class
+
+
+def gcp_bq_row_to_proto(row=None, schema=None, message_class=None):
+    """
+    Returns the row (dictionary in the insert_rows_json() format) serialized as message_class
+    (see gcp_bq_schema_to_proto()).  Columns missing from the row or None are left unset (NULL).
+    """
+    from datetime import datetime, date, timezone
+
+    msg = message_class()
+    for field in schema:
+        value = row.get(field.name)
+        if value is None: continue
+        if field.field_type == "TIMESTAMP":
+            if isinstance(value, str): value = datetime.fromisoformat(value)
+            if isinstance(value, datetime):
+                if value.tzinfo is None: value = value.replace(tzinfo=timezone.utc)
+                value = round(value.timestamp() * 1e6)
+            value = int(value)
+        elif field.field_type == "DATE":
+            if isinstance(value, str): value = date.fromisoformat(value)
+            value = (value - date(1970, 1, 1)).days
+        elif field.field_type in ("INTEGER", "INT64"):
+            value = int(value)
+        elif field.field_type in ("FLOAT", "FLOAT64"):
+            value = float(value)
+        elif field.field_type in ("NUMERIC", "BIGNUMERIC", "DATETIME", "TIME", "JSON"):
+            value = str(value)
+        setattr(msg, field.name, value)
+    return msg.SerializeToString()
+
+
+class BqCommittedWriteStream:
+    """
+    A COMMITTED Storage Write API stream to the table project_id.dataset_id.table_id.
+
+    append(serialized_rows, offset) appends protobuf rows (see gcp_bq_row_to_proto()) at the stream offset
+    and raises the API exception if the append fails (google.api_core.exceptions.AlreadyExists if rows
+    were already appended at offset, OutOfRange if offset is past the end of the stream).
+    """
+
+    def __init__(self, project_id=None, dataset_id=None, table_id=None, descriptor_proto=None, write_client=None, verbose=False):
+        from google.cloud import bigquery_storage_v1
+        from google.cloud.bigquery_storage_v1 import types, writer
+
+        if project_id is None: raise Exception("Argument project_id has not been passed")
+        if dataset_id is None: raise Exception("Argument data_set has not been passed")
+        if table_id is None: raise Exception("Argument table_id has not been passed")
+        if descriptor_proto is None: raise Exception("Argument descriptor_proto has not been passed")
+
+        self.write_client = write_client if not write_client is None else bigquery_storage_v1.BigQueryWriteClient()
+        parent = self.write_client.table_path(project_id, dataset_id, table_id)
+        write_stream = types.WriteStream()
+        write_stream.type_ = types.WriteStream.Type.COMMITTED
+        self.stream_name = self.write_client.create_write_stream(parent=parent, write_stream=write_stream).name     # Make an API request.
+        if verbose: print("Storage Write API stream " + self.stream_name)
+
+        # The schema is only sent with the first request on the connection
+        request_template = types.AppendRowsRequest()
+        request_template.write_stream = self.stream_name
+        proto_schema = types.ProtoSchema()
+        proto_schema.proto_descriptor = descriptor_proto
+        proto_data = types.AppendRowsRequest.ProtoData()
+        proto_data.writer_schema = proto_schema
+        request_template.proto_rows = proto_data
+        self._append_rows_stream = writer.AppendRowsStream(self.write_client, request_template)
+
+    def append(self, serialized_rows=None, offset=0, timeout_s=60.0):
+        from google.cloud.bigquery_storage_v1 import types
+
+        proto_rows = types.ProtoRows()
+        proto_rows.serialized_rows.extend(serialized_rows)
+        proto_data = types.AppendRowsRequest.ProtoData()
+        proto_data.rows = proto_rows
+        request = types.AppendRowsRequest()
+        request.offset = offset
+        request.proto_rows = proto_data
+        self._append_rows_stream.send(request).result(timeout=timeout_s)     # Make an API request.
+
+    def close(self):
+        self._append_rows_stream.close()
+        self.write_client.finalize_write_stream(name=self.stream_name)      # Make an API request.
+
+
+class FakeWriteStream:
+    """
+    Local stand-in for BqCommittedWriteStream, so the Storage Write API sink can be used offline.
+
+    Appended rows are kept in self.rows (decoded with message_class if given, else the serialized bytes)
+    with the same offset rules as BigQuery.  fail_appends makes the next appends raise ServiceUnavailable,
+    and lose_responses makes the next appends succeed but raise DeadlineExceeded (a lost response).
+    """
+
+    def __init__(self, message_class=None):
+        self.message_class = message_class
+        self.rows = []
+        self.appends = 0
+        self.fail_appends = 0
+        self.lose_responses = 0
+        self.closed = False
+
+    def append(self, serialized_rows=None, offset=0, timeout_s=60.0):
+        from google.api_core import exceptions
+
+        self.appends += 1
+        if self.closed: raise exceptions.FailedPrecondition("Stream is finalized")
+        if self.fail_appends > 0:
+            self.fail_appends -= 1
+            raise exceptions.ServiceUnavailable("Fake append failure")
+        if offset < len(self.rows): raise exceptions.AlreadyExists("Offset " + str(offset) + " already exists (stream length " + str(len(self.rows)) + ")")
+        if offset > len(self.rows): raise exceptions.OutOfRange("Offset " + str(offset) + " is beyond the end of the stream (stream length " + str(len(self.rows)) + ")")
+        for data in serialized_rows:
+            if self.message_class is None:
+                self.rows.append(data)
+            else:
+                msg = self.message_class()
+                msg.ParseFromString(data)
+                self.rows.append(msg)
+        if self.lose_responses > 0:
+            self.lose_responses -= 1
+            raise exceptions.DeadlineExceeded("Fake lost append response")
+
+    def close(self):
+        self.closed = True
+
+
+class BqStorageWriteSink(BqBatchWriter):
+    """
+    BqBatchWriter that writes the batches with the Storage Write API instead of insert_rows_json().
+
+    Each batch is appended to a COMMITTED stream at the next stream offset.  A failed append is retried
+    at the same offset, and ALREADY_EXISTS on a retry means the earlier attempt was written, so every
+    batch is written exactly once.  If the append still fails, the batch's messages are failed and the
+    stream is replaced (its state is unknown).
+
+    schema is the table schema (default from the metadata cache), and stream_factory a callable that
+    returns (descriptor_proto, message_class) -> stream, e.g. lambda d, m: FakeWriteStream(m) to run offline.
+    """
+
+    def __init__(self, project_id=None, dataset_id=None, table_id=None, schema=None, stream_factory=None, max_rows=BQ_BATCH_MAX_ROWS, max_bytes=BQ_BATCH_MAX_BYTES, max_latency_s=BQ_BATCH_MAX_LATENCY_S, verbose=False):
+        self.schema = schema
+        self.stream_factory = stream_factory
+        self.stream = None
+        self.offset = 0
+        self._descriptor_proto = None
+        self._message_class = None
+        super().__init__(project_id=project_id, dataset_id=dataset_id, table_id=table_id, max_rows=max_rows, max_bytes=max_bytes, max_latency_s=max_latency_s, verbose=verbose)
+
+    def _open_stream(self):
+        if self.schema is None:
+            self.schema = gcp_bq_table_schema_cached(project_id=self.project_id, dataset_id=self.dataset_id, table_id=self.table_id)
+            if self.schema is None: raise Exception("Table " + self.project_id + "." + self.dataset_id + "." + self.table_id + " not found")
+        if self._message_class is None:
+            self._descriptor_proto, self._message_class = gcp_bq_schema_to_proto(schema=self.schema)
+        if self.stream_factory is None:
+            self.stream = BqCommittedWriteStream(project_id=self.project_id, dataset_id=self.dataset_id, table_id=self.table_id, descriptor_proto=self._descriptor_proto, verbose=self.verbose)
+        else:
+            self.stream = self.stream_factory(self._descriptor_proto, self._message_class)
+        self.offset = 0
+
+    def _close_stream(self):
+        if self.stream is None: return
+        try:
+            self.stream.close()
+        except Exception as e:
+            print("ERROR: closing write stream " + str(e))
+        self.stream = None
+
+    def _insert(self, rows, row_ids=None):
+        # row_ids are not used, the stream offsets make the appends exactly-once
+        from google.api_core import exceptions
+        from time import sleep
+
+        try:
+            if self.stream is None: self._open_stream()
+            serialized_rows = [gcp_bq_row_to_proto(row=row, schema=self.schema, message_class=self._message_class) for row in rows]
+        except Exception as e:
+            print("ERROR: Storage Write API " + str(e))
+            return [{"index": i, "errors": [str(e)]} for i in range(0, len(rows))]
+
+        error = None
+        for attempt in range(0, STORAGE_WRITE_APPEND_RETRIES + 1):
+            if attempt > 0: sleep(STORAGE_WRITE_RETRY_BACKOFF_S * 2 ** (attempt - 1))
+            try:
+                self.stream.append(serialized_rows, offset=self.offset)
+                self.offset += len(rows)
+                return []
+            except exceptions.AlreadyExists:
+                if attempt == 0:
+                    # Rows this sink did not write are at this offset, so the stream cannot be trusted
+                    error = "offset " + str(self.offset) + " already exists"
+                    break
+                # The previous attempt was written, but its response was lost
+                self.offset += len(rows)
+                return []
+            except Exception as e:
+                error = str(e)
+                print("ERROR: Storage Write API append at offset " + str(self.offset) + " (attempt " + str(attempt+1) + ") " + error)
+
+        # Start over on a new stream.  The rows may or may not have been written, the messages will be delivered again.
+        self._close_stream()
+        return [{"index": i, "errors": [error]} for i in range(0, len(rows))]
+
+    def close(self):
+        """ Stops the flush thread, writes the rows still buffered and finalizes the write stream. """
+        super().close()
+        self._close_stream()
+
+
+# ---------------------------------------------------------------------------
+# Batch load jobs
+#
+# Load jobs are free (streaming inserts are billed) and suit high volume, latency tolerant feeds.
+# The rows are written to local Parquet segments (see ParquetSink in api_sinks.py), and every
+# BQ_LOAD_INTERVAL_S seconds the finished segments are appended to the table with a load job
+# (WRITE_APPEND).  A table is limited to 1,500 load jobs per day, one every 58 s on average.
+# Each segment is loaded with a job id derived from its name, and recorded in a ledger (BqLoadLedger),
+# so a segment is never loaded twice.
+BQ_LOAD_DIR = "bq_load"
+BQ_LOAD_INTERVAL_S = 300.0
+BQ_LOAD_TIMEOUT_S = 600.0
+BQ_LOAD_POLL_S = 5.0            # Interval the state of a load job is polled at when waiting for it timed out
+
+
+def gcp_bq_load_job_id(project_id=None, dataset_id=None, table_id=None, segment=None):
+    """
+    Returns the load job id for segment (a local path or a 'gs://' URI) and the table.
+    BigQuery rejects a second job with the same id, so a segment is not loaded twice by a retry.
+    """
+    from hashlib import blake2b
+
+    if segment is None: raise Exception("Argument segment has not been passed")
+    key = str(project_id) + "." + str(dataset_id) + "." + str(table_id) + "|" + str(segment)
+    return "load_" + blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def gcp_bq_load_parquet(project_id=None, dataset_id=None, table_id=None, source=None, job_id=None, client=None, timeout_s=BQ_LOAD_TIMEOUT_S, verbose=False):
+    """
+    Appends the Parquet file source (a local path, or a 'gs://' URI or list of URIs) to the table
+    project_id.dataset_id.table_id with a load job (WRITE_APPEND), and returns the number of rows loaded.
+    If a job with job_id already exists (the segment was loaded before), the rows of that job are returned.
+
+    The job keeps running when waiting for it times out after timeout_s, so its state is then polled with
+    client.get_job() for up to timeout_s more.  Returns None if the job is still running (load the source
+    again later with the same job_id to get its result), and raises an exception only if the job failed.
+    """
+    from concurrent.futures import TimeoutError
+    from google.cloud import bigquery
+    from google.api_core.exceptions import Conflict
+    from pathlib import Path
+    from time import monotonic, perf_counter, sleep
+
+    if project_id is None: raise Exception("Argument project_id has not been passed")
+    if dataset_id is None: raise Exception("Argument data_set has not been passed")
+    if table_id is None: raise Exception("Argument table_id has not been passed")
+    if source is None: raise Exception("Argument source has not been passed")
+
+    if client is None: client = gcp_bq_client(project_id)
+    table_ref = project_id + "." + dataset_id + "." + table_id
+    job_config = bigquery.LoadJobConfig(source_format=bigquery.SourceFormat.PARQUET, write_disposition=bigquery.WriteDisposition.WRITE_APPEND)
+
+    t_start = perf_counter()
+    try:
+        if isinstance(source, list) or str(source).startswith("gs://"):
+            job = client.load_table_from_uri(source, table_ref, job_id=job_id, job_config=job_config)     # Make an API request.
+        else:
+            with open(Path(source), "rb") as f:
+                job = client.load_table_from_file(f, table_ref, job_id=job_id, job_config=job_config)     # Make an API request.
+    except Conflict:
+        # The job (and the segment) already exists
+        job = client.get_job(job_id)
+    try:
+        job.result(timeout=timeout_s)     # Waits for the job to complete.  Raises an exception if the job failed.
+    except TimeoutError:
+        t_end = monotonic() + timeout_s
+        while True:
+            job = client.get_job(job.job_id)      # Make an API request.
+            if job.state == "DONE": break
+            if monotonic() >= t_end:
+                print("WARNING: load job " + str(job.job_id) + " still running after " + str(round(perf_counter() - t_start)) + " sec")
+                return None
+            sleep(BQ_LOAD_POLL_S)
+        if not job.error_result is None: raise Exception("Load job " + str(job.job_id) + " failed " + str(job.error_result))
+    if verbose: print("Load job " + str(job.job_id) + " appended " + str(job.output_rows) + " rows to " + table_ref + " in " + str(round(perf_counter() - t_start, 3)) + " sec")
+    return job.output_rows or 0
+
+
+class BqLoadLedger:
+    """
+    Ledger of the segments (local paths or 'gs://' URIs) loaded to BigQuery, kept in the JSON lines file path.
+    Each line is {"segment": <segment>, "job_id": <load job id>, "rows": <rows loaded>, "unix": <time loaded>}.
+    """
+
+    def __init__(self, path=None):
+        import json
+        from pathlib import Path
+
+        if path is None: raise Exception("Argument path has not been passed")
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._loaded = {}
+        if self.path.exists():
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    if line.strip() == "": continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line partly written when the process stopped
+                        continue
+                    self._loaded[entry["segment"]] = entry
+
+    @staticmethod
+    def key(segment):
+        # A local segment is identified by its file name, so the ledger still applies if the directory is moved
+        from pathlib import Path
+        return str(segment) if str(segment).startswith("gs://") else Path(segment).name
+
+    def loaded(self, segment=None):
+        """ Returns True if segment has been loaded. """
+        with self._lock:
+            return self.key(segment) in self._loaded
+
+    def add(self, segment=None, job_id=None, rows=0):
+        """ Records that segment was loaded by the load job job_id. """
+        import json
+        from time import time
+
+        entry = {"segment": self.key(segment), "job_id": job_id, "rows": rows, "unix": time()}
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+            self._loaded[entry["segment"]] = entry
+
+
+def gcp_bq_load_segments(project_id=None, dataset_id=None, table_id=None, segments=None, ledger=None, delete_loaded=False, client=None, verbose=True):
+    """
+    Loads each of segments (local Parquet files or 'gs://' URIs) that is not in ledger (a BqLoadLedger)
+    to the table with its own load job, and records it in ledger.  A local segment is deleted once
+    loaded if delete_loaded.  A segment whose load job is still running is skipped (it is not recorded,
+    so it is loaded again with the same job id).  Returns (segments loaded, rows loaded).
+    e.g. the Parquet files of a ParquetSink:
+        gcp_bq_load_segments(project_id, dataset_id, table_id, segments=sink.segments(), ledger=BqLoadLedger(sink.path / "_loaded.jsonl"))
+    """
+    from pathlib import Path
+
+    if segments is None: raise Exception("Argument segments has not been passed")
+    if ledger is None: raise Exception("Argument ledger has not been passed")
+
+    n_segments = 0
+    n_rows = 0
+    for segment in segments:
+        if ledger.loaded(segment): continue
+        job_id = gcp_bq_load_job_id(project_id=project_id, dataset_id=dataset_id, table_id=table_id, segment=BqLoadLedger.key(segment))
+        rows = gcp_bq_load_parquet(project_id=project_id, dataset_id=dataset_id, table_id=table_id, source=segment, job_id=job_id, client=client, verbose=verbose)
+        if rows is None: continue
+        ledger.add(segment=segment, job_id=job_id, rows=rows)
+        if delete_loaded and not str(segment).startswith("gs://"): Path(segment).unlink(missing_ok=True)
+        n_segments += 1
+        n_rows += rows
+    return n_segments, n_rows
+
+
+class BqLoadJobSink(ParquetSink):
+    """
+    Writes the rows to local Parquet segments in path (see ParquetSink in api_sinks.py) and loads the
+    segments to the BigQuery table project_id.dataset_id.table_id with load jobs every load_interval_s
+    seconds, and by flush() and close().  The loaded segments are recorded in the ledger
+    <path>/_loaded.jsonl, and deleted if delete_loaded.
+
+    The callbacks of add() are held until the segment with the rows has been loaded, so a message is
+    acked once its rows are in the table.  on_failure() is called for the rows of a segment that could
+    not be loaded (the segment is renamed '.parquet.failed' and not loaded again).  The callbacks of a
+    segment whose load job is still running are held until a later load() gets its result.  A segment
+    still not loaded at close() stays in path, and is loaded (with the same job id) by the next BqLoadJobSink.
+    The messages are held for up to load_interval_s, so the subscriber flow control must allow the
+    messages of a whole interval to be outstanding in stream and service mode.  In drain mode write()
+    is called per pull, and loads the segments only once the current one is load_interval_s old (or was
+    rolled by size), so a drain makes one load job per interval and a last one at flush().
+    """
+
+    bigquery = True
+
+    def __init__(self, project_id=None, dataset_id=None, table_id=None, path=BQ_LOAD_DIR, load_interval_s=BQ_LOAD_INTERVAL_S, delete_loaded=True, client=None, max_rows=BQ_BATCH_MAX_ROWS, max_bytes=BQ_BATCH_MAX_BYTES, max_latency_s=BQ_BATCH_MAX_LATENCY_S, verbose=False):
+        from pathlib import Path
+
+        if project_id is None: raise Exception("Argument project_id has not been passed")
+        if dataset_id is None: raise Exception("Argument data_set has not been passed")
+        if table_id is None: raise Exception("Argument table_id has not been passed")
+
+        self.project_id = project_id
+        self.dataset_id = dataset_id
+        self.table_id = table_id
+        self.load_interval_s = load_interval_s
+        self.delete_loaded = delete_loaded
+        self.client = client
+        self._load_lock = threading.Lock()
+        self._finished = []         # [(segment, callbacks)] not yet loaded
+        Path(path).mkdir(parents=True, exist_ok=True)
+        self.ledger = BqLoadLedger(Path(path) / "_loaded.jsonl")
+        super().__init__(path=path, prefix=table_id, max_rows=max_rows, max_bytes=max_bytes, max_latency_s=max_latency_s, verbose=verbose)
+        self.stats.update({"load_jobs": 0, "loaded_rows": 0, "load_failures": 0})
+
+        # The finished segments of a previous process that are not in the ledger (e.g. its load job was still
+        # running at close()) are loaded again with the same job id, before any new rows:  the rows of a job
+        # that completed are then in the table when the redelivered messages are checked for duplicates.
+        with self._flush_lock:
+            self._finished += [(segment, []) for segment in self.segments() if not self.ledger.loaded(segment)]
+        if len(self._finished) > 0:
+            print("Loading " + str(len(self._finished)) + " segments left in " + str(path) + " by a previous process")
+            self.load()
+
+        self._loader = threading.Thread(target=self._run_loader, name="BqLoadJobSink", daemon=True)
+        self._loader.start()
+
+    def _segment_done(self, segment, callbacks):
+        # The callbacks of the rows of a finished segment are held until it is loaded
+        self._finished.append((segment, callbacks))
+
+    def _run_loader(self):
+        while not self._stop.wait(self.load_interval_s):
+            self.load()
+
+    def load(self, min_age_s=0.0):
+        """
+        Finishes the current segment (if it is at least min_age_s seconds old) and loads every finished
+        segment to the table, then calls the callbacks of their rows.  Returns the number of rows loaded.
+        """
+        import os
+        from time import monotonic
+
+        with self._load_lock:
+            with self._flush_lock:
+                if not self._writer is None and monotonic() - self._segment_t_start >= min_age_s: self._roll()
+                finished = self._finished
+                self._finished = []
+
+            loaded = 0
+            running = []
+            for segment, callbacks in finished:
+                try:
+                    n_segments, rows = gcp_bq_load_segments(project_id=self.project_id, dataset_id=self.dataset_id, table_id=self.table_id, segments=[segment], ledger=self.ledger, delete_loaded=self.delete_loaded, client=self.client, verbose=self.verbose)
+                except Exception as e:
+                    print("ERROR: load job for " + segment.name + " " + str(e))
+                    with self._lock:
+                        self.stats["load_failures"] += 1
+                    # The messages are delivered again, so the segment must not be loaded later
+                    try:
+                        os.replace(segment, str(segment) + ".failed")
+                    except OSError:
+                        pass
+                    self._call_callbacks([(on_success, on_failure, [str(e)]) for on_success, on_failure, errors in callbacks])
+                    continue
+                if n_segments == 0 and not self.ledger.loaded(segment):
+                    # The load job is still running, its result is fetched by the next load()
+                    running.append((segment, callbacks))
+                    continue
+                with self._lock:
+                    self.stats["load_jobs"] += n_segments
+                    self.stats["loaded_rows"] += rows
+                loaded += rows
+                self._call_callbacks(callbacks)
+            if len(running) > 0:
+                with self._flush_lock:
+                    self._finished = running + self._finished
+            return loaded
+
+    def flush(self):
+        """
+        Writes every buffered row to the current segment, then loads the segments to the table and calls the callbacks.
+        Returns the number of rows written.
+        """
+        written = self._flush()
+        self.load()
+        return written
+
+    def write(self):
+        """
+        Writes every buffered row to the current segment.  The segments are only loaded (and the callbacks
+        called) once the current segment is load_interval_s old, or segments were rolled by size.
+        Returns the number of rows written.
+        """
+        written = self._flush()
+        self.load(min_age_s=self.load_interval_s)
+        return written
+
+    def close(self):
+        """ Stops the flush and load threads, writes the rows still buffered and loads the last segments. """
+        super().close()
+        self._loader.join()
+        self.load()
+
 
 if __name__ == '__main__':
 
@@ -13,6 +13,10 @@ __version__ = "0.0.0"
 from pathlib import Path
 print("'" + Path(__file__).stem + ".py'  v" + __version__)
 
+import threading
+import weakref
+from datetime import datetime, timezone, timedelta
+
 
 # Make sure Windows environment variable CLOUDSDK_PYTHON is set
 #import os
@@ -326,15 +330,634 @@ def gcp_pubsub_create_pull_subscription(project_id=None, topic_id=None, subscrip
         return False
 
 
+# ---------------------------------------------------------------------------
+# Process-wide publisher pool
+
+# One PublisherClient (and therefore one gRPC channel) is kept per (project_id, topic_id).
+# The topic is verified once when the client is created, so each later publish costs one RPC.
+_publisher_pool = {}
+_publisher_pool_lock = threading.Lock()
+
+# Default publisher flow control (see gcp_pubsub_flow_control()), used by gcp_pubsub_get_publisher()
+# when no flow_control is passed.  The client library default is to ignore the limits, so the futures
+# and buffers grow without bound when publishing faster than the network can drain them.
+PUBLISH_MAX_OUTSTANDING_MESSAGES = 10000
+PUBLISH_MAX_OUTSTANDING_BYTES = 100000000       # 100 MB
+PUBLISH_LIMIT_EXCEEDED_BEHAVIOR = "BLOCK"       # "BLOCK", "ERROR" or "IGNORE"
+
+# In-flight gauges for every message published through gcp_pubsub_publish()
+_publish_gauges = {"in_flight_messages": 0, "in_flight_bytes": 0, "max_in_flight_messages": 0, "max_in_flight_bytes": 0, "published": 0, "failed": 0}
+_publish_gauges_lock = threading.Lock()
+
+
+def gcp_pubsub_flow_control(max_messages=PUBLISH_MAX_OUTSTANDING_MESSAGES, max_bytes=PUBLISH_MAX_OUTSTANDING_BYTES, limit_exceeded_behavior=PUBLISH_LIMIT_EXCEEDED_BEHAVIOR):
+    """
+    Returns a pubsub_v1.types.PublishFlowControl limiting the messages and bytes a publisher holds
+    that have not yet been acknowledged by the Pub/Sub service.
+
+    limit_exceeded_behavior:
+        "BLOCK"     .publish() blocks until enough outstanding messages have been sent (bounded memory, slows the producer).
+        "ERROR"     .publish() raises pubsub_v1.publisher.exceptions.FlowControlLimitError.
+        "IGNORE"    no limit (client library default).
+    """
+
+    # pip install --upgrade google-cloud-pubsub
+    from google.cloud import pubsub_v1
+
+    behaviors = {
+        "BLOCK": pubsub_v1.types.LimitExceededBehavior.BLOCK,
+        "ERROR": pubsub_v1.types.LimitExceededBehavior.ERROR,
+        "IGNORE": pubsub_v1.types.LimitExceededBehavior.IGNORE,
+    }
+    if not limit_exceeded_behavior.upper() in behaviors: raise Exception("Argument limit_exceeded_behavior must be one of " + str(list(behaviors.keys())) + ", not '" + str(limit_exceeded_behavior) + "'")
+
+    return pubsub_v1.types.PublishFlowControl(
+        message_limit=max_messages,
+        byte_limit=max_bytes,
+        limit_exceeded_behavior=behaviors[limit_exceeded_behavior.upper()],
+    )
+
+
+def gcp_pubsub_get_publisher(project_id=None, topic_id=None, batch_settings=None, flow_control=None, publisher_factory=None, timeout_s=15, verbose=False):
+    """
+    Returns (publisher, topic_path) for project_id and topic_id from the process-wide publisher pool.
+
+    The first call for a (project_id, topic_id) creates the PublisherClient and confirms the topic
+    exists with a single get_topic() request.  Later calls return the same client without any RPC.
+
+    batch_settings is an optional pubsub_v1.types.BatchSettings and flow_control an optional
+    pubsub_v1.types.PublishFlowControl (see gcp_pubsub_flow_control()).  Without flow_control the
+    publisher is bounded by PUBLISH_MAX_OUTSTANDING_MESSAGES, PUBLISH_MAX_OUTSTANDING_BYTES and
+    PUBLISH_LIMIT_EXCEEDED_BEHAVIOR (pass gcp_pubsub_flow_control(limit_exceeded_behavior="IGNORE") for no limit).
+    Publishers with different batch settings or flow control for the same topic are pooled separately.
+
+    publisher_factory is a callable that returns a PublisherClient-like object (default pubsub_v1.PublisherClient).
+    """
+
+    if project_id is None: raise Exception("Argument project_id not passed to the function.")
+    if topic_id is None: raise Exception("Argument topic_id not passed to the function.")
+
+    if flow_control is None: flow_control = gcp_pubsub_flow_control(max_messages=PUBLISH_MAX_OUTSTANDING_MESSAGES, max_bytes=PUBLISH_MAX_OUTSTANDING_BYTES, limit_exceeded_behavior=PUBLISH_LIMIT_EXCEEDED_BEHAVIOR)
+    key = (project_id, topic_id, batch_settings, flow_control)
+    with _publisher_pool_lock:
+        if key in _publisher_pool: return _publisher_pool[key]
+
+    from google.api_core.exceptions import NotFound
+
+    if publisher_factory is None:
+        # pip install --upgrade google-cloud-pubsub
+        from google.cloud import pubsub_v1
+        publisher_factory = pubsub_v1.PublisherClient
+
+    kwargs = {}
+    if not batch_settings is None: kwargs["batch_settings"] = batch_settings
+    if not flow_control is None:
+        from google.cloud import pubsub_v1
+        kwargs["publisher_options"] = pubsub_v1.types.PublisherOptions(flow_control=flow_control)
+    publisher = publisher_factory(**kwargs)
+
+    # The `topic_path` method creates a fully qualified identifier
+    # in the form `projects/{project_id}/topics/{topic_id}`
+    topic_path = publisher.topic_path(project_id, topic_id)
+
+    # Make sure the topic exists (one request instead of listing every topic in the project).
+    # The request is made without holding the pool lock, so it doesn't block the other publishers.
+    # Other errors (e.g. permission denied, service unavailable) are raised as they are.
+    try:
+        publisher.get_topic(request={"topic": topic_path}, timeout=timeout_s)
+    except NotFound as e:
+        if verbose: print("ERROR: .get_topic() " + str(e))
+        raise Exception("Topic '" + topic_id + "' for project '" + project_id + "' does not exist!")
+
+    with _publisher_pool_lock:
+        if key in _publisher_pool:
+            # Another thread created a publisher for the same key in the meantime
+            publisher.stop()
+            return _publisher_pool[key]
+        if verbose: print("Publisher created for " + topic_path)
+        _publisher_pool[key] = (publisher, topic_path)
+        return _publisher_pool[key]
+
+
+def gcp_pubsub_close_publishers(verbose=False):
+    """
+    Flushes any pending messages and closes every publisher in the process-wide pool.
+    Call at shutdown.
+    """
+
+    with _publisher_pool_lock:
+        for key, (publisher, topic_path) in _publisher_pool.items():
+            try:
+                publisher.stop()
+                if verbose: print("Publisher closed for " + topic_path)
+            except Exception as e:
+                print("ERROR: publisher.stop() " + str(e))
+        _publisher_pool.clear()
+
+
+def gcp_pubsub_publish(publisher=None, topic_path=None, data=None, **attributes):
+    """
+    Publishes data with publisher.publish() and returns the future, keeping the in-flight gauges
+    (see gcp_pubsub_publisher_gauges()) up to date until the future completes.
+    """
+
+    n_bytes = len(data)
+    with _publish_gauges_lock:
+        _publish_gauges["in_flight_messages"] += 1
+        _publish_gauges["in_flight_bytes"] += n_bytes
+        _publish_gauges["max_in_flight_messages"] = max(_publish_gauges["max_in_flight_messages"], _publish_gauges["in_flight_messages"])
+        _publish_gauges["max_in_flight_bytes"] = max(_publish_gauges["max_in_flight_bytes"], _publish_gauges["in_flight_bytes"])
+
+    def done(future):
+        failed = not future.exception() is None
+        with _publish_gauges_lock:
+            _publish_gauges["in_flight_messages"] -= 1
+            _publish_gauges["in_flight_bytes"] -= n_bytes
+            if failed: _publish_gauges["failed"] += 1
+            else: _publish_gauges["published"] += 1
+
+    try:
+        future = publisher.publish(topic=topic_path, data=data, **attributes)
+    except Exception:
+        # e.g. FlowControlLimitError or MessageTooLargeError.  The message never left.
+        with _publish_gauges_lock:
+            _publish_gauges["in_flight_messages"] -= 1
+            _publish_gauges["in_flight_bytes"] -= n_bytes
+            _publish_gauges["failed"] += 1
+        raise
+
+    future.add_done_callback(done)
+    return future
+
+
+def gcp_pubsub_publisher_gauges(reset_max=False):
+    """
+    Returns a copy of the process-wide publisher gauges:
+
+        in_flight_messages      messages published that the Pub/Sub service has not yet acknowledged
+        in_flight_bytes         bytes in those messages
+        max_in_flight_messages  high water mark of in_flight_messages
+        max_in_flight_bytes     high water mark of in_flight_bytes
+        published               messages acknowledged by the Pub/Sub service
+        failed                  messages that failed to publish
+
+    reset_max=True resets the high water marks to the current in-flight values after reading them.
+    """
+
+    with _publish_gauges_lock:
+        gauges = dict(_publish_gauges)
+        if reset_max:
+            _publish_gauges["max_in_flight_messages"] = _publish_gauges["in_flight_messages"]
+            _publish_gauges["max_in_flight_bytes"] = _publish_gauges["in_flight_bytes"]
+    return gauges
+
+
+# Default batching for publish_many().  The client library default is 100 messages / 1 MB / 10 ms.
+PUBLISH_MANY_MAX_MESSAGES = 1000
+PUBLISH_MANY_MAX_BYTES = 1000000        # 1 MB
+PUBLISH_MANY_MAX_LATENCY_S = 0.05
+
+
+def publish_many(packets=None, project_id=None, topic_id=None, attributes=None, content_encoding=None, compress_min_bytes=None, batch_settings=None, flow_control=None, timeout_s=60.0, publisher_factory=None, verbose=False):
+    """
+    Publishes every data packet in the list packets to topic_id and returns (message_ids, failures).
+
+        message_ids     list the same length as packets with the Pub/Sub message ID, or None if the publish failed.
+        failures        list of (index, exception) for each packet that was not published.
+
+    All packets are handed to the publisher at once so the client library can batch them according
+    to batch_settings (pubsub_v1.types.BatchSettings: max_messages, max_bytes, max_latency), and the
+    futures are only gathered at the end.  timeout_s is the total time allowed to gather the futures.
+
+    attributes is an optional dictionary of message attributes (string values) sent with every message,
+    for example {"attrs": <custom metadata JSON>, PACKET_TYPE_ATTRIBUTE: "F32"}.
+
+    content_encoding ('zlib' or 'lzma') compresses each packet of at least compress_min_bytes
+    and sets the message attribute CONTENT_ENCODING_ATTRIBUTE (see compress_data_packet()).
+
+    flow_control (see gcp_pubsub_flow_control()) bounds the messages and bytes held by the publisher.
+    With "BLOCK" a large list of packets is handed over as fast as the network drains it.
+    """
+
+    if packets is None: raise Exception("Argument packets not passed to the function.")
+
+    from time import perf_counter
+
+    if batch_settings is None:
+        # pip install --upgrade google-cloud-pubsub
+        from google.cloud import pubsub_v1
+        batch_settings = pubsub_v1.types.BatchSettings(
+            max_messages=PUBLISH_MANY_MAX_MESSAGES,
+            max_bytes=PUBLISH_MANY_MAX_BYTES,
+            max_latency=PUBLISH_MANY_MAX_LATENCY_S,
+        )
+
+    publisher, topic_path = gcp_pubsub_get_publisher(project_id=project_id, topic_id=topic_id, batch_settings=batch_settings, flow_control=flow_control, publisher_factory=publisher_factory)
+
+    t_start = perf_counter()
+    message_ids = [None] * len(packets)
+    failures = []
+
+    # Hand every packet to the publisher without waiting for the result
+    if attributes is None: attributes = {}
+    if compress_min_bytes is None: compress_min_bytes = COMPRESS_MIN_BYTES
+    futures = []
+    for i in range(0, len(packets)):
+        try:
+            data, encoding = compress_data_packet(packets[i], content_encoding=content_encoding, min_bytes=compress_min_bytes)
+            if encoding is None:
+                futures.append((i, gcp_pubsub_publish(publisher, topic_path, data, **attributes)))
+            else:
+                futures.append((i, gcp_pubsub_publish(publisher, topic_path, data, **dict(attributes, **{CONTENT_ENCODING_ATTRIBUTE: encoding}))))
+        except Exception as e:
+            # e.g. pubsub_v1.publisher.exceptions.MessageTooLargeError or FlowControlLimitError
+            failures.append((i, e))
+
+    # Gather the futures
+    for i, future in futures:
+        try:
+            message_ids[i] = future.result(timeout=max(0.0, timeout_s - (perf_counter() - t_start)))
+        except Exception as e:
+            failures.append((i, e))
+    failures.sort(key=lambda f: f[0])
+
+    if verbose:
+        t_elapsed = perf_counter() - t_start
+        print("Published " + str(len(packets)-len(failures)) + " of " + str(len(packets)) + " messages to " + topic_path + " in " + str(round(t_elapsed,3)) + " sec")
+        for i, e in failures:
+            print("\tERROR: packet " + str(i) + " " + str(e))
+
+    return message_ids, failures
+
+
+# ---------------------------------------------------------------------------
+# Asyncio publisher
+
+# The Pub/Sub futures are completed by the client library's own background threads.  Each one is
+# bridged to an asyncio future with a done callback and loop.call_soon_threadsafe(), so awaiting
+# thousands of publishes needs no thread per message and they all share one event loop.
+#
+# With flow control "BLOCK" (the default of gcp_pubsub_get_publisher()) .publish() would block the event loop
+# when the limits are reached.  So without flow_control the asyncio functions use a publisher with the same
+# limits and "ERROR", every publish first awaits an asyncio.Semaphore of PUBLISH_MAX_OUTSTANDING_MESSAGES
+# (per event loop), and a publish over the byte limit is retried after PUBLISH_ASYNC_RETRY_S instead.
+# A flow_control passed to them should not use "BLOCK".
+PUBLISH_ASYNC_RETRY_S = 0.01
+
+# One semaphore per event loop (removed when the loop is garbage collected)
+_publish_async_semaphores = weakref.WeakKeyDictionary()
+_publish_async_semaphores_lock = threading.Lock()
+
+
+def gcp_pubsub_async_flow_control():
+    """
+    Returns the default publisher flow control of the asyncio functions:  the limits of gcp_pubsub_get_publisher()
+    with "ERROR" instead of blocking.
+    """
+    return gcp_pubsub_flow_control(max_messages=PUBLISH_MAX_OUTSTANDING_MESSAGES, max_bytes=PUBLISH_MAX_OUTSTANDING_BYTES, limit_exceeded_behavior="ERROR")
+
+
+async def gcp_pubsub_publish_await(publisher=None, topic_path=None, data=None, **attributes):
+    """
+    Publishes data with gcp_pubsub_publish() without blocking the event loop, and returns an asyncio future
+    for the message ID.  Waits (awaits) while PUBLISH_MAX_OUTSTANDING_MESSAGES publishes of the event loop
+    are outstanding, or while the publisher raises FlowControlLimitError.
+    """
+    import asyncio
+    # pip install --upgrade google-cloud-pubsub
+    from google.cloud.pubsub_v1.publisher.exceptions import FlowControlLimitError
+
+    loop = asyncio.get_running_loop()
+    with _publish_async_semaphores_lock:
+        if not loop in _publish_async_semaphores: _publish_async_semaphores[loop] = asyncio.Semaphore(PUBLISH_MAX_OUTSTANDING_MESSAGES)
+        semaphore = _publish_async_semaphores[loop]
+
+    await semaphore.acquire()
+    try:
+        while True:
+            try:
+                future = gcp_pubsub_publish(publisher, topic_path, data, **attributes)
+                break
+            except FlowControlLimitError:
+                await asyncio.sleep(PUBLISH_ASYNC_RETRY_S)
+    except BaseException:
+        semaphore.release()
+        raise
+
+    aio_future = gcp_pubsub_wrap_future(future, loop)
+    aio_future.add_done_callback(lambda f: semaphore.release())
+    return aio_future
+
+
+def gcp_pubsub_wrap_future(future, loop=None):
+    """
+    Returns an asyncio future for the Pub/Sub (concurrent.futures style) future.
+    """
+
+    import asyncio
+
+    if loop is None: loop = asyncio.get_running_loop()
+    aio_future = loop.create_future()
+
+    def set_result(f):
+        if aio_future.cancelled(): return
+        e = f.exception()
+        if e is None:
+            aio_future.set_result(f.result())
+        else:
+            aio_future.set_exception(e)
+
+    def done(f):
+        # The event loop may have been closed while the message was being published
+        if loop.is_closed(): return
+        loop.call_soon_threadsafe(set_result, f)
+
+    future.add_done_callback(done)
+    return aio_future
+
+
+async def publish_async(data=None, project_id=None, topic_id=None, attributes=None, content_encoding=None, compress_min_bytes=None, batch_settings=None, flow_control=None, publisher_factory=None):
+    """
+    Publishes the data packet data to topic_id and returns the Pub/Sub message ID.
+    Raises the publish exception if the message could not be published.
+
+    The arguments are the same as for publish_many().
+    """
+
+    if data is None: raise Exception("Argument data not passed to the function.")
+
+    if flow_control is None: flow_control = gcp_pubsub_async_flow_control()
+    publisher, topic_path = gcp_pubsub_get_publisher(project_id=project_id, topic_id=topic_id, batch_settings=batch_settings, flow_control=flow_control, publisher_factory=publisher_factory)
+
+    if attributes is None: attributes = {}
+    if compress_min_bytes is None: compress_min_bytes = COMPRESS_MIN_BYTES
+    data, encoding = compress_data_packet(data, content_encoding=content_encoding, min_bytes=compress_min_bytes)
+    if not encoding is None: attributes = {**attributes, CONTENT_ENCODING_ATTRIBUTE: encoding}
+
+    return await (await gcp_pubsub_publish_await(publisher, topic_path, data, **attributes))
+
+
+async def publish_many_async(packets=None, project_id=None, topic_id=None, attributes=None, content_encoding=None, compress_min_bytes=None, batch_settings=None, flow_control=None, timeout_s=60.0, publisher_factory=None, verbose=False):
+    """
+    Asyncio version of publish_many().  Returns (message_ids, failures).
+
+    The packets are handed to the publisher without waiting for their results (see gcp_pubsub_publish_await(),
+    the hand off awaits while the flow control limits are reached) and the futures are awaited together with
+    asyncio.wait(), so the event loop is free while the client library batches and sends them.
+    timeout_s is the total time allowed to wait for the futures.
+    """
+
+    if packets is None: raise Exception("Argument packets not passed to the function.")
+
+    import asyncio
+    from time import perf_counter
+
+    if batch_settings is None:
+        # pip install --upgrade google-cloud-pubsub
+        from google.cloud import pubsub_v1
+        batch_settings = pubsub_v1.types.BatchSettings(
+            max_messages=PUBLISH_MANY_MAX_MESSAGES,
+            max_bytes=PUBLISH_MANY_MAX_BYTES,
+            max_latency=PUBLISH_MANY_MAX_LATENCY_S,
+        )
+
+    if flow_control is None: flow_control = gcp_pubsub_async_flow_control()
+    publisher, topic_path = gcp_pubsub_get_publisher(project_id=project_id, topic_id=topic_id, batch_settings=batch_settings, flow_control=flow_control, publisher_factory=publisher_factory)
+
+    t_start = perf_counter()
+    message_ids = [None] * len(packets)
+    failures = []
+
+    # Hand every packet to the publisher without waiting for the result
+    if attributes is None: attributes = {}
+    if compress_min_bytes is None: compress_min_bytes = COMPRESS_MIN_BYTES
+    futures = {}
+    for i in range(0, len(packets)):
+        try:
+            data, encoding = compress_data_packet(packets[i], content_encoding=content_encoding, min_bytes=compress_min_bytes)
+            if encoding is None:
+                aio_future = await gcp_pubsub_publish_await(publisher, topic_path, data, **attributes)
+            else:
+                aio_future = await gcp_pubsub_publish_await(publisher, topic_path, data, **dict(attributes, **{CONTENT_ENCODING_ATTRIBUTE: encoding}))
+            futures[aio_future] = i
+        except Exception as e:
+            # e.g. pubsub_v1.publisher.exceptions.MessageTooLargeError
+            failures.append((i, e))
+
+    # Await the futures
+    if len(futures) > 0:
+        done, pending = await asyncio.wait(futures.keys(), timeout=timeout_s)
+        for aio_future in done:
+            if aio_future.exception() is None:
+                message_ids[futures[aio_future]] = aio_future.result()
+            else:
+                failures.append((futures[aio_future], aio_future.exception()))
+        for aio_future in pending:
+            aio_future.cancel()
+            failures.append((futures[aio_future], asyncio.TimeoutError("Publish not completed within " + str(timeout_s) + " sec")))
+    failures.sort(key=lambda f: f[0])
+
+    if verbose:
+        t_elapsed = perf_counter() - t_start
+        print("Published " + str(len(packets)-len(failures)) + " of " + str(len(packets)) + " messages to " + topic_path + " in " + str(round(t_elapsed,3)) + " sec")
+        for i, e in failures:
+            print("\tERROR: packet " + str(i) + " " + str(e))
+
+    return message_ids, failures
+
+
+# ---------------------------------------------------------------------------
+# Subscriber concurrency
+#
+# A streaming pull holds at most SUBSCRIBE_MAX_OUTSTANDING_MESSAGES / SUBSCRIBE_MAX_OUTSTANDING_BYTES
+# messages that have not been acked or nacked, and runs the callbacks on a pool of
+# SUBSCRIBE_EXECUTOR_THREADS threads.  The client library defaults are 1000 messages / 100 MiB / 10 threads.
+# The callbacks mostly wait on I/O, so more threads than cores help.  CPU-heavy decoding is limited
+# by the GIL, so it can be moved to SUBSCRIBE_DECODE_PROCESSES worker processes (0 decodes in the callback thread).
+
+SUBSCRIBE_MAX_OUTSTANDING_MESSAGES = 1000
+SUBSCRIBE_MAX_OUTSTANDING_BYTES = 100000000     # 100 MB
+SUBSCRIBE_EXECUTOR_THREADS = 10
+SUBSCRIBE_DECODE_PROCESSES = 0
+
+
+def gcp_pubsub_subscriber_flow_control(max_messages=SUBSCRIBE_MAX_OUTSTANDING_MESSAGES, max_bytes=SUBSCRIBE_MAX_OUTSTANDING_BYTES):
+    """
+    Returns a pubsub_v1.types.FlowControl limiting the messages and bytes a streaming pull
+    holds that have not yet been acked or nacked.
+    """
+
+    # pip install --upgrade google-cloud-pubsub
+    from google.cloud import pubsub_v1
+
+    if max_messages < 1: raise Exception("Argument max_messages must be at least 1, not " + str(max_messages))
+    if max_bytes < 1: raise Exception("Argument max_bytes must be at least 1, not " + str(max_bytes))
+
+    return pubsub_v1.types.FlowControl(max_messages=max_messages, max_bytes=max_bytes)
+
+
+def gcp_pubsub_subscriber_scheduler(executor_threads=SUBSCRIBE_EXECUTOR_THREADS):
+    """
+    Returns a pubsub_v1.subscriber.scheduler.ThreadScheduler that runs the subscriber callbacks
+    on a pool of executor_threads threads.
+
+    The scheduler is shut down with its streaming pull, so a new one is needed for each subscribe().
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+    from google.cloud import pubsub_v1
+
+    if executor_threads < 1: raise Exception("Argument executor_threads must be at least 1, not " + str(executor_threads))
+
+    executor = ThreadPoolExecutor(max_workers=executor_threads, thread_name_prefix="ThreadPoolExecutor-SubscriberCallback")
+    return pubsub_v1.subscriber.scheduler.ThreadScheduler(executor=executor)
+
+
+def gcp_pubsub_decode_pool(processes=SUBSCRIBE_DECODE_PROCESSES):
+    """
+    Returns a concurrent.futures.ProcessPoolExecutor with processes workers for decoding messages,
+    or None if processes is 0.  Call .shutdown() on it when done.
+
+    The workers are started with "spawn":  they are created on the first submit(), from a subscriber
+    callback while the gRPC streaming pull and the sink threads are running, and forking a process
+    with gRPC threads running is not supported (it can deadlock).
+    """
+
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+
+    if processes < 0: raise Exception("Argument processes must be 0 or more, not " + str(processes))
+    if processes == 0: return None
+
+    return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+
+
+# ---------------------------------------------------------------------------
+# Subscriber ack manager
+
+class PubSubAckManager:
+    """
+    Acks (and nacks) subscriber messages without blocking the calling thread.
+
+    ack() sends the ack with message.ack_with_response() and returns at once.  The ack future is
+    resolved by a done callback that records the ack latency and counts the failures by error code.
+    With exactly-once delivery enabled on the subscription, a successful ack future guarantees
+    the message is not delivered again.
+
+    wait() blocks until every ack sent has completed (e.g. before the subscriber is closed).
+    """
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self._lock = threading.Condition()
+        self.pending = 0
+        self.stats = {"acks": 0, "ack_failures": 0, "nacks": 0, "ack_latency_s_total": 0.0, "ack_latency_s_max": 0.0, "ack_errors": {}}
+
+    def _send(self, message, ack):
+        from time import monotonic
+
+        t_start = monotonic()
+        with self._lock:
+            self.pending += 1
+
+        def done(future):
+            t_latency = monotonic() - t_start
+            error = None
+            try:
+                future.result()
+            except Exception as e:
+                # pubsub_v1.subscriber.exceptions.AcknowledgeError (e.error_code), or another exception
+                error = str(getattr(e, "error_code", type(e).__name__))
+            with self._lock:
+                self.pending -= 1
+                if not ack:
+                    self.stats["nacks"] += 1
+                elif error is None:
+                    self.stats["acks"] += 1
+                    self.stats["ack_latency_s_total"] += t_latency
+                    self.stats["ack_latency_s_max"] = max(self.stats["ack_latency_s_max"], t_latency)
+                else:
+                    self.stats["ack_failures"] += 1
+                    self.stats["ack_errors"][error] = self.stats["ack_errors"].get(error, 0) + 1
+                self._lock.notify_all()
+            if self.verbose:
+                if not ack: print("Nack for message # " + str(message.message_id) + " sent in " + str(round(t_latency,3)) + " sec")
+                elif error is None: print("Ack for message # " + str(message.message_id) + " successful in " + str(round(t_latency,3)) + " sec")
+                else: print("Ack for message # " + str(message.message_id) + " failed with error " + error)
+
+        try:
+            future = message.ack_with_response() if ack else message.nack_with_response()
+        except Exception as e:
+            done(_FailedFuture(e))
+            return
+        future.add_done_callback(done)
+
+    def ack(self, message=None):
+        """ Acks message.  Returns without waiting for the ack to complete. """
+        if message is None: raise Exception("Argument message not passed to the function.")
+        self._send(message, True)
+
+    def nack(self, message=None):
+        """ Nacks message so that it is delivered again.  Returns without waiting. """
+        if message is None: raise Exception("Argument message not passed to the function.")
+        self._send(message, False)
+
+    def wait(self, timeout_s=30.0):
+        """ Waits up to timeout_s for every ack and nack sent to complete.  Returns True if none are pending. """
+        with self._lock:
+            return self._lock.wait_for(lambda: self.pending == 0, timeout=timeout_s)
+
+    def summary(self):
+        """ Returns a one line summary of the stats. """
+        with self._lock:
+            stats = dict(self.stats)
+        avg_ms = 1000.0 * stats["ack_latency_s_total"] / stats["acks"] if stats["acks"] > 0 else 0.0
+        return str(stats["acks"]) + " acks (avg " + str(round(avg_ms,1)) + " ms, max " + str(round(1000.0*stats["ack_latency_s_max"],1)) + " ms), " + str(stats["ack_failures"]) + " ack failures " + str(stats["ack_errors"]) + ", " + str(stats["nacks"]) + " nacks"
+
+
+class _FailedFuture:
+    # Future already completed with exception e
+    def __init__(self, e):
+        self._e = e
+
+    def result(self, timeout=None):
+        raise self._e
+
+
 
 # ---------------------------------------------------------------------------
 
 # pip install numpy
 
 
-def create_data_packet(packet_type='JSON', channels=3, source=None, verbose=False):
+# The subscriber identifies a row by (unix_ms, pub_region), so every sample created in this process gets
+# a distinct unix_ms:  the current time in whole ms, or 1 ms after the last sample if that is later
+# (e.g. several packets created within the same ms, or a batch that runs ahead of the clock).
+_packet_unix_ms_last = 0.0
+_packet_unix_ms_lock = threading.Lock()
+
+
+def packet_unix_ms(count=1, unix_ms_inc=1.0):
+    """
+    Returns the unix_ms of the first of count samples created unix_ms_inc ms apart.
+    The unix_ms is never earlier than 1 ms after the last sample returned by a previous call.
+    """
+    from time import time
+    global _packet_unix_ms_last
+
+    with _packet_unix_ms_lock:
+        unix_ms = max(float(int(time() * 1000.0)), _packet_unix_ms_last + 1.0)
+        _packet_unix_ms_last = unix_ms + (count - 1) * unix_ms_inc
+    return unix_ms
+
+
+def create_data_packet(packet_type='JSON', channels=3, source=None, samples=1, verbose=False):
     """
     Returns a JSON serialized data packet consisting of data and metadata.
+
+    packet_type may also be any codec in PACKET_CODECS ('F32', 'F64', 'ARROW') for a binary data packet.
+    An envelope packet type ('JSON_ENVELOPE', 'F32_ENVELOPE', 'F64_ENVELOPE', 'ARROW_ENVELOPE') holds
+    'samples' timestamped samples 1 ms apart (see create_data_packets()).
     
     The data:
         datetime_created
@@ -362,16 +985,18 @@ def create_data_packet(packet_type='JSON', channels=3, source=None, verbose=Fals
 
     import json
     from datetime import datetime, timezone
-    from time import mktime
     from math import sin, exp
 
     if source is None: raise Exception("Argument 'source' was not passsed.")
 
+    if packet_type in ENVELOPE_PACKET_TYPES:
+        return create_data_packets(n=1, channels=channels, source=source, packet_type=packet_type, samples=samples)[0]
+
     # Create and populate a data packet
 
-    # Get the datetime now in UTC as an object and in Unix ms
+    # Get the datetime now in UTC as an object and in Unix ms (distinct from the samples created before)
     datetime_created = datetime.now(tz=timezone.utc)
-    unix_ms = mktime(datetime_created.timetuple()) * 1000.0
+    unix_ms = packet_unix_ms()
 
     # Calculate x from unix_ms
     x = (unix_ms / 10**(len(str(int(unix_ms)))-0))
@@ -446,7 +1071,7 @@ def create_data_packet(packet_type='JSON', channels=3, source=None, verbose=Fals
     # datetime_created must be converted to a string for JSON serialization
     data = {
         "datetime_created": datetime_created.strftime("%Y-%m-%dT%H:%M:%S.%f%z"),
-        "unix_ms": time.mktime(datetime_created.timetuple()) * 1000,        # DateTime to Unix timestamp milliseconds
+        "unix_ms": unix_ms,        # DateTime to Unix timestamp milliseconds
         "pub_region": source,
         "payload": json.dumps(payload)
     }
@@ -459,12 +1084,766 @@ def create_data_packet(packet_type='JSON', channels=3, source=None, verbose=Fals
         #data = orjson.dumps(data, option=orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY)
         #print(data) 
         # b'{"datetime_created":"2024-08-23T16:08:57.604388+00:00","unix_ms":1724443737000.0,"payload":[8.598089e-39,-1.6940384e38,4.043461e-39,9.399784e37,-2.201807e-39]}'
+    elif packet_type in PACKET_CODECS:
+        # Binary packet types (see encode_data_packet())
+        data = encode_data_packet({
+            "datetime_created": datetime_created,
+            "unix_ms": data["unix_ms"],
+            "pub_region": source,
+            "payload": payload,
+        }, packet_type=packet_type)
     else:
         raise Exception("packet_type of '" + str(packet_type) + "' not currently supported")
-    
+
     return data
 
 
+def data_packet_payloads(unix_ms=None, channels=3):
+    """
+    Returns a 2D np.float64 array of shape (len(unix_ms), channels) with the payload values
+    that create_data_packet() calculates for each time in the 1D array unix_ms.
+
+    Every channel formula is evaluated over all of the times at once.
+    """
+
+    # pip install numpy
+    import numpy as np
+
+    if unix_ms is None: raise Exception("Argument 'unix_ms' was not passsed.")
+
+    unix_ms = np.asarray(unix_ms, dtype=np.float64)
+
+    # Calculate x from unix_ms  (unix_ms / 10**number_of_integer_digits)
+    digits = np.floor(np.log10(unix_ms)) + 1.0
+    x = unix_ms / np.power(10.0, digits)
+
+    # Remove integer part of x
+    x = x - np.trunc(x)
+
+    poly = x**4 + x**3 + x**2 + x
+    cyc = np.where(x < 1.0, np.sin(x), np.sin(1.0/np.where(x == 0.0, 1.0, x)))
+
+    payloads = np.empty((len(x), channels), dtype=np.float64)
+    for c in range(0, channels):
+        if c == 0: payloads[:, c] = x                                   # raw
+        elif c == 1: payloads[:, c] = cyc                               # cyc1
+        elif c == 2: payloads[:, c] = poly                              # poly
+        elif c == 3: payloads[:, c] = float(c) * x + float(1/c)         # lin1
+        elif c == 4: payloads[:, c] = 10.0*x + x*10.0                   # cyc2
+        elif c == 5: payloads[:, c] = x**2                              # square
+        elif c == 6: payloads[:, c] = x**3                              # cubic
+        elif c == 7: payloads[:, c] = float(-1/c)*x + float(1/c)        # lin2
+        elif c == 8: payloads[:, c] = np.exp(x)                         # exp
+        else: payloads[:, c] = poly                                     # ch9, ch10, ..
+
+    return payloads
+
+
+def create_data_packets(n=1000, channels=3, source=None, unix_ms_inc=1.0, packet_type='JSON', samples=1, verbose=False):
+    """
+    Returns a list of n JSON serialized data packets in the same format as create_data_packet().
+    Any other packet_type in PACKET_CODECS is encoded per packet with encode_data_packet().
+    For an envelope packet type (ENVELOPE_PACKET_TYPES) each of the n data packets holds 'samples' samples.
+
+    Packet i is created at the current time + i*unix_ms_inc milliseconds.  The payload for all
+    n packets is calculated as one NumPy array by data_packet_payloads() and the packets are
+    serialized in bulk with a string template rather than two json.dumps() calls per packet.
+    """
+    from datetime import datetime, timezone
+    from time import perf_counter
+    import json
+    # pip install numpy
+    import numpy as np
+
+    if source is None: raise Exception("Argument 'source' was not passsed.")
+
+    t_start = perf_counter()
+
+    if not packet_type in ENVELOPE_PACKET_TYPES: samples = 1
+    if samples < 1: raise Exception("Argument 'samples' must be at least 1, not " + str(samples))
+
+    # Get the datetime now in UTC as an object and in Unix ms (same as create_data_packet())
+    datetime_created = datetime.now(tz=timezone.utc)
+    unix_ms_start = packet_unix_ms(count=n*samples, unix_ms_inc=unix_ms_inc)
+
+    offsets_ms = np.arange(n*samples, dtype=np.float64) * unix_ms_inc
+    unix_ms = unix_ms_start + offsets_ms
+    payloads = data_packet_payloads(unix_ms=unix_ms, channels=channels)
+
+    # "%Y-%m-%dT%H:%M:%S.%f%z" for every packet
+    dt = np.datetime64(datetime_created.replace(tzinfo=None), 'us') + (offsets_ms * 1000.0).astype('timedelta64[us]')
+
+    if packet_type != 'JSON':
+        if not packet_type in PACKET_CODECS: raise Exception("packet_type of '" + str(packet_type) + "' not currently supported")
+        packets = [
+            {"datetime_created": d.replace(tzinfo=timezone.utc), "unix_ms": u, "pub_region": source, "payload": payloads[i]}
+            for i, d, u in zip(range(0, n*samples), dt.tolist(), unix_ms.tolist())
+        ]
+        if packet_type in ENVELOPE_PACKET_TYPES:
+            data = [encode_data_packet(packets[i:i+samples], packet_type=packet_type) for i in range(0, n*samples, samples)]
+        else:
+            data = [encode_data_packet(packet, packet_type=packet_type) for packet in packets]
+        if verbose: print(str(n) + " " + packet_type + " data packets of " + str(channels) + " channels created in " + str(round(perf_counter()-t_start,3)) + " sec")
+        return data
+
+    datetimes_created = np.datetime_as_string(dt, unit='us')
+
+    # json.dumps() writes a float with repr(), so the packets are identical to create_data_packet().
+    # repr() is the dominant cost, so each distinct channel column is converted to strings only once
+    # (channels 2 and 9+ share the same formula).
+    col_strs = []
+    col_cache = {}
+    for c in range(0, channels):
+        key = payloads[:, c].tobytes()
+        if key not in col_cache: col_cache[key] = list(map(repr, payloads[:, c].tolist()))
+        col_strs.append(col_cache[key])
+
+    # The payload string only holds digits, so it needs no JSON escaping when nested.
+    template = '{"datetime_created": "%s+0000", "unix_ms": %r, "pub_region": ' + json.dumps(source) + ', "payload": "[%s]"}'
+    # With no channels zip() of the columns would be empty, so each packet gets an empty payload "[]"
+    rows = zip(*col_strs) if channels > 0 else [()] * (n*samples)
+    data = [
+        (template % (d, u, ", ".join(row))).encode('utf-8')
+        for d, u, row in zip(datetimes_created.tolist(), unix_ms.tolist(), rows)
+    ]
+
+    if verbose: print(str(n) + " data packets of " + str(channels) + " channels created in " + str(round(perf_counter()-t_start,3)) + " sec")
+
+    return data
+
+
+# ---------------------------------------------------------------------------
+# Data packet codecs
+
+# A decoded data packet is a dictionary:
+#   {"datetime_created": <datetime in UTC>, "unix_ms": <float>, "pub_region": <str>, "payload": <list of floats>}
+#
+# The publisher sets the message attribute PACKET_TYPE_ATTRIBUTE to the codec used to encode message.data,
+# and the subscriber decodes message.data with the same codec.  Messages without the attribute are 'JSON'.
+
+PACKET_TYPE_ATTRIBUTE = "packet_type"
+
+# Fixed header for the 'F32' and 'F64' binary data packets (little endian, 23 bytes):
+#   magic b'DP', version, dtype code, datetime_created (int64 us since epoch), unix_ms (float64),
+#   pub_region length (uint8), channels (uint16)
+# followed by the pub_region (UTF-8) and the payload as a packed float32 or float64 array.
+#
+# 'ARROW' is an Arrow IPC stream.  The schema makes it larger than 'JSON' for a single reading,
+# so it is intended for packets holding many readings.
+PACKET_BINARY_HEADER = "<2sBBqdBH"
+PACKET_BINARY_MAGIC = b"DP"
+PACKET_BINARY_VERSION = 1
+PACKET_BINARY_DTYPES = {1: "<f4", 2: "<f8"}
+
+# Envelope packet types hold K timestamped samples (readings) from one pub_region in a single message.
+# encode() takes a list of K data packet dictionaries and decode() returns the list.
+#
+# Fixed header for 'F32_ENVELOPE' and 'F64_ENVELOPE' (little endian, 11 bytes):
+#   magic b'DE', version, dtype code, pub_region length (uint8), samples K (uint32), channels (uint16)
+# followed by the pub_region (UTF-8), datetime_created[K] (int64 us since epoch), unix_ms[K] (float64)
+# and the payloads as a packed K x channels float32 or float64 array.
+ENVELOPE_PACKET_TYPES = ('JSON_ENVELOPE', 'F32_ENVELOPE', 'F64_ENVELOPE', 'ARROW_ENVELOPE')
+ENVELOPE_BINARY_HEADER = "<2sBBBIH"
+ENVELOPE_BINARY_MAGIC = b"DE"
+
+PACKET_CODECS = {}
+
+
+def _binary_dtype(dtype_code):
+    # Returns the NumPy dtype for the dtype code of a binary data packet header
+    if not dtype_code in PACKET_BINARY_DTYPES: raise Exception("Unknown binary data packet dtype code " + str(dtype_code) + ".  Use one of " + str(list(PACKET_BINARY_DTYPES.keys())))
+    return PACKET_BINARY_DTYPES[dtype_code]
+
+
+def _binary_packet(data):
+    # Parses the header of a 'F32' or 'F64' binary data packet.
+    # Returns datetime_created (us since epoch), unix_ms, pub_region and the payload as a NumPy array (no copy).
+    import struct
+    # pip install numpy
+    import numpy as np
+
+    magic, version, dtype_code, us, unix_ms, region_len, channels = struct.unpack_from(PACKET_BINARY_HEADER, data)
+    if magic != PACKET_BINARY_MAGIC or version != PACKET_BINARY_VERSION: raise Exception("Data is not a version " + str(PACKET_BINARY_VERSION) + " binary data packet")
+    offset = struct.calcsize(PACKET_BINARY_HEADER)
+    pub_region = bytes(data[offset:offset+region_len]).decode('utf-8')
+    offset += region_len
+    payload = np.frombuffer(data, dtype=_binary_dtype(dtype_code), count=channels, offset=offset)
+    return us, unix_ms, pub_region, payload
+
+
+def _binary_envelope(data):
+    # Parses the header of a 'F32_ENVELOPE' or 'F64_ENVELOPE' binary data packet.
+    # Returns pub_region and the datetime_created (us since epoch), unix_ms and payload (samples x channels)
+    # columns as NumPy arrays (no copy).
+    import struct
+    # pip install numpy
+    import numpy as np
+
+    magic, version, dtype_code, region_len, samples, channels = struct.unpack_from(ENVELOPE_BINARY_HEADER, data)
+    if magic != ENVELOPE_BINARY_MAGIC or version != PACKET_BINARY_VERSION: raise Exception("Data is not a version " + str(PACKET_BINARY_VERSION) + " binary envelope data packet")
+    offset = struct.calcsize(ENVELOPE_BINARY_HEADER)
+    pub_region = bytes(data[offset:offset+region_len]).decode('utf-8')
+    offset += region_len
+    us = np.frombuffer(data, dtype="<i8", count=samples, offset=offset)
+    offset += 8 * samples
+    unix_ms = np.frombuffer(data, dtype="<f8", count=samples, offset=offset)
+    offset += 8 * samples
+    payloads = np.frombuffer(data, dtype=_binary_dtype(dtype_code), count=samples*channels, offset=offset).reshape(samples, channels)
+    return pub_region, us, unix_ms, payloads
+
+
+def _binary_region(pub_region):
+    # Returns pub_region as UTF-8.  The length is a uint8 in the binary headers.
+    region = pub_region.encode('utf-8')
+    if len(region) > 255: raise Exception("pub_region of " + str(len(region)) + " bytes is too long for a binary data packet (255 bytes max)")
+    return region
+
+
+def _json_loads_backend():
+    # orjson is used when it is installed (it is not in requirements.txt, see the note on Alpine Linux above)
+    try:
+        import orjson
+        return orjson.loads, "orjson"
+    except ImportError:
+        import json
+        return json.loads, "json"
+
+_json_loads, JSON_BACKEND = _json_loads_backend()
+
+
+def json_loads(data=None):
+    """
+    Returns the object from the JSON str or bytes data, decoded with the faster JSON_BACKEND if installed.
+    """
+    import json
+    try:
+        return _json_loads(data)
+    except ValueError:
+        # e.g. NaN, which orjson does not accept
+        return json.loads(data)
+
+
+def parse_iso_datetime(s=None):
+    """
+    Returns the datetime for the ISO 8601 string s (e.g. '2024-09-20T11:31:38.520109+0000' as written by the
+    'JSON' codec) using datetime.fromisoformat(), which is much faster than strptime().
+    """
+    from datetime import datetime
+    try:
+        return datetime.fromisoformat(s)
+    except ValueError:
+        # Python < 3.11 does not accept an offset without ':'
+        return datetime.strptime(s, "%Y-%m-%dT%H:%M:%S.%f%z")
+
+
+def register_packet_codec(packet_type=None, encode=None, decode=None):
+    """
+    Adds (or replaces) the codec packet_type in PACKET_CODECS.
+
+        encode(packet) -> bytes
+        decode(data) -> packet
+
+    For an envelope packet type (ENVELOPE_PACKET_TYPES) packet is a list of data packet dictionaries.
+    """
+    if packet_type is None: raise Exception("Argument packet_type not passed to the function.")
+    if encode is None or decode is None: raise Exception("Arguments encode and decode must both be passed to the function.")
+    PACKET_CODECS[packet_type] = (encode, decode)
+
+
+def encode_data_packet(packet=None, packet_type='JSON'):
+    """
+    Returns the data packet dictionary packet serialized to bytes with the codec packet_type.
+    """
+    if packet is None: raise Exception("Argument packet not passed to the function.")
+    if not packet_type in PACKET_CODECS: raise Exception("packet_type of '" + str(packet_type) + "' not currently supported")
+    return PACKET_CODECS[packet_type][0](packet)
+
+
+def decode_data_packet(data=None, packet_type='JSON'):
+    """
+    Returns the data packet dictionary from the bytes data that were encoded with the codec packet_type.
+    """
+    if data is None: raise Exception("Argument data not passed to the function.")
+    if not packet_type in PACKET_CODECS: raise Exception("packet_type of '" + str(packet_type) + "' not currently supported")
+    return PACKET_CODECS[packet_type][1](data)
+
+
+def _encode_packet_json(packet):
+    import json
+    data = {
+        "datetime_created": packet["datetime_created"].strftime("%Y-%m-%dT%H:%M:%S.%f%z"),
+        "unix_ms": packet["unix_ms"],
+        "pub_region": packet["pub_region"],
+        "payload": json.dumps([float(v) for v in packet["payload"]])
+    }
+    return json.dumps(data).encode('utf-8')
+
+
+def _decode_packet_json(data):
+    packet = json_loads(data)
+    packet["datetime_created"] = parse_iso_datetime(packet["datetime_created"])
+    # The payload is a JSON string of a list nested inside the JSON packet
+    packet["payload"] = json_loads(packet["payload"])
+    return packet
+
+
+def _encode_packet_binary(packet, dtype_code):
+    from datetime import datetime, timezone, timedelta
+    import struct
+    # pip install numpy
+    import numpy as np
+
+    region = _binary_region(packet["pub_region"])
+    payload = np.asarray(packet["payload"], dtype=_binary_dtype(dtype_code))
+    us = (packet["datetime_created"] - datetime(1970, 1, 1, tzinfo=timezone.utc)) // timedelta(microseconds=1)
+    header = struct.pack(PACKET_BINARY_HEADER, PACKET_BINARY_MAGIC, PACKET_BINARY_VERSION, dtype_code, us, packet["unix_ms"], len(region), len(payload))
+    return header + region + payload.tobytes()
+
+
+def _decode_packet_binary(data):
+    us, unix_ms, pub_region, payload = _binary_packet(data)
+    return {
+        "datetime_created": datetime(1970, 1, 1, tzinfo=timezone.utc) + timedelta(microseconds=us),
+        "unix_ms": unix_ms,
+        "pub_region": pub_region,
+        "payload": payload.tolist(),
+    }
+
+
+def _packet_arrow_schema():
+    # pip install pyarrow
+    import pyarrow as pa
+    return pa.schema([
+        ("datetime_created", pa.timestamp("us", tz="UTC")),
+        ("unix_ms", pa.float64()),
+        ("pub_region", pa.string()),
+        ("payload", pa.list_(pa.float64())),
+    ])
+
+
+def _encode_packets_arrow(packets):
+    # pip install pyarrow
+    import pyarrow as pa
+    schema = _packet_arrow_schema()
+    batch = pa.RecordBatch.from_pylist([{
+        "datetime_created": packet["datetime_created"],
+        "unix_ms": packet["unix_ms"],
+        "pub_region": packet["pub_region"],
+        "payload": [float(v) for v in packet["payload"]],
+    } for packet in packets], schema=schema)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        writer.write_batch(batch)
+    return sink.getvalue().to_pybytes()
+
+
+def _decode_packets_arrow(data):
+    # pip install pyarrow
+    import pyarrow as pa
+    table = pa.ipc.open_stream(data).read_all()
+    return table.to_pylist()
+
+
+def _encode_envelope_json(packets):
+    import json
+    # Columnar JSON object.  The payloads are a JSON array of arrays (not a nested JSON string).
+    data = {
+        "pub_region": packets[0]["pub_region"],
+        "datetime_created": [packet["datetime_created"].strftime("%Y-%m-%dT%H:%M:%S.%f%z") for packet in packets],
+        "unix_ms": [float(packet["unix_ms"]) for packet in packets],
+        "payload": [[float(v) for v in packet["payload"]] for packet in packets],
+    }
+    return json.dumps(data).encode('utf-8')
+
+
+def _decode_envelope_json(data):
+    data = json_loads(data)
+    pub_region = data["pub_region"]
+    return [
+        {"datetime_created": parse_iso_datetime(d), "unix_ms": u, "pub_region": pub_region, "payload": payload}
+        for d, u, payload in zip(data["datetime_created"], data["unix_ms"], data["payload"])
+    ]
+
+
+def _encode_envelope_binary(packets, dtype_code):
+    from datetime import datetime, timezone, timedelta
+    import struct
+    # pip install numpy
+    import numpy as np
+
+    region = _binary_region(packets[0]["pub_region"])
+    epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    us = np.array([(packet["datetime_created"] - epoch) // timedelta(microseconds=1) for packet in packets], dtype="<i8")
+    unix_ms = np.array([packet["unix_ms"] for packet in packets], dtype="<f8")
+    payloads = np.asarray([packet["payload"] for packet in packets], dtype=_binary_dtype(dtype_code))
+    header = struct.pack(ENVELOPE_BINARY_HEADER, ENVELOPE_BINARY_MAGIC, PACKET_BINARY_VERSION, dtype_code, len(region), len(packets), payloads.shape[1])
+    return header + region + us.tobytes() + unix_ms.tobytes() + payloads.tobytes()
+
+
+def _decode_envelope_binary(data):
+    pub_region, us, unix_ms, payloads = _binary_envelope(data)
+
+    epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+    return [
+        {"datetime_created": epoch + timedelta(microseconds=t), "unix_ms": u, "pub_region": pub_region, "payload": payload}
+        for t, u, payload in zip(us.tolist(), unix_ms.tolist(), payloads.tolist())
+    ]
+
+
+register_packet_codec('JSON', _encode_packet_json, _decode_packet_json)
+register_packet_codec('F32', lambda packet: _encode_packet_binary(packet, 1), _decode_packet_binary)
+register_packet_codec('F64', lambda packet: _encode_packet_binary(packet, 2), _decode_packet_binary)
+register_packet_codec('ARROW', lambda packet: _encode_packets_arrow([packet]), lambda data: _decode_packets_arrow(data)[0])
+register_packet_codec('JSON_ENVELOPE', _encode_envelope_json, _decode_envelope_json)
+register_packet_codec('F32_ENVELOPE', lambda packets: _encode_envelope_binary(packets, 1), _decode_envelope_binary)
+register_packet_codec('F64_ENVELOPE', lambda packets: _encode_envelope_binary(packets, 2), _decode_envelope_binary)
+register_packet_codec('ARROW_ENVELOPE', _encode_packets_arrow, _decode_packets_arrow)
+
+
+# Used to convert the datetime_created of a packet to microseconds since the epoch
+PACKET_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+PACKET_US = timedelta(microseconds=1)
+
+
+def decode_data_packet_columns(data=None, packet_type='JSON'):
+    """
+    Returns the samples of the data packet data (encoded with the codec packet_type) as columns:
+        {"datetime_created_us": int64 array (us since epoch, UTC), "unix_ms": float64 array,
+         "pub_region": str, "payload": float64 array of shape (samples, channels)}
+
+    The binary and Arrow packet types are read directly into NumPy arrays (no Python objects per value).
+    Packet types registered with register_packet_codec() are decoded with decode_data_packet().
+    """
+    # pip install numpy
+    import numpy as np
+
+    if data is None: raise Exception("Argument data not passed to the function.")
+
+    if packet_type in ('F32', 'F64'):
+        us, unix_ms, pub_region, payload = _binary_packet(data)
+        return {"datetime_created_us": np.array([us], dtype=np.int64), "unix_ms": np.array([unix_ms], dtype=np.float64),
+                "pub_region": pub_region, "payload": payload.astype(np.float64).reshape(1, -1)}
+
+    if packet_type in ('F32_ENVELOPE', 'F64_ENVELOPE'):
+        pub_region, us, unix_ms, payload = _binary_envelope(data)
+        return {"datetime_created_us": us.astype(np.int64), "unix_ms": unix_ms.astype(np.float64), "pub_region": pub_region, "payload": payload.astype(np.float64)}
+
+    if packet_type in ('ARROW', 'ARROW_ENVELOPE'):
+        # pip install pyarrow
+        import pyarrow as pa
+        table = pa.ipc.open_stream(data).read_all()
+        payload = table.column("payload").combine_chunks()
+        samples = len(table)
+        return {"datetime_created_us": table.column("datetime_created").cast(pa.int64()).to_numpy(),
+                "unix_ms": table.column("unix_ms").to_numpy(),
+                "pub_region": table.column("pub_region")[0].as_py() if samples > 0 else "",
+                "payload": payload.flatten().to_numpy(zero_copy_only=False).reshape(samples, -1) if samples > 0 else np.zeros((0, 0))}
+
+    if packet_type in ('JSON', 'JSON_ENVELOPE'):
+        packet = json_loads(data)
+        if packet_type == 'JSON':
+            datetimes = [packet["datetime_created"]]
+            unix_ms = [packet["unix_ms"]]
+            # The payload is a JSON string of a list nested inside the JSON packet
+            payload = [json_loads(packet["payload"])]
+        else:
+            datetimes = packet["datetime_created"]
+            unix_ms = packet["unix_ms"]
+            payload = packet["payload"]
+        if len(datetimes) > 1 and all(len(d) == 31 and d.endswith("+0000") for d in datetimes):
+            # UTC, parsed by NumPy without the offset
+            us = np.array([d[:26] for d in datetimes], dtype="datetime64[us]").astype(np.int64)
+        else:
+            us = np.array([(parse_iso_datetime(d) - PACKET_EPOCH) // PACKET_US for d in datetimes], dtype=np.int64)
+        return {"datetime_created_us": us, "unix_ms": np.asarray(unix_ms, dtype=np.float64),
+                "pub_region": packet["pub_region"], "payload": np.asarray(payload, dtype=np.float64).reshape(len(us), -1)}
+
+    # Any other registered codec
+    packets = decode_data_packet(data, packet_type=packet_type)
+    if not isinstance(packets, list): packets = [packets]
+    return {"datetime_created_us": np.array([(p["datetime_created"] - PACKET_EPOCH) // PACKET_US for p in packets], dtype=np.int64),
+            "unix_ms": np.array([p["unix_ms"] for p in packets], dtype=np.float64),
+            "pub_region": packets[0]["pub_region"] if len(packets) > 0 else "",
+            "payload": np.asarray([p["payload"] for p in packets], dtype=np.float64).reshape(len(packets), -1)}
+
+
+# ---------------------------------------------------------------------------
+# Data packet compression
+
+# When a data packet is compressed, the publisher sets the message attribute CONTENT_ENCODING_ATTRIBUTE
+# to the compression used and the subscriber decompresses message.data before decoding it.
+# Data packets smaller than COMPRESS_MIN_BYTES are sent uncompressed (and without the attribute).
+
+CONTENT_ENCODING_ATTRIBUTE = "content-encoding"
+COMPRESS_MIN_BYTES = 512
+
+
+def _content_encodings():
+    # Python standard library compressors:  content_encoding: (compress, decompress)
+    import zlib
+    import lzma
+    return {
+        "zlib": (lambda data: zlib.compress(data, 6), zlib.decompress),
+        "lzma": (lambda data: lzma.compress(data, preset=1), lzma.decompress),
+    }
+
+
+def compress_data_packet(data=None, content_encoding='zlib', min_bytes=COMPRESS_MIN_BYTES):
+    """
+    Returns (data, content_encoding) where data is the data packet compressed with content_encoding ('zlib' or 'lzma').
+
+    Returns the data packet unchanged with content_encoding None if content_encoding is None,
+    the data packet is smaller than min_bytes, or compression does not make it smaller.
+    """
+    if data is None: raise Exception("Argument data not passed to the function.")
+    if content_encoding is None or content_encoding == "" or len(data) < min_bytes: return data, None
+
+    encodings = _content_encodings()
+    if not content_encoding in encodings: raise Exception("content_encoding of '" + str(content_encoding) + "' not currently supported")
+
+    compressed = encodings[content_encoding][0](data)
+    if len(compressed) >= len(data): return data, None
+    return compressed, content_encoding
+
+
+def decompress_data_packet(data=None, content_encoding=None):
+    """
+    Returns the data packet decompressed according to content_encoding (the message attribute CONTENT_ENCODING_ATTRIBUTE).
+    The data packet is returned unchanged if content_encoding is None.
+    """
+    if data is None: raise Exception("Argument data not passed to the function.")
+    if content_encoding is None or content_encoding == "": return data
+
+    encodings = _content_encodings()
+    if not content_encoding in encodings: raise Exception("content_encoding of '" + str(content_encoding) + "' not currently supported")
+    return encodings[content_encoding][1](data)
+
+
+# ---------------------------------------------------------------------------
+# Durable local spool (write-ahead log)
+
+# Data packets that could not be published are appended to segment files in a local spool directory
+# and published again by a background replayer once the Pub/Sub service can be reached.
+#
+# Each record is a header of struct SPOOL_RECORD_HEADER (data length, attributes length, CRC-32 of both)
+# followed by the data packet as published (possibly compressed) and the message attributes as JSON.
+# A record torn by a crash fails the length or CRC check and ends the segment.
+SPOOL_RECORD_HEADER = "<III"
+SPOOL_SEGMENT_PREFIX = "spool-"
+SPOOL_SEGMENT_SUFFIX = ".seg"
+SPOOL_SEGMENT_MAX_BYTES = 16000000      # 16 MB
+SPOOL_FSYNC_EVERY = 100                 # records
+SPOOL_FSYNC_INTERVAL_S = 1.0
+
+
+class PublishSpool:
+    """
+    Append-only local spool of data packets that could not be published.
+
+    Records are appended to the active segment file, which is fsync()'d after every fsync_every
+    records or fsync_interval_s seconds (whichever comes first), when it is sealed, and on close().
+    The active segment is sealed and a new one started once it reaches segment_max_bytes.
+
+    replay() publishes the sealed segments in order with publish_many() and deletes each segment
+    once every record in it was published.  start_replayer() runs replay() in a background thread.
+    """
+
+    def __init__(self, spool_dir=None, segment_max_bytes=SPOOL_SEGMENT_MAX_BYTES, fsync_every=SPOOL_FSYNC_EVERY, fsync_interval_s=SPOOL_FSYNC_INTERVAL_S, verbose=False):
+        if spool_dir is None: raise Exception("Argument spool_dir not passed to the function.")
+        from pathlib import Path
+        from time import monotonic
+
+        self.spool_dir = Path(spool_dir)
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync_every = fsync_every
+        self.fsync_interval_s = fsync_interval_s
+        self.verbose = verbose
+
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._replayer = None
+        self._replayer_stop = threading.Event()
+
+        # Segments left by a previous run are sealed.  New records go to a new segment.
+        segments = self.segments()
+        self._next_seq = int(segments[-1].stem[len(SPOOL_SEGMENT_PREFIX):]) + 1 if len(segments) > 0 else 1
+        self._file = None
+        self._file_bytes = 0
+        self._unsynced = 0
+        self._t_synced = monotonic()
+        if verbose and len(segments) > 0: print(str(len(segments)) + " spool segments found in " + str(self.spool_dir))
+
+    def segments(self):
+        """ Returns the segment files in the spool directory in the order they were written. """
+        return sorted(self.spool_dir.glob(SPOOL_SEGMENT_PREFIX + "*" + SPOOL_SEGMENT_SUFFIX))
+
+    def append(self, data=None, attributes=None):
+        """
+        Appends the data packet data and its message attributes (dictionary of strings) to the spool.
+        """
+        import json
+        import struct
+        import zlib
+        from time import monotonic
+
+        if data is None: raise Exception("Argument data not passed to the function.")
+        attrs = json.dumps(attributes if not attributes is None else {}).encode("utf-8")
+        record = struct.pack(SPOOL_RECORD_HEADER, len(data), len(attrs), zlib.crc32(attrs, zlib.crc32(data))) + data + attrs
+
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.spool_dir / (SPOOL_SEGMENT_PREFIX + str(self._next_seq).zfill(12) + SPOOL_SEGMENT_SUFFIX), "ab")
+                self._next_seq += 1
+                self._file_bytes = 0
+            self._file.write(record)
+            self._file_bytes += len(record)
+            self._unsynced += 1
+            if self._file_bytes >= self.segment_max_bytes:
+                self._seal()
+            elif self._unsynced >= self.fsync_every or monotonic() - self._t_synced >= self.fsync_interval_s:
+                self._sync()
+
+    def _sync(self):
+        import os
+        from time import monotonic
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._t_synced = monotonic()
+
+    def _seal(self):
+        # Called with self._lock held
+        if self._file is None: return
+        self._sync()
+        self._file.close()
+        self._file = None
+
+    def seal(self):
+        """ Seals the active segment so that replay() can publish it. """
+        with self._lock:
+            self._seal()
+
+    def close(self):
+        """ Stops the replayer and fsync()s and closes the active segment. """
+        self.stop_replayer()
+        self.seal()
+
+    @staticmethod
+    def read_segment(path):
+        """
+        Returns the list of (data, attributes) records in the segment file path.
+        Reading stops at the first torn or corrupt record.
+        """
+        import json
+        import struct
+        import zlib
+
+        header_size = struct.calcsize(SPOOL_RECORD_HEADER)
+        with open(path, "rb") as f:
+            buf = f.read()
+
+        records = []
+        pos = 0
+        while pos + header_size <= len(buf):
+            data_len, attrs_len, crc = struct.unpack_from(SPOOL_RECORD_HEADER, buf, pos)
+            start = pos + header_size
+            end = start + data_len + attrs_len
+            if end > len(buf): break
+            data = buf[start:start+data_len]
+            attrs = buf[start+data_len:end]
+            if zlib.crc32(attrs, zlib.crc32(data)) != crc: break
+            records.append((data, json.loads(attrs.decode("utf-8"))))
+            pos = end
+        return records
+
+    def pending(self):
+        """ Returns the number of records in the spool. """
+        with self._lock:
+            if not self._file is None: self._file.flush()
+            return sum(len(self.read_segment(path)) for path in self.segments())
+
+    def replay(self, project_id=None, topic_id=None, flow_control=None, timeout_s=60.0, publisher_factory=None, verbose=None):
+        """
+        Seals the active segment and publishes every spooled record to topic_id.
+        Returns (records published, records still spooled).
+
+        A segment is deleted once every record in it was published.  If none of the records
+        in a segment could be published the replay stops (the service is still unreachable).
+        Records that failed in a partly published segment are appended to the spool again.
+        """
+        if verbose is None: verbose = self.verbose
+
+        with self._replay_lock:
+            self.seal()
+            # A producer may have started a new active segment since it was sealed
+            with self._lock:
+                active = None if self._file is None else self._file.name
+                segments = [path for path in self.segments() if str(path) != active]
+            published = 0
+            remaining = 0
+            stopped = False
+            for path in segments:
+                records = self.read_segment(path)
+                if stopped:
+                    remaining += len(records)
+                    continue
+
+                # Publish consecutive records with the same attributes with one publish_many() call.
+                # The data packets were spooled as published, so they are not compressed again.
+                failed = []
+                i = 0
+                while i < len(records):
+                    j = i + 1
+                    while j < len(records) and records[j][1] == records[i][1]: j += 1
+                    try:
+                        message_ids, failures = publish_many(packets=[data for data, attributes in records[i:j]], project_id=project_id, topic_id=topic_id, attributes=records[i][1], flow_control=flow_control, timeout_s=timeout_s, publisher_factory=publisher_factory)
+                        failed += [records[i+k] for k, e in failures]
+                    except Exception as e:
+                        if verbose: print("ERROR: spool replay " + str(e))
+                        failed += records[i:j]
+                    i = j
+
+                if len(failed) == len(records) and len(records) > 0:
+                    stopped = True
+                    remaining += len(records)
+                    continue
+                for data, attributes in failed:
+                    self.append(data, attributes)
+                path.unlink()
+                published += len(records) - len(failed)
+                remaining += len(failed)
+
+            if verbose and published + remaining > 0: print("Spool replay: " + str(published) + " published, " + str(remaining) + " still spooled")
+            return published, remaining
+
+    def start_replayer(self, project_id=None, topic_id=None, interval_s=5.0, flow_control=None, publisher_factory=None):
+        """
+        Starts a background thread that calls replay() every interval_s seconds while the spool is not empty.
+        """
+        if project_id is None: raise Exception("Argument project_id not passed to the function.")
+        if topic_id is None: raise Exception("Argument topic_id not passed to the function.")
+        if not self._replayer is None: return
+
+        def run():
+            while not self._replayer_stop.wait(interval_s):
+                if len(self.segments()) == 0: continue
+                try:
+                    self.replay(project_id=project_id, topic_id=topic_id, flow_control=flow_control, publisher_factory=publisher_factory)
+                except Exception as e:
+                    print("ERROR: spool replayer " + str(e))
+
+        self._replayer_stop.clear()
+        self._replayer = threading.Thread(target=run, name="PublishSpoolReplayer", daemon=True)
+        self._replayer.start()
+
+    def stop_replayer(self):
+        if self._replayer is None: return
+        self._replayer_stop.set()
+        self._replayer.join()
+        self._replayer = None
+
+
 
 if __name__ == '__main__':
     pass
@@ -0,0 +1,637 @@
+#
+#   Written by:  Mark W Kiehl
+#   http://mechatronicsolutionsllc.com/
+#   http://www.savvysolutions.info/savvycodesolutions/
+
+# Copyright (C) Mechatroinc Solutions LLC
+# License:  MIT
+
+
+# Define the script version in terms of Semantic Versioning (SemVer)
+# when Git or other versioning systems are not employed.
+__version__ = "0.0.0"
+from pathlib import Path
+print("'" + Path(__file__).stem + ".py'  v" + __version__)
+
+
+
+"""
+Sinks for the rows decoded from the Pub/Sub messages
+
+Sink            base class that buffers rows and writes them in batches from a flush thread
+                (BqBatchWriter and BqStorageWriteSink in api_gcp_bigquery.py are the BigQuery sinks)
+ParquetSink     rolling local Parquet files (segments)
+SqliteSink      a local SQLite database
+MultiSink       writes the same rows to several sinks in parallel
+
+
+"""
+
+
+import threading
+
+
+# ---------------------------------------------------------------------------
+# Sink
+#
+# Rows are written together when SINK_BATCH_MAX_ROWS rows or SINK_BATCH_MAX_BYTES bytes are buffered,
+# or the oldest row has waited SINK_BATCH_MAX_LATENCY_S seconds.
+SINK_BATCH_MAX_ROWS = 500
+SINK_BATCH_MAX_BYTES = 5000000        # 5 MB
+SINK_BATCH_MAX_LATENCY_S = 1.0
+
+
+class Sink:
+    """
+    Base class of the sinks.  Buffers rows (dictionaries) from many messages (and threads) and writes them
+    together with _insert() when max_rows rows or max_bytes bytes are buffered, or the oldest row has
+    waited max_latency_s seconds.  A subclass implements _insert(rows, row_ids) and, optionally, close().
+
+    add() buffers the rows of one message, optionally with their insertIds (row_ids, see gcp_bq_insert_id()),
+    together with the callbacks on_success() and on_failure(),
+    which are called from the flush thread once the rows have been written.
+    on_success() is only called if every row of the message was written (e.g. to ack the message),
+    otherwise on_failure(errors) is called (e.g. to nack the message so it is delivered again).
+
+    A columnar sink (columnar = True) also takes the rows of many messages as one pyarrow.RecordBatch
+    with add_record_batch(), and its _insert() is then passed a pyarrow.Table instead of the list of rows.
+
+    stats has the keys "rows", "requests", "failed_rows" and "max_rows_per_request".
+    """
+
+    # True for the sinks that write to BigQuery
+    bigquery = False
+    # True for the sinks that take a pyarrow.RecordBatch with add_record_batch()
+    columnar = False
+
+    def __init__(self, max_rows=SINK_BATCH_MAX_ROWS, max_bytes=SINK_BATCH_MAX_BYTES, max_latency_s=SINK_BATCH_MAX_LATENCY_S, verbose=False):
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_latency_s = max_latency_s
+        self.verbose = verbose
+
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._full = threading.Event()
+        self._stop = threading.Event()
+        self._batches = []          # [(rows or pyarrow.RecordBatch, row_ids, bytes, on_success, on_failure)]
+        self._rows = 0
+        self._bytes = 0
+        self._t_first = None
+        self.stats = {"rows": 0, "requests": 0, "failed_rows": 0, "max_rows_per_request": 0}
+
+        self._thread = threading.Thread(target=self._run, name=type(self).__name__, daemon=True)
+        self._thread.start()
+
+    def add(self, rows=None, on_success=None, on_failure=None, row_ids=None):
+        """
+        Buffers the rows (list of dictionaries) for the next write.
+        row_ids is an optional list of insertIds, one per row.
+        """
+        import json
+        from time import monotonic
+
+        if rows is None: raise Exception("Argument rows has not been passed")
+        if self._stop.is_set(): raise Exception(type(self).__name__ + " is closed")
+        if not row_ids is None and len(row_ids) != len(rows): raise Exception("Argument row_ids must have one insertId per row")
+
+        n_bytes = sum(len(json.dumps(row)) for row in rows)
+        with self._lock:
+            if self._t_first is None: self._t_first = monotonic()
+            self._batches.append((rows, row_ids, n_bytes, on_success, on_failure))
+            self._rows += len(rows)
+            self._bytes += n_bytes
+            if self._rows >= self.max_rows or self._bytes >= self.max_bytes: self._full.set()
+
+    def add_record_batch(self, record_batch=None, callbacks=None):
+        """
+        Buffers the rows of record_batch, a pyarrow.RecordBatch with the rows of several messages
+        (see gcp_pubsub_msgs_to_record_batch()), for the next write.  Only for a columnar sink.
+        callbacks is a list with (n_rows, on_success, on_failure) for each message, in the order of
+        their rows in record_batch.  The rows are not converted to dictionaries.
+        """
+        from time import monotonic
+
+        if record_batch is None: raise Exception("Argument record_batch has not been passed")
+        if callbacks is None: raise Exception("Argument callbacks has not been passed")
+        if not self.columnar: raise Exception(type(self).__name__ + " does not take record batches, use add()")
+        if self._stop.is_set(): raise Exception(type(self).__name__ + " is closed")
+        if sum(n_rows for n_rows, on_success, on_failure in callbacks) != record_batch.num_rows: raise Exception("Argument callbacks must have the " + str(record_batch.num_rows) + " rows of record_batch")
+
+        batch_bytes = record_batch.nbytes
+        with self._lock:
+            if self._t_first is None: self._t_first = monotonic()
+            offset = 0
+            for n_rows, on_success, on_failure in callbacks:
+                # A zero-copy slice with the rows of the message
+                n_bytes = batch_bytes * n_rows // max(1, record_batch.num_rows)
+                self._batches.append((record_batch.slice(offset, n_rows), None, n_bytes, on_success, on_failure))
+                offset += n_rows
+                self._rows += n_rows
+                self._bytes += n_bytes
+            if self._rows >= self.max_rows or self._bytes >= self.max_bytes: self._full.set()
+
+    def _run(self):
+        # Flushes when the buffer is full or the oldest buffered row has waited max_latency_s
+        from time import monotonic
+        while not self._stop.is_set():
+            with self._lock:
+                wait_s = self.max_latency_s if self._t_first is None else max(0.0, self._t_first + self.max_latency_s - monotonic())
+            self._full.wait(wait_s)
+            with self._lock:
+                due = self._full.is_set() or (not self._t_first is None and monotonic() >= self._t_first + self.max_latency_s)
+            if due: self._flush()
+            self._poll()
+
+    def _poll(self):
+        # Called by the flush thread at least every max_latency_s, e.g. to roll a segment that is due
+        pass
+
+    def _take(self):
+        # Removes up to max_rows / max_bytes of buffered rows (whole messages only).  Lists of rows and
+        # record batches (or record batches with another schema) are not taken together.
+        with self._lock:
+            n_rows = 0
+            n_bytes = 0
+            i = 0
+            while i < len(self._batches):
+                rows, rows_bytes = self._batches[i][0], self._batches[i][2]
+                if i > 0 and (n_rows + len(rows) > self.max_rows or n_bytes + rows_bytes > self.max_bytes): break
+                if i > 0 and not self._same_kind(self._batches[0][0], rows): break
+                n_rows += len(rows)
+                n_bytes += rows_bytes
+                i += 1
+            batches = self._batches[:i]
+            self._batches = self._batches[i:]
+            self._rows -= n_rows
+            self._bytes -= n_bytes
+            if len(self._batches) == 0:
+                self._t_first = None
+            if self._rows < self.max_rows and self._bytes < self.max_bytes: self._full.clear()
+        return batches
+
+    @staticmethod
+    def _same_kind(first, rows):
+        # True if rows can be written together with first (both lists, or record batches with the same schema)
+        if isinstance(first, list) or isinstance(rows, list): return isinstance(first, list) and isinstance(rows, list)
+        return first.schema.equals(rows.schema)
+
+    def _insert(self, rows, row_ids=None):
+        # Writes rows and returns a list of {"index": <row index>, "errors": [...]} for each row that was
+        # not written (an empty list if every row was written).
+        # row_ids is None or a list with an insertId (or None) per row.
+        # rows is a pyarrow.Table for the record batches of add_record_batch() (columnar sinks only).
+        raise NotImplementedError(type(self).__name__ + "._insert()")
+
+    def flush(self):
+        """
+        Writes every buffered row (one _insert() per max_rows / max_bytes) and calls the callbacks.
+        Returns the number of rows inserted.
+        """
+        return self._flush()
+
+    def write(self):
+        """
+        Writes every buffered row like flush(), but a sink that holds the callbacks until the rows are
+        durable (BqLoadJobSink) may keep holding them.  Returns the number of rows written.
+        """
+        return self._flush()
+
+    def _flush(self):
+        # Writes every buffered row, called by flush() and the flush thread
+        from time import perf_counter
+
+        inserted = 0
+        with self._flush_lock:
+            while True:
+                batches = self._take()
+                if len(batches) == 0: break
+
+                if isinstance(batches[0][0], list):
+                    rows = []
+                    row_ids = []
+                    for batch_rows, batch_row_ids, n_bytes, on_success, on_failure in batches:
+                        rows += batch_rows
+                        row_ids += batch_row_ids if not batch_row_ids is None else [None] * len(batch_rows)
+                else:
+                    # pip install pyarrow
+                    import pyarrow as pa
+                    rows = pa.Table.from_batches([batch[0] for batch in batches])
+                    row_ids = []
+
+                t_start = perf_counter()
+                errors = self._insert(rows, row_ids=row_ids if any(not row_id is None for row_id in row_ids) else None)
+
+                # A list with an entry for each row that was not inserted
+                failed = {}
+                for error in errors:
+                    failed[error["index"]] = error["errors"]
+                with self._lock:
+                    self.stats["rows"] += len(rows) - len(failed)
+                    self.stats["failed_rows"] += len(failed)
+                    self.stats["requests"] += 1
+                    self.stats["max_rows_per_request"] = max(self.stats["max_rows_per_request"], len(rows))
+                inserted += len(rows) - len(failed)
+                if self.verbose: print(str(len(rows) - len(failed)) + " of " + str(len(rows)) + " rows from " + str(len(batches)) + " messages written by " + type(self).__name__ + " in " + str(round(perf_counter() - t_start, 3)) + " sec")
+
+                results = []
+                i = 0
+                for batch_rows, batch_row_ids, n_bytes, on_success, on_failure in batches:
+                    results.append((on_success, on_failure, [failed[j] for j in range(i, i + len(batch_rows)) if j in failed]))
+                    i += len(batch_rows)
+                self._complete(results)
+        return inserted
+
+    def _complete(self, results):
+        # Called with [(on_success, on_failure, errors)] for the messages of each _insert().
+        # A subclass may hold the callbacks until the rows are durable (see ParquetSink).
+        self._call_callbacks(results)
+
+    def _call_callbacks(self, results):
+        # Calls on_success() of each message without errors, otherwise on_failure(errors)
+        for on_success, on_failure, errors in results:
+            try:
+                if len(errors) == 0:
+                    if not on_success is None: on_success()
+                else:
+                    if not on_failure is None: on_failure(errors)
+            except Exception as e:
+                print("ERROR: " + type(self).__name__ + " callback " + str(e))
+
+    def close(self):
+        """ Stops the flush thread and writes the rows still buffered. """
+        self._stop.set()
+        self._full.set()
+        self._thread.join()
+        self.flush()
+
+
+
+
+# ---------------------------------------------------------------------------
+# Parquet sink
+#
+# The rows are appended to a local Parquet file (a segment) named <prefix>_<UTC time>_<pid>_<n>.parquet in
+# PARQUET_SINK_DIR.  The segment is written as '.parquet.tmp' and renamed when it is rolled, after
+# PARQUET_SEGMENT_MAX_ROWS rows or PARQUET_SEGMENT_MAX_AGE_S seconds, so a finished segment is never
+# read while it is being written.  datetime_created is written as timestamp[us, UTC] and unix_ms as
+# int64, the types of the BigQuery table.
+PARQUET_SINK_DIR = "pubsub_parquet"
+PARQUET_SEGMENT_MAX_ROWS = 1000000
+PARQUET_SEGMENT_MAX_AGE_S = 300.0
+PARQUET_COMPRESSION = "snappy"
+
+
+def rows_to_arrow_table(rows=None):
+    """
+    Returns a pyarrow.Table from rows (a list of dictionaries, the columns of all of the rows).
+    A row without a column has a null.  The ISO string 'datetime_created' is converted to
+    timestamp[us, UTC] and 'unix_ms' to int64.
+    """
+    # pip install pyarrow
+    import pyarrow as pa
+
+    if rows is None: raise Exception("Argument rows has not been passed")
+
+    names = list(dict.fromkeys(name for row in rows for name in row))
+    table = pa.table({name: [row.get(name) for row in rows] for name in names})
+    if "datetime_created" in names and not pa.types.is_timestamp(table.schema.field("datetime_created").type):
+        i = names.index("datetime_created")
+        table = table.set_column(i, "datetime_created", table.column(i).cast(pa.timestamp("us")).cast(pa.timestamp("us", tz="UTC")))
+    if "unix_ms" in names and not pa.types.is_int64(table.schema.field("unix_ms").type):
+        i = names.index("unix_ms")
+        table = table.set_column(i, "unix_ms", table.column(i).cast(pa.int64(), safe=False))
+    return table
+
+
+class ParquetSink(Sink):
+    """
+    Writes the rows to rolling local Parquet files (segments) in path (see Sink).
+    The record batches of add_record_batch() are written as they are.
+
+    segments() returns the finished segments, and on_segment(path) (if passed) is called from the
+    thread that rolled each segment.  roll() finishes the current segment.  A segment is also rolled
+    when the columns of the rows change.
+
+    A '.parquet.tmp' segment can't be read until it is finished (the footer is written when it is closed),
+    so the callbacks of the rows are held until their segment is rolled:  by size or age (the flush thread
+    rolls a segment max_segment_age_s old), by roll(), flush() and close(), and by write() once the segment
+    is max_segment_age_s old.  In stream and service mode the messages are then held for up to
+    max_segment_age_s, so the subscriber flow control must allow the messages of a segment to be outstanding.
+    """
+
+    columnar = True
+
+    def __init__(self, path=PARQUET_SINK_DIR, prefix="rows", max_segment_rows=PARQUET_SEGMENT_MAX_ROWS, max_segment_age_s=PARQUET_SEGMENT_MAX_AGE_S, compression=PARQUET_COMPRESSION, on_segment=None, max_rows=SINK_BATCH_MAX_ROWS, max_bytes=SINK_BATCH_MAX_BYTES, max_latency_s=SINK_BATCH_MAX_LATENCY_S, verbose=False):
+        from pathlib import Path
+
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.prefix = prefix
+        self.max_segment_rows = max_segment_rows
+        self.max_segment_age_s = max_segment_age_s
+        self.compression = compression
+        self.on_segment = on_segment
+        self._writer = None
+        self._segment = None
+        self._segment_rows = 0
+        self._segment_t_start = None
+        self._segment_count = 0
+        self._callbacks = []        # callbacks of the rows in the current segment
+        super().__init__(max_rows=max_rows, max_bytes=max_bytes, max_latency_s=max_latency_s, verbose=verbose)
+
+    def _open(self, schema):
+        # Starts a new segment ('.parquet.tmp') for rows with schema
+        import os
+        from datetime import datetime, timezone
+        from time import monotonic
+        # pip install pyarrow
+        import pyarrow.parquet as pq
+
+        self._segment_count += 1
+        name = self.prefix + "_" + datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S") + "_" + str(os.getpid()) + "_" + str(self._segment_count) + ".parquet"
+        self._segment = self.path / name
+        self._writer = pq.ParquetWriter(str(self._segment) + ".tmp", schema, compression=self.compression)
+        self._segment_rows = 0
+        self._segment_t_start = monotonic()
+
+    def _complete(self, results):
+        # The callbacks of the rows written to the current segment are held until it is rolled
+        self._call_callbacks([result for result in results if len(result[2]) > 0])
+        self._callbacks += [result for result in results if len(result[2]) == 0]
+
+    def _roll(self):
+        # Closes the current segment, renames it from '.parquet.tmp' to '.parquet' and calls _segment_done()
+        import os
+
+        if self._writer is None: return None
+        callbacks = self._callbacks
+        self._callbacks = []
+        try:
+            self._writer.close()
+            os.replace(str(self._segment) + ".tmp", self._segment)
+        except Exception as e:
+            print("ERROR: ParquetSink segment " + self._segment.name + " " + str(e))
+            self._writer = None
+            self._segment = None
+            self._call_callbacks([(on_success, on_failure, [str(e)]) for on_success, on_failure, errors in callbacks])
+            return None
+        segment = self._segment
+        if self.verbose: print("Parquet segment " + segment.name + " with " + str(self._segment_rows) + " rows")
+        self._writer = None
+        self._segment = None
+        if not self.on_segment is None:
+            try:
+                self.on_segment(segment)
+            except Exception as e:
+                print("ERROR: ParquetSink on_segment " + str(e))
+        self._segment_done(segment, callbacks)
+        return segment
+
+    def _segment_done(self, segment, callbacks):
+        # The rows of segment are durable, so their callbacks are called
+        self._call_callbacks(callbacks)
+
+    def _poll(self):
+        # Rolls the segment once it is max_segment_age_s old, also when no more rows are written to it
+        self.roll(min_age_s=self.max_segment_age_s)
+
+    def roll(self, min_age_s=0.0):
+        """
+        Finishes the current segment if it is at least min_age_s seconds old.
+        Returns the path of the finished segment, or None.
+        """
+        from time import monotonic
+
+        with self._flush_lock:
+            if self._writer is None or monotonic() - self._segment_t_start < min_age_s: return None
+            return self._roll()
+
+    def segments(self):
+        """ Returns the paths of the finished segments, oldest first. """
+        return sorted(self.path.glob(self.prefix + "_*.parquet"))
+
+    def _insert(self, rows, row_ids=None):
+        from time import monotonic
+
+        try:
+            table = rows_to_arrow_table(rows) if isinstance(rows, list) else rows
+            if not self._writer is None:
+                if monotonic() - self._segment_t_start >= self.max_segment_age_s or self._segment_rows >= self.max_segment_rows:
+                    self._roll()
+                elif not table.schema.equals(self._writer.schema):
+                    # The same columns in another order, or without some of the columns, are written as nulls
+                    schema = self._writer.schema
+                    if all(name in schema.names for name in table.schema.names):
+                        try:
+                            import pyarrow as pa
+                            table = pa.table({field.name: table.column(field.name).cast(field.type) if field.name in table.schema.names else pa.nulls(table.num_rows, field.type) for field in schema}, schema=schema)
+                        except Exception:
+                            self._roll()
+                    else:
+                        self._roll()
+            if self._writer is None: self._open(table.schema)
+            self._writer.write_table(table)
+            self._segment_rows += table.num_rows
+            return []
+        except Exception as e:
+            print("ERROR: ParquetSink " + str(e))
+            return [{"index": i, "errors": [str(e)]} for i in range(0, len(rows))]
+
+    def flush(self):
+        """
+        Writes every buffered row, finishes the current segment and calls the callbacks.
+        Returns the number of rows written.
+        """
+        written = self._flush()
+        self.roll()
+        return written
+
+    def write(self):
+        """
+        Writes every buffered row.  The current segment is finished (and the callbacks of its rows called)
+        once it is max_segment_age_s old.  Returns the number of rows written.
+        """
+        written = self._flush()
+        self.roll(min_age_s=self.max_segment_age_s)
+        return written
+
+    def close(self):
+        """ Stops the flush thread, writes the rows still buffered and finishes the current segment. """
+        super().close()
+        with self._flush_lock:
+            self._roll()
+
+
+# ---------------------------------------------------------------------------
+# SQLite sink
+#
+# The table is created from the columns of the first rows (a column is added when a row has a new one),
+# with the primary key (unix_ms, pub_region) of the BigQuery table.  A row that is already in the table
+# is ignored, so a message that is delivered again is not written twice.
+SQLITE_SINK_PATH = "pubsub.sqlite"
+
+
+class SqliteSink(Sink):
+    """
+    Writes the rows to the table table_id of the SQLite database path (see Sink).
+    """
+
+    def __init__(self, path=SQLITE_SINK_PATH, table_id="tbl_pubsub", primary_key=("unix_ms", "pub_region"), max_rows=SINK_BATCH_MAX_ROWS, max_bytes=SINK_BATCH_MAX_BYTES, max_latency_s=SINK_BATCH_MAX_LATENCY_S, verbose=False):
+        self.path = str(path)
+        self.table_id = table_id
+        self.primary_key = tuple(primary_key)
+        self._conn = None
+        self._columns = None
+        super().__init__(max_rows=max_rows, max_bytes=max_bytes, max_latency_s=max_latency_s, verbose=verbose)
+
+    @staticmethod
+    def _column_type(value):
+        if isinstance(value, bool) or isinstance(value, int): return "INTEGER"
+        if isinstance(value, float): return "REAL"
+        return "TEXT"
+
+    def _connect(self):
+        import sqlite3
+
+        # _insert() is called from the flush thread or the thread of flush(), one at a time
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._columns = [row[1] for row in self._conn.execute('PRAGMA table_info("' + self.table_id + '")')]
+
+    def _create_columns(self, rows):
+        # Creates the table, or adds the columns of rows that are not in the table
+        names = list(dict.fromkeys(name for row in rows for name in row))
+        types = {}
+        for row in rows:
+            for name, value in row.items():
+                if not value is None and not name in types: types[name] = self._column_type(value)
+        if len(self._columns) == 0:
+            columns = ['"' + name + '" ' + types.get(name, "TEXT") for name in names]
+            if all(name in names for name in self.primary_key):
+                columns.append("PRIMARY KEY (" + ", ".join('"' + name + '"' for name in self.primary_key) + ")")
+            self._conn.execute('CREATE TABLE IF NOT EXISTS "' + self.table_id + '" (' + ", ".join(columns) + ")")
+            self._columns = names
+        else:
+            for name in names:
+                if not name in self._columns:
+                    self._conn.execute('ALTER TABLE "' + self.table_id + '" ADD COLUMN "' + name + '" ' + types.get(name, "TEXT"))
+                    self._columns.append(name)
+        return names
+
+    def _insert(self, rows, row_ids=None):
+        try:
+            if self._conn is None: self._connect()
+            names = self._create_columns(rows)
+            sql = 'INSERT OR IGNORE INTO "' + self.table_id + '" (' + ", ".join('"' + name + '"' for name in names) + ") VALUES (" + ", ".join("?" * len(names)) + ")"
+            with self._conn:
+                self._conn.executemany(sql, [tuple(row.get(name) for name in names) for row in rows])
+            return []
+        except Exception as e:
+            print("ERROR: SqliteSink " + str(e))
+            return [{"index": i, "errors": [str(e)]} for i in range(0, len(rows))]
+
+    def close(self):
+        """ Stops the flush thread, writes the rows still buffered and closes the database. """
+        super().close()
+        if not self._conn is None:
+            self._conn.close()
+            self._conn = None
+
+
+# ---------------------------------------------------------------------------
+# Multiple sinks
+
+class MultiSink:
+    """
+    Writes the same rows to each of sinks (Sink objects).  Each sink buffers and writes the rows from
+    its own flush thread, and flush() and close() run on every sink in parallel in a thread pool of
+    max_workers threads (one per sink by default).
+
+    add() and add_record_batch() have the arguments of Sink.add() and Sink.add_record_batch().
+    on_success() is called once every sink has written the rows of the message, and on_failure(errors)
+    once every sink has returned if any of them failed.
+
+    stats has the totals of the keys "rows", "requests" and "failed_rows" of the sinks, and "sinks"
+    with the stats of each sink.
+    """
+
+    def __init__(self, sinks=None, max_workers=None, verbose=False):
+        from concurrent.futures import ThreadPoolExecutor
+
+        if sinks is None or len(sinks) == 0: raise Exception("Argument sinks has not been passed")
+        self.sinks = list(sinks)
+        self.verbose = verbose
+        self._executor = ThreadPoolExecutor(max_workers=max_workers if not max_workers is None else len(self.sinks), thread_name_prefix="MultiSink")
+
+    @property
+    def bigquery(self):
+        # True if any of the sinks writes to BigQuery
+        return any(getattr(sink, "bigquery", False) for sink in self.sinks)
+
+    @property
+    def columnar(self):
+        # True if every sink takes record batches
+        return all(getattr(sink, "columnar", False) for sink in self.sinks)
+
+    @property
+    def stats(self):
+        stats = {"rows": 0, "requests": 0, "failed_rows": 0, "sinks": {}}
+        for sink in self.sinks:
+            for key in ["rows", "requests", "failed_rows"]:
+                stats[key] += sink.stats[key]
+            stats["sinks"][type(sink).__name__] = dict(sink.stats)
+        return stats
+
+    def _countdown(self, on_success=None, on_failure=None):
+        # Returns the callback for each sink, that calls on_success() or on_failure(errors) once every sink has called it
+        lock = threading.Lock()
+        state = {"remaining": len(self.sinks), "errors": []}
+
+        def done(errors=None):
+            with lock:
+                if not errors is None: state["errors"] += errors
+                state["remaining"] -= 1
+                if state["remaining"] > 0: return
+            if len(state["errors"]) == 0:
+                if not on_success is None: on_success()
+            else:
+                if not on_failure is None: on_failure(state["errors"])
+        return done
+
+    def add(self, rows=None, on_success=None, on_failure=None, row_ids=None):
+        """ Buffers the rows (list of dictionaries) in each of the sinks. """
+        if rows is None: raise Exception("Argument rows has not been passed")
+
+        done = self._countdown(on_success=on_success, on_failure=on_failure)
+        for sink in self.sinks:
+            sink.add(rows, on_success=done, on_failure=done, row_ids=row_ids)
+
+    def add_record_batch(self, record_batch=None, callbacks=None):
+        """ Buffers the rows of record_batch (a pyarrow.RecordBatch) in each of the sinks, which must all be columnar. """
+        if record_batch is None: raise Exception("Argument record_batch has not been passed")
+        if callbacks is None: raise Exception("Argument callbacks has not been passed")
+        if not self.columnar: raise Exception("MultiSink has a sink that does not take record batches, use add()")
+
+        sink_callbacks = []
+        for n_rows, on_success, on_failure in callbacks:
+            done = self._countdown(on_success=on_success, on_failure=on_failure)
+            sink_callbacks.append((n_rows, done, done))
+        for sink in self.sinks:
+            sink.add_record_batch(record_batch, callbacks=sink_callbacks)
+
+    def flush(self):
+        """
+        Writes every buffered row of each sink, in parallel, and calls the callbacks.
+        Returns the least number of rows written by a sink.
+        """
+        return min(self._executor.map(lambda sink: sink.flush(), self.sinks))
+
+    def write(self):
+        """ Writes every buffered row of each sink (see Sink.write()), in parallel.  Returns the least number of rows written by a sink. """
+        return min(self._executor.map(lambda sink: sink.write(), self.sinks))
+
+    def close(self):
+        """ Closes each of the sinks, in parallel. """
+        list(self._executor.map(lambda sink: sink.close(), self.sinks))
+        self._executor.shutdown()
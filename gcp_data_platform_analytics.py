@@ -34,14 +34,14 @@ import pandas as pd
 # pip install matplotlib
 import matplotlib.pyplot as plt
 
-from api_gcp_bigquery import gcp_bq_table_exists
+from api_gcp_bigquery import gcp_bq_table_exists, gcp_bq_client, gcp_bq_close_clients
 
 
 def get_tbl_data_as_df(project_id=None, dataset_id=None, table_id=None, sql=None, verbose=False):
     from time import sleep
 
-    # Create a BigQuery client
-    client = bigquery.Client(project=project_id)
+    # The shared BigQuery client for the project
+    client = gcp_bq_client(project_id)
 
     # Run the query as a batch job
     job_config = bigquery.QueryJobConfig(
@@ -122,6 +122,8 @@ if __name__ == '__main__':
         
         del df
 
+    gcp_bq_close_clients()
+
     # Read back the datafrom from the Parquet file
     if not path_file.exists(): raise Exception("File doesn't exist: ", path_file)
     print("Reading Parquet file: ", path_file.name)
@@ -0,0 +1,410 @@
+#
+#   Written by:  Mark W Kiehl
+#   http://mechatronicsolutionsllc.com/
+#   http://www.savvysolutions.info/savvycodesolutions/
+
+# Copyright (C) Mechatroinc Solutions LLC
+# License:  MIT
+
+
+# Define the script version in terms of Semantic Versioning (SemVer)
+# when Git or other versioning systems are not employed.
+__version__ = "0.0.0"
+from pathlib import Path
+print("'" + Path(__file__).stem + ".py'  v" + __version__)
+
+
+"""
+
+Benchmarks for the data platform publisher and subscriber.
+
+The benchmarks use fake Google Cloud clients that simulate network latency with sleep(),
+so they run offline and do not incur any charges.
+
+"""
+
+# pip install numpy
+
+from time import sleep, perf_counter
+
+
+# ---------------------------------------------------------------------------
+# Fake Google Pub/Sub publisher
+
+# Simulated latencies in seconds
+FAKE_CHANNEL_SETUP_S = 0.030        # gRPC channel creation + TLS handshake for a new client
+FAKE_RPC_S = 0.010                  # One round trip to the Pub/Sub service
+
+
+class FakeTopic:
+    def __init__(self, name):
+        self.name = name
+        self.state = 1
+        self.message_retention_duration = None
+
+
+class FakeFuture:
+    def __init__(self, result):
+        self._result = result
+
+    def result(self, timeout=None):
+        return self._result
+
+    def exception(self, timeout=None):
+        return None
+
+    def add_done_callback(self, callback):
+        callback(self)
+
+
+class FakePublisherClient:
+    """
+    Minimal stand-in for google.cloud.pubsub_v1.PublisherClient.
+    Every RPC sleeps for FAKE_RPC_S and a new client sleeps for FAKE_CHANNEL_SETUP_S.
+    """
+
+    def __init__(self, topics=None, **kwargs):
+        sleep(FAKE_CHANNEL_SETUP_S)
+        self.topics = topics if topics is not None else []
+        self.published = []
+
+    @staticmethod
+    def topic_path(project_id, topic_id):
+        return "projects/" + project_id + "/topics/" + topic_id
+
+    def list_topics(self, request=None, timeout=None):
+        sleep(FAKE_RPC_S)
+        return [FakeTopic(name) for name in self.topics]
+
+    def get_topic(self, request=None, timeout=None):
+        sleep(FAKE_RPC_S)
+        if request["topic"] not in self.topics: raise Exception("404 Resource not found (resource=" + request["topic"] + ").")
+        return FakeTopic(request["topic"])
+
+    def publish(self, topic, data, **attrs):
+        sleep(FAKE_RPC_S)
+        self.published.append(data)
+        return FakeFuture(str(len(self.published)))
+
+    def stop(self):
+        pass
+
+
+# ---------------------------------------------------------------------------
+
+
+def benchmark_publisher_pool(messages=50, verbose=True):
+    """
+    Reports the per-message publish latency of the previous send_data_packet_to_gcp_pub()
+    (new client + list every topic + new client + publish) against the pooled publisher.
+    """
+
+    from api_gcp_pub_sub import create_data_packet, gcp_pubsub_get_publisher, gcp_pubsub_close_publishers
+    from gcp_data_platform_pub import send_data_packet_to_gcp_pub
+
+    project_id = "benchmark-project"
+    topic_id = "benchmark_topic"
+    topics = [FakePublisherClient.topic_path(project_id, t) for t in ["topic_a", "topic_b", topic_id]]
+
+    def fake_publisher(**kwargs):
+        # kwargs as passed by gcp_pubsub_get_publisher() (e.g. publisher_options)
+        return FakePublisherClient(topics=topics, **kwargs)
+
+    def send_unpooled(region):
+        # The send path before the publisher pool, for comparison
+        exists = False
+        for topic in fake_publisher().list_topics(request={"project": "projects/" + project_id}):
+            if topic.name.split("/")[-1] == topic_id: exists = True
+        if not exists: raise Exception("Topic '" + topic_id + "' for project '" + project_id + "' does not exist!")
+        publisher = fake_publisher()
+        topic_path = publisher.topic_path(project_id, topic_id)
+        future = publisher.publish(topic=topic_path, data=create_data_packet(channels=5, source=region), attrs="{}")
+        return True, future.result()
+
+    t_start = perf_counter()
+    for i in range(0, messages):
+        send_unpooled("us-east4")
+    ms_before = (perf_counter() - t_start) * 1000.0 / messages
+
+    gcp_pubsub_close_publishers()
+    gcp_pubsub_get_publisher(project_id=project_id, topic_id=topic_id, publisher_factory=fake_publisher)
+    t_start = perf_counter()
+    for i in range(0, messages):
+        send_data_packet_to_gcp_pub(project_id=project_id, topic_id=topic_id, region="us-east4", verbose=False)
+    ms_after = (perf_counter() - t_start) * 1000.0 / messages
+    gcp_pubsub_close_publishers()
+
+    if verbose:
+        print("\nPublisher pool (" + str(messages) + " messages, fake RPC " + str(FAKE_RPC_S*1000.0) + " ms, fake channel setup " + str(FAKE_CHANNEL_SETUP_S*1000.0) + " ms)")
+        print("\tper message before: " + str(round(ms_before,2)) + " ms")
+        print("\tper message after:  " + str(round(ms_after,2)) + " ms")
+        print("\tspeedup:            " + str(round(ms_before/ms_after,1)) + "x")
+
+    return ms_before, ms_after
+
+
+def benchmark_create_data_packets(n=20000, channels=[5, 64], verbose=True):
+    """
+    Reports the time to create n data packets with create_data_packet() (one at a time)
+    against create_data_packets() (vectorized).
+    """
+
+    from api_gcp_pub_sub import create_data_packet, create_data_packets
+
+    results = []
+    if verbose: print("\nData packet creation (" + str(n) + " packets)")
+    for ch in channels:
+        t_start = perf_counter()
+        for i in range(0, n):
+            create_data_packet(channels=ch, source="us-east4")
+        us_before = (perf_counter() - t_start) * 1e6 / n
+
+        t_start = perf_counter()
+        create_data_packets(n=n, channels=ch, source="us-east4")
+        us_after = (perf_counter() - t_start) * 1e6 / n
+
+        results.append((ch, us_before, us_after))
+        if verbose: print("\t" + str(ch) + " channels:\tcreate_data_packet() " + str(round(us_before,2)) + " us/packet\tcreate_data_packets() " + str(round(us_after,2)) + " us/packet\t" + str(round(us_before/us_after,1)) + "x")
+
+    return results
+
+
+def benchmark_compression(n=200, channels=[5, 64, 1024], packet_types=["JSON", "F32"], content_encodings=["zlib", "lzma"], verbose=True):
+    """
+    Reports the compression ratio against the compress and decompress CPU time per data packet
+    for each number of channels, packet type and content encoding.
+    """
+
+    from datetime import datetime, timezone, timedelta
+    from time import time
+    # pip install numpy
+    import numpy as np
+    from api_gcp_pub_sub import data_packet_payloads, encode_data_packet, compress_data_packet, decompress_data_packet
+
+    def distinct_packets(ch, packet_type):
+        # create_data_packets() repeats the 'poly' value for channels 9 and up, which compresses far better
+        # than real readings.  Give each of those channels its own value instead.
+        datetime_created = datetime.now(tz=timezone.utc)
+        unix_ms = time() * 1000.0 + np.arange(n, dtype=np.float64)
+        payloads = data_packet_payloads(unix_ms=unix_ms, channels=ch)
+        if ch > 9: payloads[:, 9:] = np.sin(payloads[:, :1] * np.arange(10, ch+1, dtype=np.float64))
+        return [
+            encode_data_packet({"datetime_created": datetime_created + timedelta(milliseconds=i), "unix_ms": u, "pub_region": "us-east4", "payload": payloads[i].tolist()}, packet_type=packet_type)
+            for i, u in enumerate(unix_ms.tolist())
+        ]
+
+    results = []
+    if verbose:
+        print("\nData packet compression (" + str(n) + " packets, distinct channel values)")
+        print("\tchannels\tpacket_type\tencoding\tbytes\tcompressed\tratio\tcompress us\tdecompress us")
+    for ch in channels:
+        for packet_type in packet_types:
+            packets = distinct_packets(ch, packet_type)
+            raw_bytes = sum(len(p) for p in packets)
+            for content_encoding in content_encodings:
+                t_start = perf_counter()
+                compressed = [compress_data_packet(p, content_encoding=content_encoding, min_bytes=0) for p in packets]
+                us_compress = (perf_counter() - t_start) * 1e6 / n
+
+                t_start = perf_counter()
+                for data, encoding in compressed:
+                    decompress_data_packet(data, content_encoding=encoding)
+                us_decompress = (perf_counter() - t_start) * 1e6 / n
+
+                compressed_bytes = sum(len(data) for data, encoding in compressed)
+                ratio = raw_bytes / compressed_bytes
+                results.append((ch, packet_type, content_encoding, raw_bytes/n, compressed_bytes/n, ratio, us_compress, us_decompress))
+                if verbose: print("\t" + str(ch) + "\t\t" + packet_type + "\t\t" + content_encoding + "\t\t" + str(round(raw_bytes/n)) + "\t" + str(round(compressed_bytes/n)) + "\t\t" + str(round(ratio,2)) + "\t" + str(round(us_compress,1)) + "\t\t" + str(round(us_decompress,1)))
+
+    return results
+
+
+def benchmark_decode(n=2000, channels=[5, 1000], packet_types=["JSON", "JSON_ENVELOPE", "F64"], verbose=True):
+    """
+    Reports the subscriber decode time per message (data packet to BigQuery rows) of the previous
+    decoder (json.loads, strptime, strftime and "Channel_" + str(i+1) per row) against gcp_pubsub_decode_msg_rows().
+    """
+
+    from datetime import datetime, timezone
+    import json
+    from time import mktime
+    from api_gcp_pub_sub import create_data_packets, decode_data_packet, PACKET_TYPE_ATTRIBUTE, JSON_BACKEND
+    from gcp_data_platform_sub import gcp_pubsub_decode_msg_rows
+
+    def decode_before(data, attributes):
+        # The decoder before the schema-driven one, for comparison
+        attrs = json.loads(attributes['attrs'])
+        packet_type = attributes.get(PACKET_TYPE_ATTRIBUTE, 'JSON')
+        if packet_type == 'JSON':
+            packet = json.loads(data)
+            packet["datetime_created"] = datetime.strptime(packet["datetime_created"], "%Y-%m-%dT%H:%M:%S.%f%z")
+            packet["payload"] = json.loads(packet["payload"])
+        elif packet_type == 'JSON_ENVELOPE':
+            d = json.loads(data)
+            packet = [{"datetime_created": datetime.strptime(t, "%Y-%m-%dT%H:%M:%S.%f%z"), "unix_ms": u, "pub_region": d["pub_region"], "payload": payload} for t, u, payload in zip(d["datetime_created"], d["unix_ms"], d["payload"])]
+        else:
+            packet = decode_data_packet(data, packet_type=packet_type)
+        if not isinstance(packet, list): packet = [packet]
+        unix_ms_now = mktime(datetime.now(tz=timezone.utc).timetuple()) * 1000
+        rows = []
+        for sample in packet:
+            row = {'pub_region': sample['pub_region'], 'datetime_created': sample['datetime_created'].strftime("%Y-%m-%dT%H:%M:%S.%f"), 'unix_ms': sample['unix_ms'], 'msg_trip_s': (unix_ms_now - sample['unix_ms'])/1000.0}
+            for i in range(0,len(sample['payload'])):
+                row["Channel_" + str(i+1)] = sample['payload'][i]
+            rows.append(row)
+        return rows
+
+    results = []
+    if verbose:
+        print("\nSubscriber decode, message to BigQuery rows (" + str(n) + " messages, JSON backend " + JSON_BACKEND + ")")
+        print("\tchannels\tpacket_type\tbefore us\tafter us\tspeedup")
+    for ch in channels:
+        for packet_type in packet_types:
+            if packet_type == 'JSON_ENVELOPE':
+                # 10 samples per message
+                packets = create_data_packets(n=n, channels=ch, source="us-east4", packet_type=packet_type, samples=10)
+            else:
+                packets = create_data_packets(n=n, channels=ch, source="us-east4", packet_type=packet_type)
+            attributes = {"attrs": json.dumps({"business": "Mechatronic Solutions LLC", "unix_ms": 1679828219121}), PACKET_TYPE_ATTRIBUTE: packet_type}
+
+            t_start = perf_counter()
+            for data in packets:
+                decode_before(data, attributes)
+            us_before = (perf_counter() - t_start) * 1e6 / n
+
+            t_start = perf_counter()
+            for data in packets:
+                gcp_pubsub_decode_msg_rows(data=data, attributes=attributes, verbose=False)
+            us_after = (perf_counter() - t_start) * 1e6 / n
+
+            results.append((ch, packet_type, us_before, us_after))
+            if verbose: print("\t" + str(ch) + "\t\t" + packet_type + ("\t" if len(packet_type) < 8 else "") + "\t" + str(round(us_before,1)) + "\t\t" + str(round(us_after,1)) + "\t\t" + str(round(us_before/us_after,1)) + "x")
+
+    return results
+
+
+def benchmark_record_batch(n=2000, channels=[5, 1000], packet_types=["JSON", "F64_ENVELOPE"], verbose=True):
+    """
+    Reports the time per message to decode n messages into a dictionary per row (gcp_pubsub_decode_msg_rows())
+    against one pyarrow.RecordBatch (gcp_pubsub_msgs_to_record_batch()).
+    """
+
+    from types import SimpleNamespace
+    from api_gcp_pub_sub import create_data_packets, PACKET_TYPE_ATTRIBUTE
+    from gcp_data_platform_sub import gcp_pubsub_decode_msg_rows, gcp_pubsub_msgs_to_record_batch
+
+    results = []
+    if verbose:
+        print("\nMessages to rows against a record batch (" + str(n) + " messages)")
+        print("\tchannels\tpacket_type\trows us\t\tbatch us\tspeedup")
+    for ch in channels:
+        for packet_type in packet_types:
+            samples = 10 if packet_type.endswith("_ENVELOPE") else 1
+            packets = create_data_packets(n=n, channels=ch, source="us-east4", packet_type=packet_type, samples=samples)
+            messages = [SimpleNamespace(data=data, attributes={"attrs": "{}", PACKET_TYPE_ATTRIBUTE: packet_type}) for data in packets]
+
+            t_start = perf_counter()
+            rows = []
+            for message in messages:
+                rows += gcp_pubsub_decode_msg_rows(data=message.data, attributes=message.attributes, verbose=False)
+            us_rows = (perf_counter() - t_start) * 1e6 / n
+
+            t_start = perf_counter()
+            gcp_pubsub_msgs_to_record_batch(messages)
+            us_batch = (perf_counter() - t_start) * 1e6 / n
+
+            results.append((ch, packet_type, us_rows, us_batch))
+            if verbose: print("\t" + str(ch) + "\t\t" + packet_type + ("\t" if len(packet_type) < 8 else "") + "\t" + str(round(us_rows,1)) + "\t\t" + str(round(us_batch,1)) + "\t\t" + str(round(us_rows/us_batch,1)) + "x")
+
+    return results
+
+
+def benchmark_storage_write(rows=50, verbose=True):
+    """
+    Checks BqStorageWriteSink offline against FakeWriteStream: one batch of rows messages (one row each)
+    is written per case, after forcing the append failure of the case.  The rows written and the acks and
+    nacks are compared with the expected ones, and an exception is raised if any case does not match.
+    """
+
+    from google.cloud import bigquery
+    from api_gcp_bigquery import BqStorageWriteSink, FakeWriteStream
+
+    schema = [bigquery.SchemaField("id", "STRING"), bigquery.SchemaField("datetime_created", "TIMESTAMP"), bigquery.SchemaField("Channel_1", "FLOAT")]
+    streams = []
+
+    def stream_factory(descriptor_proto, message_class):
+        streams.append(FakeWriteStream(message_class))
+        return streams[-1]
+
+    def lost_row(stream):
+        stream.rows.pop()
+
+    def foreign_row(stream):
+        stream.rows.append(stream.message_class())
+
+    # (case, forced failure, rows written, new stream)
+    cases = [
+        ("append", None, True, False),
+        ("append retried", lambda stream: setattr(stream, "fail_appends", 1), True, False),
+        ("response lost (ALREADY_EXISTS)", lambda stream: setattr(stream, "lose_responses", 1), True, False),
+        ("append failed", lambda stream: setattr(stream, "fail_appends", 10), False, True),
+        ("foreign rows (ALREADY_EXISTS)", foreign_row, False, True),
+        ("rows lost (OUT_OF_RANGE)", lost_row, False, True),
+    ]
+
+    sink = BqStorageWriteSink(project_id="project", dataset_id="dataset", table_id="table", schema=schema, stream_factory=stream_factory, max_rows=rows*10, max_latency_s=3600.0)
+    sink.add([{"id": "first", "datetime_created": "2024-09-20T11:31:38.520109+00:00", "Channel_1": 0.0}])
+    sink.flush()
+
+    results = []
+    if verbose:
+        print("\nStorage Write API sink against FakeWriteStream (" + str(rows) + " rows per case)")
+        print("\tcase\t\t\t\tappends\toffset\tacks\tnacks\tstreams\tresult")
+    for i, (case, fail, written, new_stream) in enumerate(cases):
+        stream = streams[-1]
+        n_streams = len(streams)
+        rows_before = len(stream.rows)
+        appends_before = stream.appends
+        if not fail is None: fail(stream)
+        ids = [str(i) + "_" + str(j) for j in range(0, rows)]
+        acks = []
+        nacks = []
+        for row_id in ids:
+            sink.add([{"id": row_id, "datetime_created": "2024-09-20T11:31:38.520109+00:00", "Channel_1": float(i)}], on_success=lambda row_id=row_id: acks.append(row_id), on_failure=lambda errors, row_id=row_id: nacks.append(row_id))
+        sink.flush()
+
+        stream_ids = [row.id for row in stream.rows]
+        ok = (acks == (ids if written else []) and nacks == ([] if written else ids)
+              and (stream_ids.count(ids[0]) == 1) == written and len(set(stream_ids)) == len(stream_ids)
+              and (sink.stream is None) == new_stream and (not written or sink.offset == len(stream.rows)))
+        if new_stream:
+            # The next add() opens a new stream at offset 0
+            sink.add([{"id": "first" + str(i), "datetime_created": "2024-09-20T11:31:38.520109+00:00", "Channel_1": 0.0}])
+            sink.flush()
+            ok = ok and len(streams) == n_streams + 1 and sink.offset == 1
+        results.append((case, stream.appends - appends_before, rows_before, len(acks), len(nacks), len(streams), ok))
+        if verbose: print("\t" + case + "\t" * max(1, 4 - len(case) // 8) + str(stream.appends - appends_before) + "\t" + str(rows_before) + "\t" + str(len(acks)) + "\t" + str(len(nacks)) + "\t" + str(len(streams)) + "\t" + ("ok" if ok else "FAILED"))
+
+    sink.close()
+    failed = [case for case, appends, offset, n_acks, n_nacks, n_streams, ok in results if not ok]
+    if len(failed) > 0: raise Exception("BqStorageWriteSink failed the cases " + str(failed))
+    return results
+
+
+
+if __name__ == '__main__':
+    pass
+
+    benchmark_publisher_pool()
+
+    benchmark_create_data_packets()
+
+    benchmark_compression()
+
+    benchmark_decode()
+
+    benchmark_record_batch()
+
+    benchmark_storage_write()
+
+    # ---------------------------------------------------------------------------
@@ -22,7 +22,7 @@ Message publisher to Google Pub/Sub Service
 # pip install numpy
 # pip install --upgrade google-cloud-pubsub
 
-from api_gcp_pub_sub import gcp_json_credentials_exist, gcp_pubsub_get_topics, gcp_pubsub_create_topic, create_data_packet
+from api_gcp_pub_sub import gcp_json_credentials_exist, gcp_pubsub_get_publisher, gcp_pubsub_close_publishers, create_data_packet, create_data_packets, publish_many, compress_data_packet, gcp_pubsub_flow_control, gcp_pubsub_publish, gcp_pubsub_publisher_gauges, PublishSpool, PUBLISH_MAX_OUTSTANDING_MESSAGES, PUBLISH_MAX_OUTSTANDING_BYTES, PUBLISH_LIMIT_EXCEEDED_BEHAVIOR, PACKET_TYPE_ATTRIBUTE, CONTENT_ENCODING_ATTRIBUTE, COMPRESS_MIN_BYTES
 from time import sleep, perf_counter
 from savvy_os import savvy_get_os
 from random import randint
@@ -35,56 +35,79 @@ import os
 PROJECT_ID = "data-platform-v1-6"
 TOPIC_ID = "streaming_data_packet_topic"
 
+# Number of data packets published per Google Run Jobs execution (env var GCP_PUBLISH_COUNT)
+PUBLISH_COUNT = 1
+
+# Data packet codec: 'JSON', 'F32', 'F64' or 'ARROW'  (env var GCP_PACKET_TYPE)
+# or an envelope packet type 'JSON_ENVELOPE', 'F32_ENVELOPE', 'F64_ENVELOPE' or 'ARROW_ENVELOPE'
+# holding PACKET_SAMPLES samples per message  (env var GCP_PACKET_SAMPLES)
+PACKET_TYPE = "JSON"
+PACKET_SAMPLES = 1
+
+# Data packet compression: '' (none), 'zlib' or 'lzma'  (env var GCP_CONTENT_ENCODING)
+# Only data packets of at least COMPRESS_MIN_BYTES are compressed  (env var GCP_COMPRESS_MIN_BYTES)
+CONTENT_ENCODING = ""
+
+# Publisher daemon mode  (env var GCP_PUBLISH_MODE="daemon", always used when running locally)
+#   PUBLISH_RATE        target messages per second  (env var GCP_PUBLISH_RATE)   1/120 = one message every 2 minutes
+#   PUBLISH_BURST       messages that may be sent at once after the rate has fallen behind  (env var GCP_PUBLISH_BURST)
+#   PUBLISH_TICK_S      fixed scheduler tick in seconds  (env var GCP_PUBLISH_TICK_S)
+#   PUBLISH_DURATION_S  seconds to run before exiting, 0 = run forever  (env var GCP_PUBLISH_DURATION_S)
+PUBLISH_MODE = ""
+PUBLISH_RATE = 1.0/120.0
+PUBLISH_BURST = 1
+PUBLISH_TICK_S = 0.1
+PUBLISH_DURATION_S = 0.0
+
+# Publisher flow control (backpressure) limits the unacknowledged messages and bytes held by the publisher.
+#   env vars GCP_PUBLISH_MAX_OUTSTANDING_MESSAGES, GCP_PUBLISH_MAX_OUTSTANDING_BYTES and
+#   GCP_PUBLISH_LIMIT_EXCEEDED_BEHAVIOR ("BLOCK", "ERROR" or "IGNORE")
+#   Defaults PUBLISH_MAX_OUTSTANDING_MESSAGES, PUBLISH_MAX_OUTSTANDING_BYTES and PUBLISH_LIMIT_EXCEEDED_BEHAVIOR from api_gcp_pub_sub.py
+
+# Local spool directory for data packets that could not be published, '' = no spool  (env var GCP_PUBLISH_SPOOL_DIR)
+# The publisher daemon spools failed messages and replays them in the background once Pub/Sub can be reached again.
+# Google Run Jobs executions replay the spool (if any) before publishing.
+PUBLISH_SPOOL_DIR = ""
+
 # ---------------------------------------------------------------------------
 
+# Custom metadata sent with every message
+CUSTOM_META_CONTENT = {
+    'business': 'Mechatronic Solutions LLC',
+    'latitude': 40.44127,
+    'longitude': -76.12276,
+}
+
 
-def send_data_packet_to_gcp_pub(project_id=None, topic_id=None, region=None, verbose=True):
+def send_data_packet_to_gcp_pub(project_id=None, topic_id=None, region=None, packet_type='JSON', samples=1, content_encoding=None, compress_min_bytes=COMPRESS_MIN_BYTES, flow_control=None, spool=None, verbose=True):
+    """
+    Publishes one data packet and returns (True, message ID) or (False, None) if it was not published.
+
+    With a PublishSpool (spool), the data packet is appended to the spool if it cannot be published,
+    and the publish is not waited for:  (True, None) is returned once the publisher has accepted the
+    message, and a publish that later fails is spooled from the future's done callback.
+    """
 
-    # pip install --upgrade google-cloud-pubsub
-    from concurrent.futures import TimeoutError
-    from google.cloud import pubsub_v1
     import json
 
     if region is None: raise Exception("The argument 'region' was not passed to the function.")
 
-    # Get a list of topics for the project
-    topics = gcp_pubsub_get_topics(project_id=project_id, verbose=False)
-    #if verbose: print(str(len(topics)) + " topics found for project " + project_id)
-    
-    # Make sure a topic matching topic_id exists
-    exists = False
-    for topic in topics:
-        #if verbose: print("\t", topic.name)
-        topic_name = str(topic.name).split("/")
-        topic_name = topic_name[len(topic_name)-1]
-        if topic_name == topic_id: exists = True
-    
-    if not exists: raise Exception("Topic '" + topic_id + "' for project '" + project_id + "' does not exist!")
-    
-    publisher = pubsub_v1.PublisherClient()
-
-    # The `topic_path` method creates a fully qualified identifier
-    # in the form `projects/{project_id}/topics/{topic_id}`
-    topic_path = publisher.topic_path(project_id, topic_id)
-    #if verbose: print("topic_path: ", topic_path)
-    # topic_path:  projects/data-platform-2024/topics/raw_streaming
-
     # Create a data packet.
     # Note that argument "source" is optional metadata that can be encoded into the packet and should ideally be the REGION for the publisher.
-    data_packet = create_data_packet(channels=5, source=region)
+    data_packet = create_data_packet(packet_type=packet_type, channels=5, source=region, samples=samples)
     if verbose: print(data_packet)
     # {"datetime_created":"2024-09-01T15:37:50.639435+00:00","unix_ms":1725219470000.0,"source":"api_gcp_pub-sub.py","payload":[-8.334515e-39,-3.249203e38,1.0373193e-38,1.98253e38,7.008128e-39]}
 
-    # Create custom metadata as a dictionary
-    custom_meta_content = {
-        'business': 'Mechatronic Solutions LLC',
-        'latitude': 40.44127,
-        'longitude': -76.12276,
-    }
     # NOTE:  All attributes being published to Pub/Sub must be sent as text strings, 
     #        and the attr argument passed to .publish() must be a string, NOT a dictionary. 
     # https://cloud.google.com/pubsub/docs/samples/pubsub-publish-custom-attributes
-    custom_meta_content = json.dumps(custom_meta_content)
+    custom_meta_content = json.dumps(CUSTOM_META_CONTENT)
+
+    # Optionally compress the data packet.  The content-encoding attribute tells the subscriber how to decompress it.
+    # The packet_type attribute tells the subscriber which codec to decode the data packet with.
+    attributes = {"attrs": custom_meta_content, PACKET_TYPE_ATTRIBUTE: packet_type}
+    data_packet, encoding = compress_data_packet(data_packet, content_encoding=content_encoding, min_bytes=compress_min_bytes)
+    if not encoding is None: attributes[CONTENT_ENCODING_ATTRIBUTE] = encoding
 
     # When you publish a message, the client returns a future.  timeout=600 s is default
     # This method may block if LimitExceededBehavior.BLOCK is used in the flow control settings.
@@ -93,14 +116,163 @@ def send_data_packet_to_gcp_pub(project_id=None, topic_id=None, region=None, ver
     # https://cloud.google.com/pubsub/docs/samples/pubsub-publisher-retry-settings
     # https://cloud.google.com/pubsub/docs/publisher
     try: 
-        future = publisher.publish(topic=topic_path, data=data_packet, attrs=custom_meta_content)
+        # Get the long-lived publisher for the topic from the process-wide pool.
+        # The first call creates the client and verifies that the topic exists, later calls reuse both.
+        publisher, topic_path = gcp_pubsub_get_publisher(project_id=project_id, topic_id=topic_id, flow_control=flow_control)
+        #if verbose: print("topic_path: ", topic_path)
+        # topic_path:  projects/data-platform-2024/topics/raw_streaming
+
+        future = gcp_pubsub_publish(publisher, topic_path, data_packet, **attributes)
     except Exception as e:
         print("ERROR: " + str(e))
-        print(future.result())
+        if not spool is None: spool.append(data_packet, attributes)
         return False, None
-    
-    # print("msg #: ", future.result())
-    return True, future.result()
+
+    if not spool is None:
+        def spool_if_failed(f):
+            if not f.exception() is None:
+                print("ERROR: " + str(f.exception()))
+                spool.append(data_packet, attributes)
+        future.add_done_callback(spool_if_failed)
+        return True, None
+
+    try:
+        # print("msg #: ", future.result())
+        return True, future.result()
+    except Exception as e:
+        print("ERROR: " + str(e))
+        return False, None
+
+
+def send_data_packets_to_gcp_pub(project_id=None, topic_id=None, region=None, count=1000, packet_type='JSON', samples=1, content_encoding=None, compress_min_bytes=COMPRESS_MIN_BYTES, flow_control=None, spool=None, verbose=True):
+    """
+    Publishes count data packets to the topic with one batched publish_many() call.
+    Returns (message_ids, failures) from publish_many().
+
+    With a PublishSpool (spool), the data packets that failed are appended to the spool.
+    """
+
+    import json
+
+    if region is None: raise Exception("The argument 'region' was not passed to the function.")
+
+    data_packets = create_data_packets(n=count, channels=5, source=region, packet_type=packet_type, samples=samples)
+    attributes = {"attrs": json.dumps(CUSTOM_META_CONTENT), PACKET_TYPE_ATTRIBUTE: packet_type}
+
+    try:
+        message_ids, failures = publish_many(packets=data_packets, project_id=project_id, topic_id=topic_id, attributes=attributes, content_encoding=content_encoding, compress_min_bytes=compress_min_bytes, flow_control=flow_control, verbose=verbose)
+    except Exception as e:
+        # e.g. the topic could not be reached
+        if spool is None: raise
+        print("ERROR: " + str(e))
+        message_ids, failures = [None] * len(data_packets), [(i, e) for i in range(0, len(data_packets))]
+
+    # The failed data packets are spooled uncompressed with the attributes they were published with
+    if not spool is None:
+        for i, e in failures:
+            spool.append(data_packets[i], attributes)
+
+    return message_ids, failures
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter.
+
+    Tokens accumulate at 'rate' per second up to 'capacity'.  Each message sent consumes one token,
+    so the long term send rate is 'rate' and at most 'capacity' messages are sent at once.
+    """
+
+    def __init__(self, rate=1.0, capacity=1.0):
+        from time import monotonic
+        if rate <= 0.0: raise Exception("Argument rate must be greater than zero.")
+        self.rate = float(rate)
+        self.capacity = max(float(capacity), 1.0)
+        self.tokens = self.capacity         # start full so the first message is sent right away
+        self.t_last = monotonic()
+
+    def refill(self):
+        from time import monotonic
+        t_now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (t_now - self.t_last) * self.rate)
+        self.t_last = t_now
+        return self.tokens
+
+    def take(self, max_tokens=None):
+        """
+        Returns the number of whole tokens taken (at most max_tokens) after refilling the bucket.
+        """
+        n = int(self.refill())
+        if not max_tokens is None: n = min(n, max_tokens)
+        self.tokens -= n
+        return n
+
+
+def run_publisher_daemon(project_id=None, topic_id=None, region=None, rate=PUBLISH_RATE, burst=PUBLISH_BURST, tick_s=PUBLISH_TICK_S, duration_s=PUBLISH_DURATION_S, packet_type='JSON', samples=1, content_encoding=None, compress_min_bytes=COMPRESS_MIN_BYTES, flow_control=None, spool=None, report_s=60.0, verbose=True):
+    """
+    Publishes data packets continuously at 'rate' messages per second until duration_s has elapsed (0 = forever).
+
+    A fixed-rate scheduler wakes every tick_s seconds on an absolute schedule (the send time does not
+    shift the next tick), and a TokenBucket decides how many messages to send on each tick.  Messages
+    that fall behind (slow sends, overrun ticks) are caught up in bursts of up to 'burst' messages.
+    flow_control (see gcp_pubsub_flow_control()) bounds the messages and bytes held by the publisher.
+    With a PublishSpool (spool), messages that fail are spooled and the sends do not wait for the
+    publish to complete, so a slow or unreachable Pub/Sub service does not hold up the schedule.
+    Returns (messages sent, failures).
+    """
+    from time import monotonic
+
+    if region is None: raise Exception("The argument 'region' was not passed to the function.")
+    if tick_s <= 0.0: raise Exception("Argument tick_s must be greater than zero.")
+
+    # Add one tick worth of tokens to the burst so the fraction of a token left over on each tick
+    # is not clipped by the capacity (the rate would otherwise fall short at low burst values).
+    bucket = TokenBucket(rate=rate, capacity=max(burst, 1) + rate * tick_s)
+    if verbose: print("Publisher daemon: " + str(rate) + " messages/sec, burst " + str(bucket.capacity) + ", tick " + str(tick_s) + " sec, duration " + (str(duration_s) + " sec" if duration_s > 0 else "forever"))
+
+    sent = 0
+    failures = 0
+    t_start = monotonic()
+    t_next_tick = t_start
+    t_next_report = t_start + report_s
+    sent_report = 0
+
+    while duration_s <= 0 or monotonic() - t_start < duration_s:
+        n = bucket.take()
+        if n == 1:
+            try:
+                send_result, msg_no = send_data_packet_to_gcp_pub(project_id=project_id, topic_id=topic_id, region=region, packet_type=packet_type, samples=samples, content_encoding=content_encoding, compress_min_bytes=compress_min_bytes, flow_control=flow_control, spool=spool, verbose=False)
+            except Exception as e:
+                print("ERROR: " + str(e))
+                send_result = False
+            if send_result: sent += 1
+            else: failures += 1
+        elif n > 1:
+            try:
+                message_ids, send_failures = send_data_packets_to_gcp_pub(project_id=project_id, topic_id=topic_id, region=region, count=n, packet_type=packet_type, samples=samples, content_encoding=content_encoding, compress_min_bytes=compress_min_bytes, flow_control=flow_control, spool=spool, verbose=False)
+                sent += n - len(send_failures)
+                failures += len(send_failures)
+            except Exception as e:
+                print("ERROR: " + str(e))
+                failures += n
+
+        t_now = monotonic()
+        if verbose and t_now >= t_next_report:
+            gauges = gcp_pubsub_publisher_gauges(reset_max=True)
+            print("Publisher daemon: " + str(sent) + " messages sent, " + str(failures) + " failures, " + str(round((sent - sent_report) / (t_now - t_next_report + report_s), 2)) + " messages/sec, in flight max " + str(gauges["max_in_flight_messages"]) + " messages / " + str(gauges["max_in_flight_bytes"]) + " bytes" + ("" if spool is None else ", " + str(spool.pending()) + " spooled"))
+            sent_report = sent
+            t_next_report = t_now + report_s
+
+        # Fixed-rate tick on an absolute schedule.  If a send overran one or more ticks, skip them
+        # (the bucket has already accumulated the tokens for the elapsed time).
+        t_next_tick += tick_s
+        if t_next_tick > t_now:
+            sleep(t_next_tick - t_now)
+        else:
+            t_next_tick = t_now
+
+    if verbose: print("Publisher daemon stopped: " + str(sent) + " messages sent, " + str(failures) + " failures in " + str(round(monotonic() - t_start, 1)) + " sec")
+    return sent, failures
 
 
 if __name__ == '__main__':
@@ -124,43 +296,79 @@ if __name__ == '__main__':
   # Allow environment variables to override global project constants
   PROJECT_ID = os.environ.get("GCP_PROJECT_ID",PROJECT_ID)
   TOPIC_ID = os.environ.get("GCP_TOPIC_ID",TOPIC_ID)
+  PUBLISH_COUNT = int(os.environ.get("GCP_PUBLISH_COUNT",PUBLISH_COUNT))
+  PACKET_TYPE = os.environ.get("GCP_PACKET_TYPE",PACKET_TYPE)
+  PACKET_SAMPLES = int(os.environ.get("GCP_PACKET_SAMPLES",PACKET_SAMPLES))
+  CONTENT_ENCODING = os.environ.get("GCP_CONTENT_ENCODING",CONTENT_ENCODING)
+  COMPRESS_MIN_BYTES = int(os.environ.get("GCP_COMPRESS_MIN_BYTES",COMPRESS_MIN_BYTES))
+  PUBLISH_MODE = os.environ.get("GCP_PUBLISH_MODE",PUBLISH_MODE)
+  PUBLISH_RATE = float(os.environ.get("GCP_PUBLISH_RATE",PUBLISH_RATE))
+  PUBLISH_BURST = int(os.environ.get("GCP_PUBLISH_BURST",PUBLISH_BURST))
+  PUBLISH_TICK_S = float(os.environ.get("GCP_PUBLISH_TICK_S",PUBLISH_TICK_S))
+  PUBLISH_DURATION_S = float(os.environ.get("GCP_PUBLISH_DURATION_S",PUBLISH_DURATION_S))
+  PUBLISH_MAX_OUTSTANDING_MESSAGES = int(os.environ.get("GCP_PUBLISH_MAX_OUTSTANDING_MESSAGES",PUBLISH_MAX_OUTSTANDING_MESSAGES))
+  PUBLISH_MAX_OUTSTANDING_BYTES = int(os.environ.get("GCP_PUBLISH_MAX_OUTSTANDING_BYTES",PUBLISH_MAX_OUTSTANDING_BYTES))
+  PUBLISH_LIMIT_EXCEEDED_BEHAVIOR = os.environ.get("GCP_PUBLISH_LIMIT_EXCEEDED_BEHAVIOR",PUBLISH_LIMIT_EXCEEDED_BEHAVIOR)
+  flow_control = gcp_pubsub_flow_control(max_messages=PUBLISH_MAX_OUTSTANDING_MESSAGES, max_bytes=PUBLISH_MAX_OUTSTANDING_BYTES, limit_exceeded_behavior=PUBLISH_LIMIT_EXCEEDED_BEHAVIOR)
+  PUBLISH_SPOOL_DIR = os.environ.get("GCP_PUBLISH_SPOOL_DIR",PUBLISH_SPOOL_DIR)
+  spool = None if PUBLISH_SPOOL_DIR == "" else PublishSpool(spool_dir=PUBLISH_SPOOL_DIR, verbose=True)
 
   print("COMPUTERNAME: " + os.environ.get("COMPUTERNAME","")+ "\n")
 
 
-  if script_running_locally:
-    # This script is running locally, either directly or from within a Docker container, but not via Google Run Jobs.
+  if script_running_locally or PUBLISH_MODE == "daemon":
+    # This script is running locally, either directly or from within a Docker container, but not via Google Run Jobs,
+    # or it was started as a long running publisher (GCP_PUBLISH_MODE=daemon).
 
-    # Publish a message every 2 minutes (120 seconds).
+    # Publish at PUBLISH_RATE messages per second.  The default is one message every 2 minutes (120 seconds)
     # (simulates Scheduler Jobs running and executing a Google Run Jobs running this script)
 
-    while True:
-        t_loop_start = perf_counter()
-
-        send_result, msg_no = send_data_packet_to_gcp_pub(project_id=PROJECT_ID, topic_id=TOPIC_ID, region=gcp_run_jobs_region, verbose=True)
-        if not send_result: 
-            raise Exception("Error sending data packet to " + PROJECT_ID + " | " + TOPIC_ID)
-        else:
-            print("Message # " + str(msg_no) + " successfully sent the data packet for project_id " + PROJECT_ID + ", topic_id " + TOPIC_ID + "")
+    # Replay spooled data packets in the background
+    if not spool is None: spool.start_replayer(project_id=PROJECT_ID, topic_id=TOPIC_ID, flow_control=flow_control)
 
-        #t = randint(30,90)
-        t = 120        # Wait time in seconds between message publishing
-        print("Next message publish in " + str(t) + " sec..\n")
-        sleep(t)     # wait / pause / sleep for t seconds
+    try:
+        run_publisher_daemon(project_id=PROJECT_ID, topic_id=TOPIC_ID, region=gcp_run_jobs_region, rate=PUBLISH_RATE, burst=PUBLISH_BURST, tick_s=PUBLISH_TICK_S, duration_s=PUBLISH_DURATION_S, packet_type=PACKET_TYPE, samples=PACKET_SAMPLES, content_encoding=CONTENT_ENCODING, compress_min_bytes=COMPRESS_MIN_BYTES, flow_control=flow_control, spool=spool, verbose=True)
+    except KeyboardInterrupt:
+        print("Keyboard interrupt stopped script")
 
-        t_loop_elapsed = perf_counter() - t_loop_start
-        print("Loop time " + str(round(t_loop_elapsed,1)) + " sec\n")
+    # Close the pooled publisher (flushes anything still pending, failures are spooled), then the spool
+    if not spool is None: spool.stop_replayer()
+    gcp_pubsub_close_publishers()
+    if not spool is None: spool.close()
 
   else:
     # gcp_json_credentials_exist() == False
     # This script is running from a Docker container via Google Run Jobs.
 
-    # Send data packet to to GCP Pub/Sub once and then exit
-    send_result, msg_no = send_data_packet_to_gcp_pub(project_id=PROJECT_ID, topic_id=TOPIC_ID, region=gcp_run_jobs_region, verbose=True)
-    if not send_result: 
-        raise Exception("Error sending data packet to " + PROJECT_ID + " | " + TOPIC_ID + "\n")
+    # Publish data packets spooled by an earlier execution (PUBLISH_SPOOL_DIR on a persistent volume)
+    if not spool is None: spool.replay(project_id=PROJECT_ID, topic_id=TOPIC_ID, flow_control=flow_control)
+
+    # With a spool, the data packets that fail to publish are spooled for the next execution
+    if PUBLISH_COUNT > 1:
+        # Send PUBLISH_COUNT data packets to GCP Pub/Sub in batches and then exit
+        message_ids, failures = send_data_packets_to_gcp_pub(project_id=PROJECT_ID, topic_id=TOPIC_ID, region=gcp_run_jobs_region, count=PUBLISH_COUNT, packet_type=PACKET_TYPE, samples=PACKET_SAMPLES, content_encoding=CONTENT_ENCODING, compress_min_bytes=COMPRESS_MIN_BYTES, flow_control=flow_control, spool=spool, verbose=True)
+        if len(failures) > 0 and spool is None: 
+            raise Exception(str(len(failures)) + " of " + str(PUBLISH_COUNT) + " data packets failed to send to " + PROJECT_ID + " | " + TOPIC_ID + "\n")
+        elif len(failures) > 0:
+            print("WARNING: " + str(len(failures)) + " of " + str(PUBLISH_COUNT) + " data packets failed to send to " + PROJECT_ID + " | " + TOPIC_ID + " and were spooled\n")
+        else:
+            print(str(PUBLISH_COUNT) + " data packets successfully sent for project_id " + PROJECT_ID + ", topic_id " + TOPIC_ID + " with ack\n")
     else:
-        print("Message # " + str(msg_no) + " successfully sent the data packet for project_id " + PROJECT_ID + ", topic_id " + TOPIC_ID + " with ack\n")
+        # Send data packet to to GCP Pub/Sub once and then exit
+        send_result, msg_no = send_data_packet_to_gcp_pub(project_id=PROJECT_ID, topic_id=TOPIC_ID, region=gcp_run_jobs_region, packet_type=PACKET_TYPE, samples=PACKET_SAMPLES, content_encoding=CONTENT_ENCODING, compress_min_bytes=COMPRESS_MIN_BYTES, flow_control=flow_control, spool=spool, verbose=True)
+        if not send_result and spool is None: 
+            raise Exception("Error sending data packet to " + PROJECT_ID + " | " + TOPIC_ID + "\n")
+        elif not send_result:
+            print("WARNING: the data packet failed to send to " + PROJECT_ID + " | " + TOPIC_ID + " and was spooled\n")
+        elif msg_no is None:
+            # With a spool the publish is not waited for.  If it fails when the publisher is closed below, it is spooled.
+            print("Data packet handed to the publisher for project_id " + PROJECT_ID + ", topic_id " + TOPIC_ID + "\n")
+        else:
+            print("Message # " + str(msg_no) + " successfully sent the data packet for project_id " + PROJECT_ID + ", topic_id " + TOPIC_ID + " with ack\n")
+
+    # Close the pooled publisher (flushes anything still pending, failures are spooled), then the spool
+    gcp_pubsub_close_publishers()
+    if not spool is None: spool.close()
 
 
 
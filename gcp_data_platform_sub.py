@@ -26,8 +26,11 @@ Subscriber to the Google Pub/Sub message service
 # pip install --upgrade google-cloud-bigquery
 from google.cloud import bigquery
 
-from api_gcp_pub_sub import gcp_json_credentials_exist, gcp_pubsub_get_subscriptions
-from api_gcp_bigquery import gcp_bq_table_exists, gcp_bq_row_exists
+from api_gcp_pub_sub import gcp_json_credentials_exist, gcp_pubsub_get_subscriptions, decode_data_packet, decompress_data_packet, decode_data_packet_columns, json_loads, PACKET_EPOCH, PACKET_US, parse_iso_datetime, PubSubAckManager, PACKET_TYPE_ATTRIBUTE, CONTENT_ENCODING_ATTRIBUTE
+from api_gcp_pub_sub import gcp_pubsub_subscriber_flow_control, gcp_pubsub_subscriber_scheduler, gcp_pubsub_decode_pool, SUBSCRIBE_MAX_OUTSTANDING_MESSAGES, SUBSCRIBE_MAX_OUTSTANDING_BYTES, SUBSCRIBE_EXECUTOR_THREADS, SUBSCRIBE_DECODE_PROCESSES
+from api_gcp_bigquery import gcp_bq_client, gcp_bq_close_clients, gcp_bq_table_exists, gcp_bq_row_exists, gcp_bq_rows_exist, gcp_bq_table_exists_cached, gcp_bq_get_table_cached, gcp_bq_invalidate_metadata, gcp_bq_insert_id, BqDedupIndex, DEDUP_WARM_WINDOW_S, BqBatchWriter, BqStorageWriteSink, BQ_BATCH_MAX_ROWS, BQ_BATCH_MAX_BYTES, BQ_BATCH_MAX_LATENCY_S
+from api_gcp_bigquery import BqLoadJobSink, BQ_LOAD_DIR, BQ_LOAD_INTERVAL_S
+from api_sinks import ParquetSink, SqliteSink, MultiSink, PARQUET_SINK_DIR, SQLITE_SINK_PATH
 from savvy_os import savvy_get_os
 import os
 
@@ -41,25 +44,311 @@ SUBSCRIPTION_ID = "streaming_data_packet_subscription"
 DATASET_ID = "ds_data_platform"
 TABLE_ID = "tbl_pubsub"
 
+# How rows are written to BigQuery  (env var GCP_BQ_WRITER)
+#   "batch"     rows from many messages are inserted together by a BqBatchWriter, messages are acked after the insert
+#   "storage_write"  as "batch", but the batches are appended to a Storage Write API committed stream (BqStorageWriteSink)
+#                    with stream offsets instead of the legacy streaming insert_rows_json()
+#   "load_job"  the rows are written to local Parquet segments in BQ_LOAD_DIR that are appended to the table with a
+#               load job every BQ_LOAD_INTERVAL_S (BqLoadJobSink), messages are acked after their segment was loaded.
+#               Load jobs are free (streaming inserts are billed), for high volume feeds that tolerate the latency.
+#               In stream and service mode raise GCP_SUBSCRIBE_MAX_OUTSTANDING_MESSAGES to the messages of an interval.
+#               (env vars GCP_BQ_LOAD_DIR, GCP_BQ_LOAD_INTERVAL_S)
+#   "row"       the rows of each message are inserted with their own request, then the message is acked
+# The batch limits are BQ_BATCH_MAX_ROWS, BQ_BATCH_MAX_BYTES and BQ_BATCH_MAX_LATENCY_S from api_gcp_bigquery.py
+#   (env vars GCP_BQ_BATCH_MAX_ROWS, GCP_BQ_BATCH_MAX_BYTES, GCP_BQ_BATCH_MAX_LATENCY_S)
+BQ_WRITER = "batch"
+
+# Check that each row is not already in the table before it is written  (env var GCP_BQ_CHECK_EXISTS "1" or "0")
+# (with the in-memory BqDedupIndex).  Every row is also given a deterministic insertId, so BigQuery drops
+# the rows of a message that is redelivered shortly after it was written even without this check.
+BQ_CHECK_EXISTS = True
+
+# The dedup index is warmed at startup with the rows written in the last DEDUP_WARM_WINDOW_S seconds
+# (from api_gcp_bigquery.py, env var GCP_DEDUP_WARM_WINDOW_S, 0 = no warm).  It is not warmed for BQ_WRITER "batch" and "row", where
+# the insertIds already drop a redelivered message, so a Run Jobs execution or a supervisor worker
+# does not scan the table each time it starts.
+
+# Where the rows are written  (env var GCP_SINKS, a comma separated list of)
+#   "bigquery"  the BigQuery table, with BQ_WRITER ("batch", "storage_write" or "load_job")
+#   "parquet"   rolling local Parquet files in PARQUET_SINK_DIR  (env var GCP_PARQUET_SINK_DIR)
+#   "sqlite"    the local SQLite database SQLITE_SINK_PATH  (env var GCP_SQLITE_SINK_PATH)
+# "" is the BigQuery table with BQ_WRITER (including "row").  Several sinks are written in parallel by a MultiSink,
+# e.g. "bigquery,parquet" lands a local copy next to the table.  Without "bigquery" the pipeline runs without
+# the BigQuery table (BQ_CHECK_EXISTS is not used).
+SINKS = ""
+
+# How the subscription is read  (env var GCP_PULL_MODE)
+#   "stream"    a streaming pull for timeout_s, messages are processed one at a time by the callback
+#   "drain"     synchronous pulls of PULL_MAX_MESSAGES messages that are processed in bulk, until the
+#               subscription is empty or PULL_DEADLINE_S has elapsed (see gcp_pubsub_drain_subscription())
+#   "service"   one streaming pull that stays open until SIGTERM (or SIGINT), for a long running service
+#               (e.g. Cloud Run service with min instances 1 and CPU always allocated) instead of a scheduled job.
+#               The buffered rows are written and the acks sent before it exits, and an HTTP health
+#               endpoint is served on HEALTH_PORT  (env var GCP_HEALTH_PORT, or PORT as set by Cloud Run)
+#   (env vars GCP_PULL_MAX_MESSAGES, GCP_PULL_DEADLINE_S, GCP_PULL_TIMEOUT_S, GCP_PULL_ACK_DEADLINE_S)
+PULL_MODE = "stream"
+PULL_MAX_MESSAGES = 1000
+PULL_DEADLINE_S = 540.0         # Less than the Cloud Run job task timeout (default 10 min)
+PULL_TIMEOUT_S = 5.0            # Per pull, a pull that times out (or returns nothing) means the subscription is drained
+PULL_ACK_DEADLINE_S = 600.0     # Ack deadline set for the messages held by the sink until their rows are durable (10 to 600 s)
+HEALTH_PORT = 8080
+
+# Number of subscriber worker processes in "service" mode  (env var GCP_SUBSCRIBE_WORKERS).
+# With more than 1, a supervisor process starts the workers (each with its own streaming pull on the
+# subscription), restarts the ones that exit and serves the health endpoint with their combined metrics.
+# Use one worker per core when decoding limits a single process to one core.
+SUBSCRIBE_WORKERS = 1
+
+# Subscriber concurrency, defaults from api_gcp_pub_sub.py  (env vars GCP_SUBSCRIBE_MAX_OUTSTANDING_MESSAGES,
+# GCP_SUBSCRIBE_MAX_OUTSTANDING_BYTES, GCP_SUBSCRIBE_EXECUTOR_THREADS, GCP_SUBSCRIBE_DECODE_PROCESSES).
+# Set GCP_SUBSCRIBE_DECODE_PROCESSES to the number of cores to decode large messages in worker processes.
+
 # PROJECT_ID,topic_id,dataset_id,table_id
 # ---------------------------------------------------------------------------
 
 
 
-def gcp_write_pubsub_msg_to_bq(project_id=None, dataset_id=None, table_id=None, message=None, verbose=True):
-    """"
-    Returns True if successful.
+# Column names of the channels, cached by the number of channels
+_channel_columns = {}
+
+
+def channel_columns(channels=0):
+    """ Returns the tuple of BigQuery column names 'Channel_1' .. 'Channel_<channels>'. """
+    columns = _channel_columns.get(channels)
+    if columns is None:
+        columns = tuple("Channel_" + str(i+1) for i in range(0, channels))
+        _channel_columns[channels] = columns
+    return columns
 
-    Decodes the Google Pub/Sub message and writes inserts a new record into
-    the Google BigQuery database.
 
+def _row_datetime(datetime_created):
+    # Returns the 'datetime_created' column ('%Y-%m-%dT%H:%M:%S.%f', without the UTC offset) from
+    # the ISO string of a JSON packet, or the datetime of the other codecs.
+    if isinstance(datetime_created, str):
+        # '2024-09-20T11:31:38.520109+0000' is already in the format, without the offset
+        if len(datetime_created) == 31 and datetime_created[19] == "." and datetime_created[26] in "+-": return datetime_created[:26]
+        datetime_created = parse_iso_datetime(datetime_created)
+    return datetime_created.isoformat(timespec="microseconds")[:26]
+
+
+def gcp_pubsub_decode_msg_rows(data=None, attributes=None, verbose=True):
     """
+    Decodes the data and attributes of a Google Pub/Sub message and returns the list of rows
+    (dictionaries) for the Google BigQuery table, one per sample.
 
-    from datetime import datetime, timezone
-    import json
-    from google.cloud import bigquery
+    Only bytes and a dictionary are passed (not the message), so this can run in a
+    worker process of gcp_pubsub_decode_pool().
+
+    The 'JSON' and 'JSON_ENVELOPE' packets are decoded here directly into the rows (with json_loads(),
+    and the datetime_created string is used as it is), the other packet types with decode_data_packet().
+    The channel column names come from channel_columns().
+    """
+
+    from time import perf_counter, time
+
+    if data is None: raise Exception("Argument data has not been passed")
+    if attributes is None: raise Exception("Argument attributes has not been passed")
+
+    t_start_sec = perf_counter()
+    # The metadata within the message (attributes['attrs'], a JSON string) is not used for the rows,
+    # so it is not decoded:
+    # attrs: {"business":"Mechatronic Solutions LLC","latitude":40.44127,"longitude":-76.12276,"unix_ms":1679828219121,"time":"2023-03-26T10:58:59+0000", "source"}
+
+    # Decompress message.data if the publisher compressed it (content-encoding attribute)
+    data = decompress_data_packet(data, content_encoding=attributes.get(CONTENT_ENCODING_ATTRIBUTE))
+
+    # Decode the data packet with the codec named by the packet_type attribute ('JSON' if not present)
+    # into (datetime_created, unix_ms, pub_region, payload) for each sample
+    packet_type = attributes.get(PACKET_TYPE_ATTRIBUTE, 'JSON')
+    if packet_type == 'JSON':
+        packet = json_loads(data)
+        # The payload is a JSON string of a list nested inside the JSON packet
+        samples = [(packet['datetime_created'], packet['unix_ms'], packet['pub_region'], json_loads(packet['payload']))]
+    elif packet_type == 'JSON_ENVELOPE':
+        packet = json_loads(data)
+        pub_region = packet['pub_region']
+        samples = [(d, u, pub_region, payload) for d, u, payload in zip(packet['datetime_created'], packet['unix_ms'], packet['payload'])]
+    else:
+        packets = decode_data_packet(data, packet_type=packet_type)
+        # A dictionary, or a list of dictionaries (one per sample) for an envelope packet type
+        if not isinstance(packets, list): packets = [packets]
+        samples = [(p['datetime_created'], p['unix_ms'], p['pub_region'], p['payload']) for p in packets]
+
+    # Calculate the message send/receive time
+    unix_ms_now = time() * 1000
+
+    rows = []
+    for datetime_created, unix_ms, pub_region, payload in samples:
+        elapsed_ms = unix_ms_now - unix_ms
+        row = {'pub_region': pub_region, 
+                'datetime_created': _row_datetime(datetime_created), 
+                'unix_ms': unix_ms,
+                'msg_trip_s': elapsed_ms/1000.0,
+                }
+        row.update(zip(channel_columns(len(payload)), payload))
+        rows.append(row)
+        #print("row:", row)  # {'pub_region': 'us-east4', 'datetime_created': '2024-09-20T11:31:38.520109', 'unix_ms': 1726846298000.0, 'Channel_1': 0.1726846298, 'Channel_2': 0.17182766645607023, 'Channel_3': 0.20854329490139709, 'Channel_4': 0.8513872227333332, 'Channel_5': 3.453692596}
+
+    t_elapsed_sec = perf_counter() - t_start_sec
+    if verbose and len(rows) > 0:
+        # Report the message send/receive time
+        print("Message send/receive time: " + str(round(elapsed_ms/1000.0,1)) + " sec round trip including Scheduler Run Jobs interval delay")
+        # Report the script execution time
+        print("Callback message processing elapsed time " + str(round(t_elapsed_sec,3)) + " sec for " + str(len(rows)) + " sample(s)")
+
+    for row in rows:
+        row['msg_proc_s'] = t_elapsed_sec
+
+    return rows
+
+
+# ---------------------------------------------------------------------------
+# Columnar batch builder
+#
+# gcp_pubsub_msgs_to_record_batch() decodes many messages into one pyarrow.RecordBatch with the columns
+# of the table, so a sink (BigQuery, Parquet, a local database) gets one columnar batch instead of a
+# dictionary per row.  The channels are contiguous float64 arrays.  gcp_write_pubsub_msgs_to_sink() passes
+# the batch to a columnar sink (ParquetSink, BqLoadJobSink) in drain mode.
+# Only the messages of the COLUMNAR_PACKET_TYPES are decoded into a record batch:  for the single sample
+# 'JSON' (and 'ARROW') packets and 'JSON_ENVELOPE' the dictionaries of gcp_pubsub_decode_msg_rows() are as
+# fast or faster, and a record batch of a single message (the streaming callback) is always slower.
+COLUMNAR_PACKET_TYPES = ["F32", "F64", "F32_ENVELOPE", "F64_ENVELOPE", "ARROW_ENVELOPE"]
+
+def gcp_pubsub_msgs_to_record_batch(messages=None, channels=None, verbose=False):
+    """
+    Decodes the Google Pub/Sub messages (objects with .data and .attributes) and returns
+    (record_batch, rows_per_message).
+
+    record_batch is a pyarrow.RecordBatch with one row per sample and the columns
+        unix_ms int64, pub_region string, datetime_created timestamp[us, UTC], msg_trip_s float64,
+        msg_proc_s float64 (decode time of the batch per message), Channel_1 .. Channel_<channels> float64
+    channels is the number of channel columns (the most channels of any message if None).  A message
+    with fewer channels has nulls in the other channel columns.
+
+    rows_per_message[i] is the number of rows from messages[i], or None if it could not be decoded
+    (it has no rows in record_batch).
+    """
+    from time import perf_counter, time
+    # pip install numpy
     import numpy as np
-    from time import mktime, perf_counter
+    # pip install pyarrow
+    import pyarrow as pa
+
+    if messages is None: raise Exception("Argument messages has not been passed")
+
+    t_start_sec = perf_counter()
+    decoded = []
+    rows_per_message = []
+    # Consecutive 'JSON' packets (one sample each) are collected as Python lists and converted to
+    # arrays together, rather than a few small arrays per message
+    json_packets = {"datetime_created": [], "unix_ms": [], "pub_region": [], "payload": []}
+
+    def add_json_packets():
+        if len(json_packets["unix_ms"]) == 0: return
+        decoded.append({
+            "datetime_created_us": (np.array([d[:26] for d in json_packets["datetime_created"]], dtype="datetime64[us]").astype(np.int64)
+                                    if all(len(d) == 31 and d.endswith("+0000") for d in json_packets["datetime_created"])
+                                    else np.array([(parse_iso_datetime(d) - PACKET_EPOCH) // PACKET_US for d in json_packets["datetime_created"]], dtype=np.int64)),
+            "unix_ms": np.array(json_packets["unix_ms"], dtype=np.float64),
+            "pub_region": json_packets["pub_region"],
+            "payload": np.array(json_packets["payload"], dtype=np.float64) if len(set(map(len, json_packets["payload"]))) == 1 else None,
+            "payloads": json_packets["payload"],
+        })
+        for key in json_packets: json_packets[key] = []
+
+    for message in messages:
+        try:
+            data = decompress_data_packet(message.data, content_encoding=message.attributes.get(CONTENT_ENCODING_ATTRIBUTE))
+            packet_type = message.attributes.get(PACKET_TYPE_ATTRIBUTE, 'JSON')
+            if packet_type == 'JSON':
+                packet = json_loads(data)
+                # The payload is a JSON string of a list nested inside the JSON packet
+                payload = json_loads(packet["payload"])
+                json_packets["datetime_created"].append(packet["datetime_created"])
+                json_packets["unix_ms"].append(packet["unix_ms"])
+                json_packets["pub_region"].append(packet["pub_region"])
+                json_packets["payload"].append(payload)
+                rows_per_message.append(1)
+                continue
+            columns = decode_data_packet_columns(data, packet_type=packet_type)
+        except Exception as e:
+            print("ERROR: message # " + str(getattr(message, "message_id", "")) + " could not be decoded " + str(e))
+            rows_per_message.append(None)
+            continue
+        add_json_packets()
+        decoded.append(columns)
+        rows_per_message.append(len(columns["unix_ms"]))
+    add_json_packets()
+
+    # The JSON packets with a different number of channels are padded
+    for columns in decoded:
+        if "payloads" in columns and columns["payload"] is None:
+            ch = max(map(len, columns["payloads"]))
+            columns["payload"] = np.array([p + [np.nan] * (ch - len(p)) for p in columns["payloads"]], dtype=np.float64)
+            columns["missing"] = np.array([[False] * len(p) + [True] * (ch - len(p)) for p in columns["payloads"]], dtype=bool)
+
+    if channels is None: channels = max([columns["payload"].shape[1] for columns in decoded], default=0)
+    samples = sum(len(columns["unix_ms"]) for columns in decoded)
+
+    # The payload is transposed to (channels, samples) so that each channel column is a contiguous array
+    missing = None
+    if samples > 0 and all(columns["payload"].shape[1] == channels for columns in decoded):
+        payload = np.ascontiguousarray(np.concatenate([columns["payload"] for columns in decoded]).T)
+    else:
+        payload = np.zeros((channels, samples), dtype=np.float64)
+        row = 0
+        for columns in decoded:
+            n, ch = columns["payload"].shape
+            if ch > channels: raise Exception("A message has " + str(ch) + " channels, more than channels " + str(channels))
+            payload[0:ch, row:row+n] = columns["payload"].T
+            if ch < channels or "missing" in columns:
+                if missing is None: missing = np.zeros((channels, samples), dtype=bool)
+                missing[ch:channels, row:row+n] = True
+                if "missing" in columns: missing[0:ch, row:row+n] = columns["missing"].T
+            row += n
+
+    if samples > 0:
+        unix_ms = np.concatenate([columns["unix_ms"] for columns in decoded])
+        datetime_created_us = np.concatenate([columns["datetime_created_us"] for columns in decoded])
+    else:
+        unix_ms = np.zeros(0, dtype=np.float64)
+        datetime_created_us = np.zeros(0, dtype=np.int64)
+    # One pub_region per row
+    pub_region = []
+    for columns in decoded:
+        if isinstance(columns["pub_region"], list): pub_region += columns["pub_region"]
+        else: pub_region += [columns["pub_region"]] * len(columns["unix_ms"])
+
+    msg_trip_s = (time() * 1000 - unix_ms) / 1000.0
+    msg_proc_s = np.full(samples, (perf_counter() - t_start_sec) / max(1, len(messages)))
+
+    names = ["unix_ms", "pub_region", "datetime_created", "msg_trip_s", "msg_proc_s"] + list(channel_columns(channels))
+    arrays = [
+        pa.array(unix_ms.astype(np.int64)),
+        pa.array(pub_region, type=pa.string()),
+        pa.array(datetime_created_us, type=pa.timestamp("us", tz="UTC")),
+        pa.array(msg_trip_s),
+        pa.array(msg_proc_s),
+    ]
+    for i in range(0, channels):
+        arrays.append(pa.array(payload[i]) if missing is None else pa.array(payload[i], mask=missing[i]))
+
+    record_batch = pa.RecordBatch.from_arrays(arrays, names=names)
+    if verbose: print(str(len(messages)) + " messages decoded into a record batch of " + str(samples) + " rows in " + str(round(perf_counter() - t_start_sec,3)) + " sec")
+    return record_batch, rows_per_message
+
+
+def gcp_pubsub_msg_to_bq_rows(project_id=None, dataset_id=None, table_id=None, message=None, dedup_index=None, check_exists=True, decode_pool=None, verbose=True):
+    """"
+    Decodes the Google Pub/Sub message and returns the list of new rows (dictionaries)
+    for the Google BigQuery table.  Samples that already exist in the table are skipped.
+
+    dedup_index is an optional BqDedupIndex for the table that replaces the per-row
+    gcp_bq_row_exists() query with an in-memory check.
+    check_exists=False skips the check (every sample is returned).
+    decode_pool is an optional ProcessPoolExecutor (see gcp_pubsub_decode_pool()) that runs
+    gcp_pubsub_decode_msg_rows() in a worker process instead of the calling thread.
+    """
 
     if project_id is None: raise Exception("Argument project_id has not been passed")
     if dataset_id is None: raise Exception("Argument data_set has not been passed")
@@ -70,79 +359,146 @@ def gcp_write_pubsub_msg_to_bq(project_id=None, dataset_id=None, table_id=None,
         print("ordering_key:", message.ordering_key)
         print("attributes:", message.attributes)
 
-    t_start_sec = perf_counter()
-    # Get the metadata within the message
-    attrs = message.attributes['attrs']     # <class 'str'>
-    # attrs: {"business":"Mechatronic Solutions LLC","latitude":40.44127,"longitude":-76.12276,"unix_ms":1679828219121,"time":"2023-03-26T10:58:59+0000", "source"}
-    # Convert the string to a Python dictionary
-    attrs = json.loads(attrs)
-    #print("attrs[business]:", attrs['business'])
+    if decode_pool is None:
+        rows = gcp_pubsub_decode_msg_rows(data=message.data, attributes=message.attributes, verbose=verbose)
+    else:
+        rows = decode_pool.submit(gcp_pubsub_decode_msg_rows, message.data, dict(message.attributes), verbose).result()
+
+    # Store each sample in Google BigQuery only if the record doesn't already exist.
+    # Without a dedup index, one query checks every sample of the message.
+    if check_exists and dedup_index is None:
+        existing = gcp_bq_rows_exist(project_id=project_id, dataset_id=dataset_id, table_id=table_id, keys=[(row['unix_ms'], row['pub_region']) for row in rows], batch_query=False)
+    rows_to_insert = []
+    for row in rows:
+        pub_region = row['pub_region']
+        if not check_exists:
+            exists = False
+        elif not dedup_index is None:
+            exists = dedup_index.exists(unix_ms=row['unix_ms'], pub_region=pub_region)
+        else:
+            exists = (float(row['unix_ms']), pub_region) in existing
+        if exists:
+            print("WARNING:  The record " + str(row['unix_ms']) + " already exists in table '" + table_id + "' and therefore it will not be added.")
+        else:
+            rows_to_insert.append(row)
 
-    # deserializes JSON in message.data to Python objects
-    try:
-        data = json.loads(message.data)     
-    except json.JSONDecodeError as e:
-        raise Exception(e)
-    # data is now a dictionary
-    
-    datetime_created = data['datetime_created']
-    datetime_created = datetime.strptime(datetime_created, "%Y-%m-%dT%H:%M:%S.%f%z")
-    #print("datetime_created:", datetime_created)    
-    
-    # Calculate the message send/receive time
-    unix_ms_now = mktime(datetime.now(tz=timezone.utc).timetuple()) * 1000
-    elapsed_ms = unix_ms_now - data['unix_ms']
-    # Extract the time in unix_ms and convert to a Python date object
-    unix_ms = data['unix_ms']
-    #print("unix_ms:", unix_ms, "\t", datetime.fromtimestamp(unix_ms/1000.0, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f%z'))
-    
-    # Deserialize the JSON string holding the list (JSON array) of floating point values
-    payload = json.loads(data['payload'])
-    #if verbose: print(str(len(payload)) + " channels of data:")
-    #for i in range(0,len(payload)):
-    #    if verbose: print("\tCh " + str(i) + "\t" + str(payload[i]))
+    return rows_to_insert
 
-    pub_region = data['pub_region']
-    #print("pub_region: " + pub_region)
 
-    # Report the message send/receive time
-    print("Message send/receive time: " + str(round(elapsed_ms/1000.0,1)) + " sec round trip including Scheduler Run Jobs interval delay")
+def gcp_write_pubsub_msg_to_bq(project_id=None, dataset_id=None, table_id=None, message=None, dedup_index=None, check_exists=True, decode_pool=None, verbose=True):
+    """"
+    Returns True if successful, including when every sample already exists in the table.
 
-    # Report the script execution time
-    t_elapsed_sec = perf_counter() - t_start_sec
-    print("Callback message processing elapsed time " + str(round(t_elapsed_sec,3)) + " sec")
+    Decodes the Google Pub/Sub message and writes inserts a new record into
+    the Google BigQuery database.
+
+    dedup_index is an optional BqDedupIndex for the table that replaces the per-row
+    gcp_bq_row_exists() query with an in-memory check.
+    check_exists=False skips the check before the insert.  Each row is inserted with a deterministic
+    insertId (see gcp_bq_insert_id()), so BigQuery drops the rows of a redelivered message.
+    decode_pool is an optional ProcessPoolExecutor for decoding the message (see gcp_pubsub_msg_to_bq_rows()).
+    """
+
+    from google.cloud import bigquery
 
-    # Store the message data in Google BigQuery only if the record doesn't already exist.
-    if gcp_bq_row_exists(project_id=project_id, dataset_id=dataset_id, table_id=table_id, unix_ms=unix_ms, pub_region=pub_region):
-        print("WARNING:  The record already exists in table '" + table_id + "' and therefore it will not be added.")
-        return False
+    rows_to_insert = gcp_pubsub_msg_to_bq_rows(project_id=project_id, dataset_id=dataset_id, table_id=table_id, message=message, dedup_index=dedup_index, check_exists=check_exists, decode_pool=decode_pool, verbose=verbose)
+    row_ids = [gcp_bq_insert_id(pub_region=row['pub_region'], unix_ms=row['unix_ms'], message_id=message.message_id) for row in rows_to_insert]
+
+    if len(rows_to_insert) == 0:
+        # Every sample already exists in the table, so there is nothing to write
+        return True
     else:
-        client = bigquery.Client()
+        from google.cloud.exceptions import NotFound
 
-        table_ref = client.dataset(dataset_id).table(table_id)
+        client = gcp_bq_client(project_id)
 
-        row = {'pub_region': 'us-east4', 
-                'datetime_created': datetime_created.strftime("%Y-%m-%dT%H:%M:%S.%f"), 
-                'unix_ms': unix_ms,
-                'msg_trip_s': elapsed_ms/1000.0,
-                'msg_proc_s': t_elapsed_sec,
-                }
-        for i in range(0,len(payload)):
-            row["Channel_" + str(i+1)] = payload[i]
-        rows_to_insert = [row]
-        #print("row:", row)  # {'pub_region': 'us-east4', 'datetime_created': '2024-09-20T11:31:38.520109', 'unix_ms': 1726846298000.0, 'Channel_1': 0.1726846298, 'Channel_2': 0.17182766645607023, 'Channel_3': 0.20854329490139709, 'Channel_4': 0.8513872227333332, 'Channel_5': 3.453692596}
-    
-        errors = client.insert_rows_json(table_ref, rows_to_insert)
+        # The table (and its schema) comes from the metadata cache, so the insert is the only request
+        table_ref = gcp_bq_get_table_cached(project_id=project_id, dataset_id=dataset_id, table_id=table_id, client=client)
+        if table_ref is None: table_ref = client.dataset(dataset_id).table(table_id)
+
+        # All of the samples in the message are inserted with one request
+        try:
+            errors = client.insert_rows_json(table_ref, rows_to_insert, row_ids=row_ids)
+        except NotFound as e:
+            # The table was deleted (or the dataset), so the cached metadata is stale
+            gcp_bq_invalidate_metadata(project_id=project_id, dataset_id=dataset_id, table_id=table_id)
+            print("ERROR: " + str(e))
+            return False
         if errors:
             print('Errors:', errors)
             return False
         else:
-            if verbose: print('Data inserted into the BigQuery table from the last message successfully.')
+            if not dedup_index is None:
+                for row in rows_to_insert:
+                    dedup_index.add(unix_ms=row['unix_ms'], pub_region=row['pub_region'])
+            if verbose: print(str(len(rows_to_insert)) + ' rows inserted into the BigQuery table from the last message successfully.')
             return True
 
 
+def gcp_write_pubsub_msgs_to_sink(project_id=None, dataset_id=None, table_id=None, messages=None, batch_writer=None, dedup_index=None, check_exists=True, ack=None, nack=None, verbose=False):
+    """
+    Decodes the Google Pub/Sub messages together into one pyarrow.RecordBatch (see gcp_pubsub_msgs_to_record_batch())
+    and buffers the new rows in batch_writer, a columnar sink (e.g. ParquetSink, BqLoadJobSink) with add_record_batch().
+    Samples that already exist in the table are skipped (dedup_index and check_exists as for gcp_pubsub_msg_to_bq_rows(),
+    but one query checks the samples of every message).
+
+    ack(i) is called once the rows of messages[i] were written (or if it has no new rows), and nack(i) if
+    messages[i] could not be decoded or its rows were not written.
+    """
+    # pip install pyarrow
+    import pyarrow as pa
+
+    if messages is None: raise Exception("Argument messages has not been passed")
+    if batch_writer is None: raise Exception("Argument batch_writer has not been passed")
+    if ack is None or nack is None: raise Exception("Arguments ack and nack have not been passed")
 
-def gcp_pubsub_get_pull_subscription_message(project_id=None, subscription_id=None, timeout_s=600.0, verbose=False):
+    try:
+        record_batch, rows_per_message = gcp_pubsub_msgs_to_record_batch(messages=messages, verbose=verbose)
+    except Exception as e:
+        print("ERROR: messages could not be decoded " + str(e))
+        for i in range(0, len(messages)): nack(i)
+        return
+
+    unix_ms = record_batch.column("unix_ms").to_pylist()
+    pub_region = record_batch.column("pub_region").to_pylist()
+    if not check_exists:
+        keep = [True] * len(unix_ms)
+    elif not dedup_index is None:
+        keep = [not dedup_index.exists(unix_ms=u, pub_region=region) for u, region in zip(unix_ms, pub_region)]
+    else:
+        existing = gcp_bq_rows_exist(project_id=project_id, dataset_id=dataset_id, table_id=table_id, keys=list(zip(unix_ms, pub_region)), batch_query=False)
+        keep = [not (float(u), region) in existing for u, region in zip(unix_ms, pub_region)]
+    if not all(keep): print("WARNING:  " + str(keep.count(False)) + " records already exist in table '" + table_id + "' and therefore they will not be added.")
+
+    callbacks = []
+    row = 0
+    for i, n_rows in enumerate(rows_per_message):
+        if n_rows is None:
+            # The message could not be decoded
+            nack(i)
+            continue
+        keys = [(unix_ms[j], pub_region[j]) for j in range(row, row + n_rows) if keep[j]]
+        row += n_rows
+        if len(keys) == 0:
+            # Every sample already exists in the table
+            ack(i)
+            continue
+        def on_success(i=i, keys=keys):
+            if not dedup_index is None:
+                for u, region in keys:
+                    dedup_index.add(unix_ms=u, pub_region=region)
+            ack(i)
+        def on_failure(errors, i=i):
+            print("ERROR: message # " + str(getattr(messages[i], "message_id", i)) + " rows not written " + str(errors))
+            nack(i)
+        callbacks.append((len(keys), on_success, on_failure))
+
+    if len(callbacks) > 0:
+        batch_writer.add_record_batch(record_batch if all(keep) else record_batch.filter(pa.array(keep)), callbacks=callbacks)
+
+
+
+def gcp_pubsub_get_pull_subscription_message(project_id=None, subscription_id=None, timeout_s=600.0, dedup_index=None, batch_writer=None, check_exists=True, ack_manager=None, flow_control=None, executor_threads=SUBSCRIBE_EXECUTOR_THREADS, decode_pool=None, stop_event=None, status=None, verbose=False):
     """
     Pull messages from Google Pub/Sub via a subscription, acknowledge the message using the callback(),
     and write the message data to BigQuery if the table specified by table_id exist.
@@ -151,13 +507,35 @@ def gcp_pubsub_get_pull_subscription_message(project_id=None, subscription_id=No
     
     Uses the global constants: project_id,topic_id,dataset_id,table_id
 
+    dedup_index is an optional BqDedupIndex for the table, and check_exists=False skips the check
+    for existing rows before the insert (see gcp_write_pubsub_msg_to_bq()).
+
+    batch_writer is an optional BqBatchWriter (or BqStorageWriteSink) for the table.  The rows of each message are then
+    buffered and inserted together with the rows of other messages, and the message is acked only
+    after its rows were inserted (nacked if the insert failed, so it is delivered again).
+
+    ack_manager is an optional PubSubAckManager that keeps the ack statistics across calls.
+    Messages are only acked once their rows were written, and the acks never block the callback.
+
+    flow_control is an optional pubsub_v1.types.FlowControl (see gcp_pubsub_subscriber_flow_control())
+    limiting the messages held that were not acked or nacked yet.  The callbacks run on executor_threads
+    threads, and decode_pool is an optional ProcessPoolExecutor (see gcp_pubsub_decode_pool()) the messages
+    are decoded in.
+
+    stop_event is an optional threading.Event.  When it is set (e.g. by a SIGTERM handler) the messages
+    received are nacked, the buffered rows are written, the pending acks are sent and the streaming pull is stopped.  timeout_s=None then listens
+    until stop_event is set or the streaming pull fails.
+    status is an optional dictionary that is updated with 'streaming' (True while the streaming pull is open),
+    'messages' and 'last_message_unix' (see start_health_server()).
+
     The best Google example:  https://cloud.google.com/python/docs/reference/pubsub/latest
     Stackoverflow topic:  https://stackoverflow.com/questions/tagged/google-cloud-pubsub
 
     """
     from concurrent.futures import TimeoutError
+    from time import monotonic, time
+    import threading
     from google.cloud import pubsub_v1
-    from google.cloud.pubsub_v1.subscriber import exceptions as sub_exceptions
 
     # pip install --upgrade google-cloud-bigquery
     # from google.cloud import bigquery
@@ -167,10 +545,21 @@ def gcp_pubsub_get_pull_subscription_message(project_id=None, subscription_id=No
 
     subscriber = pubsub_v1.SubscriberClient()
 
+    # Acks are sent without waiting for the result.  The ack futures are resolved by a done callback.
+    if ack_manager is None: ack_manager = PubSubAckManager(verbose=verbose)
+
     # The `subscription_path` method creates a fully qualified identifier
     # in the form `projects/{project_id}/subscriptions/{subscription_id}`
     subscription_path = subscriber.subscription_path(project_id, subscription_id)
 
+    # Once stop_event is set or shutdown() has started, the callback nacks the messages it receives instead
+    # of writing them.  shutdown() waits for the callbacks already running (in_flight), so the final flush()
+    # writes every row and every ack is sent before the streaming pull is cancelled (acks sent after
+    # the cancel are dropped).
+    in_flight_cond = threading.Condition()
+    in_flight = 0
+    shutting_down = threading.Event()
+
     # WARNING:  The callback below that uses <class 'google.cloud.pubsub_v1.subscriber.message.Message'> 
     # doesn't return a message greater than 50 bytes:
     #   def callback(message: pubsub_v1.subscriber.message.Message) -> None:
@@ -183,59 +572,144 @@ def gcp_pubsub_get_pull_subscription_message(project_id=None, subscription_id=No
             message.data        (this is the data package)
             message.attributes
         """        
+        nonlocal in_flight
+
+        with in_flight_cond:
+            if shutting_down.is_set() or (not stop_event is None and stop_event.is_set()):
+                # The message would be written after the streaming pull stopped, when the ack can't be sent
+                ack_manager.nack(message)
+                return
+            in_flight += 1
+        try:
+            process_message(message)
+        finally:
+            with in_flight_cond:
+                in_flight -= 1
+                in_flight_cond.notify_all()
 
-        # Use `ack_with_response()` instead of `ack()` to get a future that tracks
-        # the result of the acknowledge call. When exactly-once delivery is enabled
-        # on the subscription, the message is guaranteed to not be delivered again
-        # if the ack future succeeds.
-        #message.ack()
-        ack_future = message.ack_with_response()
 
-        try:
-            # Block on result of acknowledge call.
-            # When `timeout` is not set, result() will block indefinitely, unless an exception is encountered first.
-            ack_future.result(timeout=5.0)      # was 5.0
-            print("\nAck for message # " + str(message.message_id) + " successful.")
-        except sub_exceptions.AcknowledgeError as e:
-            print("\nAck for message # " + str(message.message_id) + " failed with error " + str(e.error_code))
+    def process_message(message):
+        """
+        Writes the rows of the message (or buffers them in batch_writer) and acks or nacks it.
+        """
+        if not status is None:
+            status['messages'] = status.get('messages', 0) + 1
+            status['last_message_unix'] = time()
 
-        if gcp_bq_table_exists(project_id=PROJECT_ID, dataset_id=DATASET_ID, table_id=TABLE_ID, verbose=False):
+        if not batch_writer is None:
+            batch_callback(message)
+            return
+
+        # The table metadata is cached, so this makes no API request in the steady state
+        if gcp_bq_table_exists_cached(project_id=PROJECT_ID, dataset_id=DATASET_ID, table_id=TABLE_ID, verbose=False):
             # The table exists.  Write the message data to the BigQuery table TABLE_ID
-            if not gcp_write_pubsub_msg_to_bq(project_id=PROJECT_ID, dataset_id=DATASET_ID, table_id=TABLE_ID, message=message):
-                raise Exception("gcp_write_pubsub_msg_to_bq() error")
+            try:
+                written = gcp_write_pubsub_msg_to_bq(project_id=PROJECT_ID, dataset_id=DATASET_ID, table_id=TABLE_ID, message=message, dedup_index=dedup_index, check_exists=check_exists, decode_pool=decode_pool)
+            except Exception as e:
+                print("ERROR: gcp_write_pubsub_msg_to_bq() " + str(e))
+                written = False
+            # Ack only after the write, otherwise nack so the message is delivered again.
+            # When exactly-once delivery is enabled on the subscription, the message is guaranteed
+            # to not be delivered again if the ack future succeeds.
+            if written:
+                ack_manager.ack(message)
+            else:
+                ack_manager.nack(message)
         else:
             # The BigQuery table doesn't exist.  Just print out the data. 
             print("message.data:", message.data)
             print("ordering_key:", message.ordering_key)
             print("attributes:", message.attributes)
+            ack_manager.ack(message)
+
+
+    def batch_callback(message):
+        """
+        Buffers the rows of the message in batch_writer.  The message is acked after the rows were inserted.
+        """
+        if not sink_table_exists(batch_writer=batch_writer, project_id=PROJECT_ID):
+            # The BigQuery table doesn't exist.  Just print out the data. 
+            print("message.data:", message.data)
+            print("ordering_key:", message.ordering_key)
+            print("attributes:", message.attributes)
+            ack_manager.ack(message)
+            return
+
+        try:
+            rows = gcp_pubsub_msg_to_bq_rows(project_id=PROJECT_ID, dataset_id=DATASET_ID, table_id=TABLE_ID, message=message, dedup_index=dedup_index, check_exists=check_exists, decode_pool=decode_pool, verbose=False)
+            row_ids = [gcp_bq_insert_id(pub_region=row['pub_region'], unix_ms=row['unix_ms'], message_id=message.message_id) for row in rows]
+        except Exception as e:
+            print("ERROR: message # " + str(message.message_id) + " could not be decoded " + str(e))
+            ack_manager.nack(message)
+            return
+
+        if len(rows) == 0:
+            # Every sample already exists in the table
+            ack_manager.ack(message)
+            return
+
+        def on_success():
+            if not dedup_index is None:
+                for row in rows:
+                    dedup_index.add(unix_ms=row['unix_ms'], pub_region=row['pub_region'])
+            ack_manager.ack(message)
+
+        def on_failure(errors):
+            print("ERROR: message # " + str(message.message_id) + " rows not inserted " + str(errors))
+            ack_manager.nack(message)
+
+        batch_writer.add(rows, on_success=on_success, on_failure=on_failure, row_ids=row_ids)
 
 
     # Asynchronously start receiving messages on a given subscription.
     # Starts a background thread to begin pulling messages from a Pub/Sub subscription and scheduling them to be processed using the provided callback.
-    streaming_pull_future = subscriber.subscribe(subscription_path, callback=callback)
+    if flow_control is None: flow_control = gcp_pubsub_subscriber_flow_control()
+    scheduler = gcp_pubsub_subscriber_scheduler(executor_threads=executor_threads)
+    streaming_pull_future = subscriber.subscribe(subscription_path, callback=callback, flow_control=flow_control, scheduler=scheduler)
     print("\nListening for messages from " + subscription_path + "")
+    if not status is None: status['streaming'] = True
+
+    def shutdown():
+        # Insert the rows still buffered and send their acks before the streaming pull is stopped.
+        # No rows are added once the running callbacks have returned, so the flush writes all of them.
+        with in_flight_cond:
+            shutting_down.set()
+            if not in_flight_cond.wait_for(lambda: in_flight == 0, timeout=30.0): print("WARNING: " + str(in_flight) + " messages still being processed at shutdown")
+        if not batch_writer is None: batch_writer.flush()
+        if not ack_manager.wait(timeout_s=30.0): print("WARNING: " + str(ack_manager.pending) + " acks still pending at shutdown")
+        streaming_pull_future.cancel()  # Trigger the shutdown.
+        streaming_pull_future.result()  # Block until the shutdown is complete.
 
     # Wrap subscriber in a 'with' block to automatically call close() when done.
     with subscriber:
         try:
             # When `timeout` is not set, result() will block indefinitely, unless an exception is encountered first.
             # timeout indicates how long you want the subscriber to receive messages. 
-            streaming_pull_future.result(timeout=timeout_s)
+            if stop_event is None:
+                streaming_pull_future.result(timeout=timeout_s)
+            else:
+                t_end = None if timeout_s is None else monotonic() + timeout_s
+                while not stop_event.wait(1.0):
+                    # result() raises the error the streaming pull failed with
+                    if streaming_pull_future.done(): streaming_pull_future.result()
+                    if not t_end is None and monotonic() >= t_end: raise TimeoutError()
+                print("Stop requested, message listening stopped.")
+                shutdown()
         except TimeoutError:
             print("Message listening stopped. The timeout of " + str(timeout_s) + "s was reached.")
-            streaming_pull_future.cancel()  # Trigger the shutdown.
-            streaming_pull_future.result()  # Block until the shutdown is complete.
+            shutdown()
         except KeyboardInterrupt:
             print("Keyboard interrupt stopped script")
-            streaming_pull_future.cancel()  # Trigger the shutdown.
-            streaming_pull_future.result()  # Block until the shutdown is complete.
+            shutdown()
         except Exception as e:
             print("ERROR: " + str(e))
-            streaming_pull_future.cancel()  # Trigger the shutdown.
-            streaming_pull_future.result()  # Block until the shutdown is complete.
+            shutdown()
 
         # Will not reach here until timeout_s has elapsed
 
+    if not status is None: status['streaming'] = False
+    print("Ack manager: " + ack_manager.summary())
+
 
     # When exactly-once delivery is enabled on the subscription, 
     # after an Ack, this error can happen:  
@@ -247,6 +721,483 @@ def gcp_pubsub_get_pull_subscription_message(project_id=None, subscription_id=No
 
 
 
+def gcp_pubsub_drain_subscription(project_id=None, subscription_id=None, max_messages=PULL_MAX_MESSAGES, deadline_s=PULL_DEADLINE_S, timeout_s=PULL_TIMEOUT_S, ack_deadline_s=PULL_ACK_DEADLINE_S, dedup_index=None, batch_writer=None, check_exists=True, executor_threads=SUBSCRIBE_EXECUTOR_THREADS, decode_pool=None, subscriber=None, verbose=False):
+    """
+    Drains the subscription with synchronous pulls of up to max_messages messages and returns
+    (acked, nacked), the number of messages acknowledged and not acknowledged.
+
+    Each pull is processed in bulk:  the messages are decoded on executor_threads threads (and in
+    decode_pool if passed), their rows are written with batch_writer.write() (a temporary
+    BqBatchWriter if None), and then the written messages are acked with one request.  The messages
+    that were not written are nacked (ack deadline set to 0) so they are delivered again.
+    A sink may hold the messages after write() until their rows are durable (BqLoadJobSink loads its
+    segments every load_interval_s, not per pull):  the ack deadline of the messages held is extended to
+    ack_deadline_s, and they are acked once the sink has called their callbacks, at the latest by
+    batch_writer.flush() when the drain ends.
+    When batch_writer is columnar (e.g. ParquetSink, BqLoadJobSink) the messages of the pull of the
+    COLUMNAR_PACKET_TYPES are instead decoded together into one pyarrow.RecordBatch (see gcp_pubsub_msgs_to_record_batch()) that is
+    passed to batch_writer.add_record_batch(), without a dictionary per row.
+
+    Returns as soon as a pull returns no messages or times out after timeout_s (the subscription
+    is drained), or when deadline_s has elapsed.  A pull on an empty subscription can wait for
+    messages until its timeout, so keep timeout_s short.
+
+    NOTE: Each pull must be written within the ack deadline of the subscription (10 to 600 s).
+
+    dedup_index, check_exists and decode_pool as for gcp_pubsub_get_pull_subscription_message().
+    subscriber is an optional pubsub_v1.SubscriberClient (one is created and closed if None).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import threading
+    from time import monotonic
+    from google.api_core.exceptions import DeadlineExceeded
+    from google.cloud import pubsub_v1
+
+    if project_id is None: raise Exception("Argument project_id not passed to the function.")
+    if subscription_id is None: raise Exception("Argument subscription_id not passed to the function.")
+    if ack_deadline_s < 10 or ack_deadline_s > 600: raise Exception("Argument ack_deadline_s must be from 10 to 600, not " + str(ack_deadline_s))
+    if max_messages < 1: raise Exception("Argument max_messages must be at least 1, not " + str(max_messages))
+    if timeout_s <= 0: raise Exception("Argument timeout_s must be greater than 0, not " + str(timeout_s))
+
+    close_subscriber = subscriber is None
+    if subscriber is None: subscriber = pubsub_v1.SubscriberClient()
+    subscription_path = subscriber.subscription_path(project_id, subscription_id)
+
+    close_writer = batch_writer is None
+    if batch_writer is None: batch_writer = BqBatchWriter(project_id=project_id, dataset_id=DATASET_ID, table_id=TABLE_ID, verbose=verbose)
+
+    def decode(received):
+        # Returns (rows, row_ids), or None if the message could not be decoded
+        message = received.message
+        try:
+            rows = gcp_pubsub_msg_to_bq_rows(project_id=project_id, dataset_id=DATASET_ID, table_id=TABLE_ID, message=message, dedup_index=dedup_index, check_exists=check_exists, decode_pool=decode_pool, verbose=False)
+        except Exception as e:
+            print("ERROR: message # " + str(message.message_id) + " could not be decoded " + str(e))
+            return None
+        return rows, [gcp_bq_insert_id(pub_region=row['pub_region'], unix_ms=row['unix_ms'], message_id=message.message_id) for row in rows]
+
+    # The ack_ids of the messages pulled that were not acked or nacked yet (with the time their ack deadline
+    # was last extended, or None), and of those to ack and to nack.  The callbacks may be called from a
+    # thread of batch_writer.
+    lock = threading.Lock()
+    held = {}
+    ack_ids = []
+    nack_ids = []
+
+    def ack(ack_id):
+        with lock:
+            held.pop(ack_id, None)
+            ack_ids.append(ack_id)
+
+    def nack(ack_id):
+        with lock:
+            held.pop(ack_id, None)
+            nack_ids.append(ack_id)
+
+    def send():
+        # Acks and nacks the messages done since the last send(), returns (acked, nacked)
+        with lock:
+            to_ack = ack_ids[:]
+            to_nack = nack_ids[:]
+            del ack_ids[:]
+            del nack_ids[:]
+        n_acked = 0
+        n_nacked = 0
+        for i in range(0, len(to_ack), max_messages):
+            try:
+                subscriber.acknowledge(request={"subscription": subscription_path, "ack_ids": to_ack[i:i+max_messages]})
+                n_acked += len(to_ack[i:i+max_messages])
+            except Exception as e:
+                # With exactly-once delivery the messages that were not acked are delivered again
+                print("ERROR: acknowledge() " + str(e))
+                n_nacked += len(to_ack[i:i+max_messages])
+        for i in range(0, len(to_nack), max_messages):
+            try:
+                subscriber.modify_ack_deadline(request={"subscription": subscription_path, "ack_ids": to_nack[i:i+max_messages], "ack_deadline_seconds": 0})
+            except Exception as e:
+                print("ERROR: modify_ack_deadline() " + str(e))
+        n_nacked += len(to_nack)
+        return n_acked, n_nacked
+
+    def extend():
+        # Extends the ack deadline of the messages held by batch_writer (e.g. until BqLoadJobSink has loaded
+        # their rows) to ack_deadline_s, when it was not extended yet or half of it has elapsed
+        with lock:
+            due = [ack_id for ack_id, t in held.items() if t is None or monotonic() - t >= ack_deadline_s / 2]
+            for ack_id in due: held[ack_id] = monotonic()
+        for i in range(0, len(due), max_messages):
+            try:
+                subscriber.modify_ack_deadline(request={"subscription": subscription_path, "ack_ids": due[i:i+max_messages], "ack_deadline_seconds": int(ack_deadline_s)})
+            except Exception as e:
+                print("ERROR: modify_ack_deadline() " + str(e))
+
+    acked = 0
+    nacked = 0
+    t_deadline = monotonic() + deadline_s
+    print("\nDraining messages from " + subscription_path + "")
+    try:
+        with ThreadPoolExecutor(max_workers=executor_threads) as executor:
+            while monotonic() < t_deadline:
+                try:
+                    response = subscriber.pull(request={"subscription": subscription_path, "max_messages": max_messages}, timeout=max(1.0, min(timeout_s, t_deadline - monotonic())))
+                except DeadlineExceeded:
+                    # No messages within timeout_s
+                    break
+                received_messages = list(response.received_messages)
+                if len(received_messages) == 0: break
+                pulled = [received.ack_id for received in received_messages]
+                with lock:
+                    for ack_id in pulled: held[ack_id] = None
+
+                if sink_table_exists(batch_writer=batch_writer, project_id=project_id):
+                    # The messages of the COLUMNAR_PACKET_TYPES go to a columnar sink as one record batch
+                    columnar = []
+                    row_messages = received_messages
+                    if getattr(batch_writer, "columnar", False):
+                        columnar = [received for received in received_messages if received.message.attributes.get(PACKET_TYPE_ATTRIBUTE, 'JSON') in COLUMNAR_PACKET_TYPES]
+                        row_messages = [received for received in received_messages if not received.message.attributes.get(PACKET_TYPE_ATTRIBUTE, 'JSON') in COLUMNAR_PACKET_TYPES]
+                    if len(columnar) > 0:
+                        columnar_ids = [received.ack_id for received in columnar]
+                        gcp_write_pubsub_msgs_to_sink(project_id=project_id, dataset_id=DATASET_ID, table_id=TABLE_ID, messages=[received.message for received in columnar], batch_writer=batch_writer, dedup_index=dedup_index, check_exists=check_exists, ack=lambda i, ids=columnar_ids: ack(ids[i]), nack=lambda i, ids=columnar_ids: nack(ids[i]), verbose=verbose)
+                    for received, decoded in zip(row_messages, executor.map(decode, row_messages)):
+                        if decoded is None:
+                            nack(received.ack_id)
+                        elif len(decoded[0]) == 0:
+                            # Every sample already exists in the table
+                            ack(received.ack_id)
+                        else:
+                            rows, row_ids = decoded
+                            def on_success(ack_id=received.ack_id, rows=rows):
+                                if not dedup_index is None:
+                                    for row in rows:
+                                        dedup_index.add(unix_ms=row['unix_ms'], pub_region=row['pub_region'])
+                                ack(ack_id)
+                            def on_failure(errors, ack_id=received.ack_id):
+                                nack(ack_id)
+                            batch_writer.add(rows, on_success=on_success, on_failure=on_failure, row_ids=row_ids)
+                    batch_writer.write()
+                else:
+                    # The BigQuery table doesn't exist.  Just print out the data.
+                    for received in received_messages:
+                        print("message.data:", received.message.data)
+                        print("attributes:", dict(received.message.attributes))
+                        ack(received.ack_id)
+
+                # The messages still held by batch_writer are acked later
+                extend()
+                n_acked, n_nacked = send()
+                acked += n_acked
+                nacked += n_nacked
+                if verbose: print(str(len(received_messages)) + " messages pulled, " + str(n_acked) + " acked, " + str(n_nacked) + " nacked, " + str(len(held)) + " held")
+
+            # Every callback has been called once flush() returns
+            extend()
+            batch_writer.flush()
+            n_acked, n_nacked = send()
+            acked += n_acked
+            nacked += n_nacked
+            if len(held) > 0: print("WARNING: " + str(len(held)) + " messages still held by the sink were not acked, they are delivered again")
+    finally:
+        if close_writer: batch_writer.close()
+        if close_subscriber: subscriber.close()
+
+    print("Drained " + str(acked) + " messages (" + str(nacked) + " not acked) from " + subscription_path + "")
+    return acked, nacked
+
+
+def start_health_server(port=HEALTH_PORT, status=None, ack_manager=None, batch_writer=None):
+    """
+    Starts an HTTP server on a daemon thread and returns it (call .shutdown() to stop it).
+
+    GET /healthz (or any path) returns the status dictionary (see gcp_pubsub_get_pull_subscription_message())
+    as JSON, with the ack_manager and batch_writer stats if passed.  The response is 200 while
+    status['streaming'] is True, otherwise 503.
+    """
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from time import time
+
+    if status is None: raise Exception("Argument status has not been passed")
+
+    class HealthHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = dict(status)
+            body['uptime_s'] = round(time() - body.get('started_unix', time()), 1)
+            if not ack_manager is None: body['acks'] = ack_manager.summary()
+            if not batch_writer is None: body['bq_writer'] = dict(batch_writer.stats)
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(200 if status.get('streaming', False) else 503)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            # No access log for every health check
+            pass
+
+    server = ThreadingHTTPServer(("", port), HealthHandler)
+    threading.Thread(target=server.serve_forever, name="HealthServer", daemon=True).start()
+    print("Health endpoint on http://localhost:" + str(server.server_address[1]) + "/healthz")
+    return server
+
+
+
+def create_dedup_index(verbose=True):
+    """
+    Returns the BqDedupIndex for the table, loaded with the rows written in the last DEDUP_WARM_WINDOW_S
+    if BQ_CHECK_EXISTS, the writer does not set insertIds and the table exists.
+    """
+    # In-memory index of the rows already in the table, used instead of a BigQuery query per row.
+    # Its Bloom filter is rotated every warm window, so it does not fill up in a long running service.
+    dedup_index = BqDedupIndex(project_id=PROJECT_ID, dataset_id=DATASET_ID, table_id=TABLE_ID, bloom_rotate_s=DEDUP_WARM_WINDOW_S)
+    if BQ_CHECK_EXISTS and DEDUP_WARM_WINDOW_S > 0 and not BQ_WRITER in ["batch", "row"] and gcp_bq_table_exists_cached(project_id=PROJECT_ID, dataset_id=DATASET_ID, table_id=TABLE_ID, verbose=False):
+        dedup_index.warm(window_s=DEDUP_WARM_WINDOW_S, verbose=verbose)
+    return dedup_index
+
+
+def sink_names():
+    """ Returns the list of sinks in SINKS ("bigquery" if SINKS is empty). """
+    names = [name.strip().lower() for name in SINKS.split(",") if name.strip() != ""]
+    if len(names) == 0: names = ["bigquery"]
+    for name in names:
+        if not name in ["bigquery", "parquet", "sqlite"]: raise Exception("GCP_SINKS of '" + SINKS + "' not supported.  Use a list of 'bigquery', 'parquet' and 'sqlite'.")
+    return names
+
+
+def sink_table_exists(batch_writer=None, project_id=None):
+    """
+    Returns True if the rows can be written with batch_writer: it has no BigQuery sink, or the table exists.
+    """
+    if not getattr(batch_writer, "bigquery", True): return True
+    # The table metadata is cached, so this makes no API request in the steady state
+    return gcp_bq_table_exists_cached(project_id=project_id, dataset_id=DATASET_ID, table_id=TABLE_ID, verbose=False)
+
+
+def create_bq_writer(verbose=True):
+    """
+    Returns the sink for SINKS: the BqBatchWriter (or BqStorageWriteSink) for BQ_WRITER, a ParquetSink,
+    a SqliteSink, or a MultiSink of several of them.  Returns None for BQ_WRITER "row" without other sinks.
+    """
+    names = sink_names()
+    sinks = []
+    for name in names:
+        if name == "parquet":
+            sinks.append(ParquetSink(path=PARQUET_SINK_DIR, prefix=TABLE_ID, max_rows=BQ_BATCH_MAX_ROWS, max_bytes=BQ_BATCH_MAX_BYTES, max_latency_s=BQ_BATCH_MAX_LATENCY_S, verbose=verbose))
+        elif name == "sqlite":
+            sinks.append(SqliteSink(path=SQLITE_SINK_PATH, table_id=TABLE_ID, max_rows=BQ_BATCH_MAX_ROWS, max_bytes=BQ_BATCH_MAX_BYTES, max_latency_s=BQ_BATCH_MAX_LATENCY_S, verbose=verbose))
+        elif BQ_WRITER == "row" and len(names) > 1:
+            raise Exception("GCP_BQ_WRITER of 'row' can't be used with other GCP_SINKS.  Use 'batch', 'storage_write' or 'load_job'.")
+        else:
+            sinks.append(create_bq_sink(verbose=verbose))
+    if len(sinks) == 1: return sinks[0]
+    return MultiSink(sinks, verbose=verbose)
+
+
+def create_bq_sink(verbose=True):
+    """
+    Returns the BqBatchWriter (BqStorageWriteSink or BqLoadJobSink) for BQ_WRITER, or None for "row".
+    """
+    if BQ_WRITER == "batch":
+        return BqBatchWriter(project_id=PROJECT_ID, dataset_id=DATASET_ID, table_id=TABLE_ID, max_rows=BQ_BATCH_MAX_ROWS, max_bytes=BQ_BATCH_MAX_BYTES, max_latency_s=BQ_BATCH_MAX_LATENCY_S, verbose=verbose)
+    elif BQ_WRITER == "storage_write":
+        return BqStorageWriteSink(project_id=PROJECT_ID, dataset_id=DATASET_ID, table_id=TABLE_ID, max_rows=BQ_BATCH_MAX_ROWS, max_bytes=BQ_BATCH_MAX_BYTES, max_latency_s=BQ_BATCH_MAX_LATENCY_S, verbose=verbose)
+    elif BQ_WRITER == "load_job":
+        return BqLoadJobSink(project_id=PROJECT_ID, dataset_id=DATASET_ID, table_id=TABLE_ID, path=BQ_LOAD_DIR, load_interval_s=BQ_LOAD_INTERVAL_S, max_rows=BQ_BATCH_MAX_ROWS, max_bytes=BQ_BATCH_MAX_BYTES, max_latency_s=BQ_BATCH_MAX_LATENCY_S, verbose=verbose)
+    elif BQ_WRITER == "row":
+        return None
+    else:
+        raise Exception("GCP_BQ_WRITER of '" + BQ_WRITER + "' not supported.  Use 'batch', 'storage_write', 'load_job' or 'row'.")
+
+
+def run_subscriber_service(stop_event=None, status=None, dedup_index=None, batch_writer=None, ack_manager=None, flow_control=None, decode_pool=None, verbose=True):
+    """
+    Keeps a streaming pull open on SUBSCRIPTION_ID until stop_event is set.
+    A streaming pull that fails with an error the client library does not retry is opened again after 5 s.
+    """
+    if stop_event is None: raise Exception("Argument stop_event has not been passed")
+    if status is None: raise Exception("Argument status has not been passed")
+
+    while not stop_event.is_set():
+        gcp_pubsub_get_pull_subscription_message(project_id=PROJECT_ID, subscription_id=SUBSCRIPTION_ID, timeout_s=None, dedup_index=dedup_index, batch_writer=batch_writer, check_exists=BQ_CHECK_EXISTS, ack_manager=ack_manager, flow_control=flow_control, executor_threads=SUBSCRIBE_EXECUTOR_THREADS, decode_pool=decode_pool, stop_event=stop_event, status=status, verbose=verbose)
+        if not stop_event.is_set():
+            status['restarts'] = status.get('restarts', 0) + 1
+            print("Streaming pull stopped, restarting in 5 sec..")
+            stop_event.wait(5.0)
+
+
+# ---------------------------------------------------------------------------
+# Multi-process subscriber supervisor
+
+# The module constants passed to each worker process (they may have been overridden by env vars)
+SUBSCRIBER_CONFIG = ["PROJECT_ID", "SUBSCRIPTION_ID", "DATASET_ID", "TABLE_ID", "BQ_WRITER", "BQ_CHECK_EXISTS", "DEDUP_WARM_WINDOW_S",
+                     "SINKS", "PARQUET_SINK_DIR", "SQLITE_SINK_PATH", "BQ_BATCH_MAX_ROWS", "BQ_BATCH_MAX_BYTES", "BQ_BATCH_MAX_LATENCY_S",
+                     "BQ_LOAD_DIR", "BQ_LOAD_INTERVAL_S",
+                     "SUBSCRIBE_MAX_OUTSTANDING_MESSAGES", "SUBSCRIBE_MAX_OUTSTANDING_BYTES", "SUBSCRIBE_EXECUTOR_THREADS", "SUBSCRIBE_DECODE_PROCESSES"]
+
+# Metrics summed over the workers
+SUBSCRIBER_METRICS = ["messages", "restarts", "acks", "ack_failures", "nacks", "rows", "requests", "failed_rows"]
+
+
+def subscriber_worker(worker_id=0, config=None, stop_event=None, metrics_queue=None, report_s=10.0):
+    """
+    Worker process started by run_subscriber_supervisor().  Runs run_subscriber_service() with its own
+    SubscriberClient, BigQuery writer, dedup index and ack manager until stop_event is set, and puts
+    its metrics (a dictionary) in metrics_queue every report_s seconds and when it stops.
+    """
+    import signal
+    import threading
+    from time import time
+
+    if config is None: raise Exception("Argument config has not been passed")
+    if stop_event is None: raise Exception("Argument stop_event has not been passed")
+
+    # The process may have been started with 'spawn', so the module constants are set from config
+    globals().update(config)
+
+    def stop(signum, frame):
+        stop_event.set()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    dedup_index = create_dedup_index(verbose=False)
+    batch_writer = create_bq_writer(verbose=False)
+    ack_manager = PubSubAckManager(verbose=False)
+    flow_control = gcp_pubsub_subscriber_flow_control(max_messages=SUBSCRIBE_MAX_OUTSTANDING_MESSAGES, max_bytes=SUBSCRIBE_MAX_OUTSTANDING_BYTES)
+    decode_pool = gcp_pubsub_decode_pool(processes=SUBSCRIBE_DECODE_PROCESSES)
+    status = {'streaming': False, 'messages': 0, 'last_message_unix': None, 'started_unix': time(), 'restarts': 0}
+
+    def report():
+        metrics = {'worker': worker_id, 'pid': os.getpid(), 'streaming': status['streaming'], 'messages': status['messages'], 'restarts': status['restarts'], 'last_message_unix': status['last_message_unix']}
+        for key in ["acks", "ack_failures", "nacks"]:
+            metrics[key] = ack_manager.stats[key]
+        if not batch_writer is None:
+            for key in ["rows", "requests", "failed_rows"]:
+                metrics[key] = batch_writer.stats[key]
+        if not metrics_queue is None: metrics_queue.put(metrics)
+
+    def reporter():
+        while not stop_event.wait(report_s):
+            report()
+
+    threading.Thread(target=reporter, name="WorkerReporter", daemon=True).start()
+    try:
+        run_subscriber_service(stop_event=stop_event, status=status, dedup_index=dedup_index, batch_writer=batch_writer, ack_manager=ack_manager, flow_control=flow_control, decode_pool=decode_pool, verbose=False)
+    finally:
+        if not batch_writer is None: batch_writer.close()
+        if not decode_pool is None: decode_pool.shutdown()
+        gcp_bq_close_clients()
+        status['streaming'] = False
+        report()
+        print("Worker " + str(worker_id) + " stopped.  " + ack_manager.summary())
+
+
+def run_subscriber_supervisor(workers=2, config=None, worker=None, report_s=60.0, min_uptime_s=60.0, verbose=True):
+    """
+    Starts workers worker processes (subscriber_worker() if worker is None) that each read the subscription
+    with their own streaming pull, restarts the ones that exit (after 1, 2, 4 .. 60 s, the backoff is reset
+    once a worker has run for min_uptime_s), and serves the health
+    endpoint on HEALTH_PORT with the metrics summed over the workers.  Runs until SIGTERM or SIGINT, then
+    stops the workers (they write their buffered rows and send their acks) and returns the summed metrics.
+
+    The workers are started with 'spawn', so no gRPC channel or thread of this process is inherited.
+    """
+    import multiprocessing
+    import queue
+    import signal
+    from time import monotonic, time
+
+    if workers < 1: raise Exception("Argument workers must be at least 1, not " + str(workers))
+    if config is None: raise Exception("Argument config has not been passed")
+    if worker is None: worker = subscriber_worker
+
+    ctx = multiprocessing.get_context("spawn")
+    stop_event = ctx.Event()
+    metrics_queue = ctx.Queue()
+
+    def stop(signum, frame):
+        print("Signal " + str(signum) + " received, stopping the workers..")
+        stop_event.set()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    processes = [None] * workers
+    restarts = [0] * workers
+    failures = [0] * workers        # Consecutive exits of a worker that ran less than min_uptime_s
+    t_started = [0.0] * workers
+    t_next_start = [0.0] * workers
+    # Last metrics reported by each worker process, keyed by (worker, pid).  A restarted worker has a new
+    # pid, so a report of the exited process still in metrics_queue cannot overwrite the new one.
+    metrics = {}
+    status = {'streaming': False, 'workers': workers, 'workers_alive': 0, 'worker_restarts': 0, 'started_unix': time()}
+    status.update(dict.fromkeys(SUBSCRIBER_METRICS, 0))
+
+    def start(i):
+        processes[i] = ctx.Process(target=worker, args=(i, config, stop_event, metrics_queue), name="SubscriberWorker-" + str(i))
+        processes[i].start()
+        t_started[i] = monotonic()
+        if verbose: print("Worker " + str(i) + " started (pid " + str(processes[i].pid) + ")")
+
+    def collect(timeout_s):
+        try:
+            m = metrics_queue.get(timeout=timeout_s)
+            metrics[(m['worker'], m['pid'])] = m
+            while True:
+                m = metrics_queue.get_nowait()
+                metrics[(m['worker'], m['pid'])] = m
+        except queue.Empty:
+            pass
+
+    def aggregate():
+        for key in SUBSCRIBER_METRICS:
+            status[key] = sum(m.get(key, 0) for m in metrics.values())
+        alive = [(i, p.pid) for i, p in enumerate(processes) if not p is None and p.is_alive()]
+        status['workers_alive'] = len(alive)
+        status['worker_restarts'] = sum(restarts)
+        status['streaming'] = any(metrics.get(key, {}).get('streaming', False) for key in alive)
+        return dict(status)
+
+    health_server = start_health_server(port=HEALTH_PORT, status=status)
+
+    for i in range(0, workers):
+        start(i)
+
+    t_report = monotonic() + report_s
+    while not stop_event.is_set():
+        collect(timeout_s=1.0)
+        for i in range(0, workers):
+            p = processes[i]
+            if not p is None and not p.is_alive() and not stop_event.is_set():
+                print("WARNING: worker " + str(i) + " (pid " + str(p.pid) + ") exited with code " + str(p.exitcode))
+                collect(timeout_s=0.1)
+                restarts[i] += 1
+                if monotonic() - t_started[i] >= min_uptime_s: failures[i] = 0
+                failures[i] += 1
+                processes[i] = None
+                t_next_start[i] = monotonic() + min(60.0, 2.0 ** (failures[i] - 1))
+            if processes[i] is None and monotonic() >= t_next_start[i] and not stop_event.is_set():
+                start(i)
+        aggregate()
+        if verbose and monotonic() >= t_report:
+            t_report = monotonic() + report_s
+            print("Workers " + str(status['workers_alive']) + "/" + str(workers) + ", " + ", ".join(key + " " + str(status[key]) for key in SUBSCRIBER_METRICS) + ", worker restarts " + str(status['worker_restarts']))
+
+    # The workers stop on the same stop_event, then write their buffered rows and send their acks
+    for p in processes:
+        if p is None: continue
+        p.join(timeout=60.0)
+        if p.is_alive():
+            print("WARNING: worker pid " + str(p.pid) + " did not stop, terminating it")
+            p.terminate()
+            p.join()
+    collect(timeout_s=0.1)
+    result = aggregate()
+    health_server.shutdown()
+    print("Supervisor stopped.  " + ", ".join(key + " " + str(result[key]) for key in SUBSCRIBER_METRICS) + ", worker restarts " + str(result['worker_restarts']))
+    return result
+
+
 if __name__ == '__main__':
     pass
 
@@ -255,10 +1206,53 @@ if __name__ == '__main__':
     SUBSCRIPTION_ID = os.environ.get("GCP_SUBSCRIPTION_ID",SUBSCRIPTION_ID)
     DATASET_ID = os.environ.get("GCP_DATASET_ID",DATASET_ID)
     TABLE_ID = os.environ.get("GCP_TABLE_ID",TABLE_ID)
+    BQ_WRITER = os.environ.get("GCP_BQ_WRITER",BQ_WRITER)
+    BQ_CHECK_EXISTS = os.environ.get("GCP_BQ_CHECK_EXISTS","1" if BQ_CHECK_EXISTS else "0") == "1"
+    DEDUP_WARM_WINDOW_S = float(os.environ.get("GCP_DEDUP_WARM_WINDOW_S",DEDUP_WARM_WINDOW_S))
+    SINKS = os.environ.get("GCP_SINKS",SINKS)
+    PARQUET_SINK_DIR = os.environ.get("GCP_PARQUET_SINK_DIR",PARQUET_SINK_DIR)
+    SQLITE_SINK_PATH = os.environ.get("GCP_SQLITE_SINK_PATH",SQLITE_SINK_PATH)
+    BQ_BATCH_MAX_ROWS = int(os.environ.get("GCP_BQ_BATCH_MAX_ROWS",BQ_BATCH_MAX_ROWS))
+    BQ_BATCH_MAX_BYTES = int(os.environ.get("GCP_BQ_BATCH_MAX_BYTES",BQ_BATCH_MAX_BYTES))
+    BQ_BATCH_MAX_LATENCY_S = float(os.environ.get("GCP_BQ_BATCH_MAX_LATENCY_S",BQ_BATCH_MAX_LATENCY_S))
+    BQ_LOAD_DIR = os.environ.get("GCP_BQ_LOAD_DIR",BQ_LOAD_DIR)
+    BQ_LOAD_INTERVAL_S = float(os.environ.get("GCP_BQ_LOAD_INTERVAL_S",BQ_LOAD_INTERVAL_S))
+    PULL_MODE = os.environ.get("GCP_PULL_MODE",PULL_MODE)
+    PULL_MAX_MESSAGES = int(os.environ.get("GCP_PULL_MAX_MESSAGES",PULL_MAX_MESSAGES))
+    PULL_DEADLINE_S = float(os.environ.get("GCP_PULL_DEADLINE_S",PULL_DEADLINE_S))
+    PULL_TIMEOUT_S = float(os.environ.get("GCP_PULL_TIMEOUT_S",PULL_TIMEOUT_S))
+    PULL_ACK_DEADLINE_S = float(os.environ.get("GCP_PULL_ACK_DEADLINE_S",PULL_ACK_DEADLINE_S))
+    HEALTH_PORT = int(os.environ.get("GCP_HEALTH_PORT",os.environ.get("PORT",HEALTH_PORT)))
+    SUBSCRIBE_MAX_OUTSTANDING_MESSAGES = int(os.environ.get("GCP_SUBSCRIBE_MAX_OUTSTANDING_MESSAGES",SUBSCRIBE_MAX_OUTSTANDING_MESSAGES))
+    SUBSCRIBE_MAX_OUTSTANDING_BYTES = int(os.environ.get("GCP_SUBSCRIBE_MAX_OUTSTANDING_BYTES",SUBSCRIBE_MAX_OUTSTANDING_BYTES))
+    SUBSCRIBE_EXECUTOR_THREADS = int(os.environ.get("GCP_SUBSCRIBE_EXECUTOR_THREADS",SUBSCRIBE_EXECUTOR_THREADS))
+    SUBSCRIBE_DECODE_PROCESSES = int(os.environ.get("GCP_SUBSCRIBE_DECODE_PROCESSES",SUBSCRIBE_DECODE_PROCESSES))
+    SUBSCRIBE_WORKERS = int(os.environ.get("GCP_SUBSCRIBE_WORKERS",SUBSCRIBE_WORKERS))
+    if not PULL_MODE in ["stream", "drain", "service"]: raise Exception("GCP_PULL_MODE of '" + PULL_MODE + "' not supported.  Use 'stream', 'drain' or 'service'.")
+    # Without the BigQuery table there is nothing to check the rows against
+    if not "bigquery" in sink_names(): BQ_CHECK_EXISTS = False
+
+    if PULL_MODE == "service" and SUBSCRIBE_WORKERS > 1:
+        # The worker processes are started before any client or thread is created in this process
+        import sys
+        run_subscriber_supervisor(workers=SUBSCRIBE_WORKERS, config={name: globals()[name] for name in SUBSCRIBER_CONFIG}, verbose=True)
+        sys.exit(0)
 
     # timeout_s indicates how long the subscriber should receive messages. 
     timeout_s = 5.0        
 
+    # In-memory index of the rows already in the table, used instead of a BigQuery query per row.
+    # It is loaded with the rows written in the last DEDUP_WARM_WINDOW_S (see create_dedup_index()).
+    dedup_index = create_dedup_index(verbose=True)
+
+    batch_writer = create_bq_writer(verbose=True)
+
+    # Acks are sent without blocking the callback, and the ack statistics are kept across the pulls
+    ack_manager = PubSubAckManager(verbose=False)
+
+    flow_control = gcp_pubsub_subscriber_flow_control(max_messages=SUBSCRIBE_MAX_OUTSTANDING_MESSAGES, max_bytes=SUBSCRIBE_MAX_OUTSTANDING_BYTES)
+    decode_pool = gcp_pubsub_decode_pool(processes=SUBSCRIBE_DECODE_PROCESSES)
+
     # ---------------------------------------------------------------------------
     # Check that credentials exist for a project
 
@@ -267,7 +1261,31 @@ if __name__ == '__main__':
     script_running_locally = gcp_json_credentials_exist()
     print("\ngcp_json_credentials_exist(): " + str(script_running_locally) + "")
 
-    if script_running_locally:
+    if PULL_MODE == "service":
+        # Long running service, locally or in the cloud.  One streaming pull is kept open until SIGTERM.
+        import signal
+        import threading
+        from time import time
+
+        stop_event = threading.Event()
+        def stop(signum, frame):
+            print("Signal " + str(signum) + " received, stopping..")
+            stop_event.set()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        status = {'streaming': False, 'messages': 0, 'last_message_unix': None, 'started_unix': time(), 'restarts': 0}
+        health_server = start_health_server(port=HEALTH_PORT, status=status, ack_manager=ack_manager, batch_writer=batch_writer)
+
+        run_subscriber_service(stop_event=stop_event, status=status, dedup_index=dedup_index, batch_writer=batch_writer, ack_manager=ack_manager, flow_control=flow_control, decode_pool=decode_pool, verbose=True)
+
+        if not batch_writer is None: batch_writer.close()
+        if not decode_pool is None: decode_pool.shutdown()
+        gcp_bq_close_clients()
+        health_server.shutdown()
+        print("Service stopped.  " + ack_manager.summary())
+
+    elif script_running_locally:
         # This script is running locally, either directly or from within a Docker container, but not via Google Run Jobs.
 
         # Simulate a Schedule Run Job that executes every 59 seconds
@@ -280,7 +1298,10 @@ if __name__ == '__main__':
             t_loop_start = perf_counter()
 
             # Check for subscriptions for subscription_id and process them if they exist
-            gcp_pubsub_get_pull_subscription_message(project_id=PROJECT_ID, subscription_id=SUBSCRIPTION_ID, timeout_s=timeout_s, verbose=True)
+            if PULL_MODE == "drain":
+                gcp_pubsub_drain_subscription(project_id=PROJECT_ID, subscription_id=SUBSCRIPTION_ID, max_messages=PULL_MAX_MESSAGES, deadline_s=PULL_DEADLINE_S, timeout_s=PULL_TIMEOUT_S, ack_deadline_s=PULL_ACK_DEADLINE_S, dedup_index=dedup_index, batch_writer=batch_writer, check_exists=BQ_CHECK_EXISTS, executor_threads=SUBSCRIBE_EXECUTOR_THREADS, decode_pool=decode_pool, verbose=True)
+            else:
+                gcp_pubsub_get_pull_subscription_message(project_id=PROJECT_ID, subscription_id=SUBSCRIPTION_ID, timeout_s=timeout_s, dedup_index=dedup_index, batch_writer=batch_writer, check_exists=BQ_CHECK_EXISTS, ack_manager=ack_manager, flow_control=flow_control, executor_threads=SUBSCRIBE_EXECUTOR_THREADS, decode_pool=decode_pool, verbose=True)
             
             t = 60      # Sleep duration in seconds
             # ack future timeout is 5.0 seconds
@@ -306,7 +1327,13 @@ if __name__ == '__main__':
         if len(subscriptions) == 0: raise Exception("No subscriptions found for project_id " + PROJECT_ID)
         
         # Check for subscriptions for subscription_id and process them if they exist
-        gcp_pubsub_get_pull_subscription_message(project_id=PROJECT_ID, subscription_id=SUBSCRIPTION_ID, timeout_s=timeout_s, verbose=True)
+        if PULL_MODE == "drain":
+            gcp_pubsub_drain_subscription(project_id=PROJECT_ID, subscription_id=SUBSCRIPTION_ID, max_messages=PULL_MAX_MESSAGES, deadline_s=PULL_DEADLINE_S, timeout_s=PULL_TIMEOUT_S, ack_deadline_s=PULL_ACK_DEADLINE_S, dedup_index=dedup_index, batch_writer=batch_writer, check_exists=BQ_CHECK_EXISTS, executor_threads=SUBSCRIBE_EXECUTOR_THREADS, decode_pool=decode_pool, verbose=True)
+        else:
+            gcp_pubsub_get_pull_subscription_message(project_id=PROJECT_ID, subscription_id=SUBSCRIPTION_ID, timeout_s=timeout_s, dedup_index=dedup_index, batch_writer=batch_writer, check_exists=BQ_CHECK_EXISTS, ack_manager=ack_manager, flow_control=flow_control, executor_threads=SUBSCRIBE_EXECUTOR_THREADS, decode_pool=decode_pool, verbose=True)
+        if not batch_writer is None: batch_writer.close()
+        if not decode_pool is None: decode_pool.shutdown()
+        gcp_bq_close_clients()
 
         # Typically the callback processes the message in 0.8 to 1.3 sec (excludes storage actions)
         # Typically the round trip message send/receive is 4.0 to 6.0 sec